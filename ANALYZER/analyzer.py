@@ -1,19 +1,29 @@
 import os
 import time
+import json
 from influxdb_client import InfluxDBClient, QueryApi, Point, WriteOptions  # type: ignore
 from dotenv import load_dotenv  # type: ignore
+import paho.mqtt.client as mqtt  # type: ignore
 import threading
 import random
-import joblib # type: ignore
 import numpy as np # type: ignore
-import pandas as pd # type: ignore
-from datetime import datetime, timedelta
+from datetime import datetime
 from influxdb_client import InfluxDBClient, WriteOptions # type: ignore
+from forecast import ForecastCache, model_fingerprint
+from forecast_index import ForecastIndex, publish_index, read_index_version
+from inflow_table import inflow_model_source, load_inflow_model
+from volume_integrator import VolumeIntegrator
+from telemetry import METRICS_PORT, TRACE_KEY, count_message, extract_trace, hop_time, record_hop, start_metrics_server
+from tenancy import (DAM_TAG, configured_dam_ids, configured_shards, current_shard, dam_from_topic,
+                     flux_dam_filter, run_sharded, shard_client_id, shard_metrics_port, shard_plan)
 # Carica le variabili dal file .env
 load_dotenv()
 
 # Variabili dal .env
 DAM_UNIQUE_ID = os.getenv("DAM_UNIQUE_ID")
+# Dighe gestite (DAM_UNIQUE_IDS) e processi worker tra cui dividerle (DAM_SHARDS)
+DAM_UNIQUE_IDS = configured_dam_ids()
+DAM_SHARDS = configured_shards()
 DAM_VOLUME = float(os.getenv("DAM_VOLUME"))  # Volume iniziale
 DAM_TOTAL_VOLUME = float(os.getenv("DAM_TOTAL_VOLUME"))  # Volume massimo
 
@@ -29,16 +39,46 @@ BUCKET_PREDICTED_DATA = os.getenv("BUCKET_PREDICTED_DATA")
 VOLUME_SENSOR_DATA= os.getenv("VOLUME_SENSOR_DATA")
 VOLUME_FIELD=os.getenv("VOLUME_FIELD")
 HEIGHT_FIELD=os.getenv("HEIGHT_FIELD")
+VOLUME_CHECKPOINT_DATA = os.getenv("VOLUME_CHECKPOINT_DATA", "volume_checkpoint")
+VOLUME_CHECKPOINT_INTERVAL = int(os.getenv("VOLUME_CHECKPOINT_INTERVAL", 300))  # Secondi tra due checkpoint
+# Ricerca dell'ultimo checkpoint al riavvio: prima finestra in intervalli di checkpoint, allargata di
+# VOLUME_CHECKPOINT_LOOKBACK_GROWTH volte fino a VOLUME_CHECKPOINT_MAX_LOOKBACK secondi (limite agli shard letti)
+VOLUME_CHECKPOINT_LOOKBACK = int(os.getenv("VOLUME_CHECKPOINT_LOOKBACK", 4))
+VOLUME_CHECKPOINT_LOOKBACK_GROWTH = int(os.getenv("VOLUME_CHECKPOINT_LOOKBACK_GROWTH", 8))
+VOLUME_CHECKPOINT_MAX_LOOKBACK = int(os.getenv("VOLUME_CHECKPOINT_MAX_LOOKBACK", 30 * 24 * 3600))
+
+MQTT_BROKER = os.getenv("MQTT_BROKER")
+MQTT_PORT = int(os.getenv("MQTT_PORT"))
+MQTT_USER = os.getenv("MQTT_USER")
+MQTT_PASSWORD = os.getenv("MQTT_PASSWORD")
+FLOWS_TOPIC_PREFIX = os.getenv("FLOWS_TOPIC_PREFIX", "monitor/flows")
+FORECAST_TOPIC_PREFIX = os.getenv("FORECAST_TOPIC_PREFIX", "analyzer/forecast")
+STATE_TOPIC_PREFIX = os.getenv("STATE_TOPIC_PREFIX", "analyzer/state")  # Notifica al PLANNER di ogni volume scritto
 
 QUERY_INTERVAL = int(os.getenv("QUERY_INTERVAL"))  # Intervallo delle query e del ciclo in secondi
+VOLUME_SOURCE = os.getenv("VOLUME_SOURCE", "stream").lower()  # "stream" (MQTT dal MONITOR) oppure "query" (InfluxDB)
+STREAM_MAX_GAP = float(os.getenv("STREAM_MAX_GAP", 10))  # Buco massimo (s) integrato tra due campioni di portata
 DUMMY_VOLUME = float(os.getenv("DUMMY_VOLUME", 0))  # Volume forzato (default 0, disabilitato)
 USE_DUMMY_VOLUME = os.getenv("USE_DUMMY_VOLUME", "false").lower() == "true"  # Abilita/disabilita il DUMMY_VOLUME
 
-MODEL_BOITE = "boite_random_forest.pkl"
-MODEL_PIAVE = "piave_random_forest.pkl"
-
-model_boite = joblib.load(MODEL_BOITE)
-model_piave = joblib.load(MODEL_PIAVE)
+MODEL_BOITE = os.getenv("MODEL_BOITE", "boite_random_forest.pkl")  # Anche un modello compatto (es. boite_compact_hgb.pkl)
+MODEL_PIAVE = os.getenv("MODEL_PIAVE", "piave_random_forest.pkl")
+
+FORECAST_CACHE_FILE = os.getenv("FORECAST_CACHE_FILE", "forecast_cache.npz")  # Cache persistente delle previsioni
+
+MODEL_FILES = {"boite": MODEL_BOITE, "piave": MODEL_PIAVE}
+# Tabella precalcolata (<modello>_lut.npy) se presente, altrimenti il modello scikit-learn.
+# La previsione è la stessa per tutte le dighe: i worker degli shard integrano solo i volumi
+# e i modelli restano nel processo principale.
+forecast_models = {}
+model_fingerprints = {}
+if current_shard() is None:
+    forecast_models = {river_name: load_inflow_model(path) for river_name, path in MODEL_FILES.items()}
+    model_fingerprints = {
+        river_name: model_fingerprint(inflow_model_source(path)) for river_name, path in MODEL_FILES.items()
+    }
+forecast_cache = ForecastCache(FORECAST_CACHE_FILE)
+FORECAST_INDEX_DIR = os.getenv("FORECAST_INDEX_DIR")  # Directory condivisa con il PLANNER per l'indice delle previsioni
 
 # Connessione a InfluxDB
 client = InfluxDBClient(url=INFLUXDB_URL, token=INFLUXDB_TOKEN, org=INFLUXDB_ORG)
@@ -53,26 +93,116 @@ write_api = client.write_api(
         max_retry_delay=5000,
         exponential_base=2
     ))
-# Variabile per il volume dinamico
-current_volume = DAM_VOLUME
-# Variabili globali per i timestamp
-previous_time = None
-current_time = None
-dummy_volume_used = False
-
-
-def calculate_initial_volume():
-    global current_volume
+mqtt_client = mqtt.Client(shard_client_id("Analyzer"))
+mqtt_client.username_pw_set(MQTT_USER, MQTT_PASSWORD)
+is_connected = False
+
+
+class DamVolumeState:
+    """Volume e bilancio di una diga: ogni DAM_UNIQUE_ID gestito dal processo ha il suo stato isolato."""
+
+    def __init__(self, dam_id):
+        self.dam_id = dam_id
+        # Variabile per il volume dinamico
+        self.current_volume = DAM_VOLUME
+        # Totali cumulati di inflow/outflow (m³) dall'inizio della storia, salvati nei checkpoint
+        self.cumulative_inflow = 0.0
+        self.cumulative_outflow = 0.0
+        self.last_checkpoint_time = 0
+        # Integratore in memoria del flusso di portate pubblicato dal MONITOR
+        self.volume_integrator = VolumeIntegrator(DAM_VOLUME, max_gap=STREAM_MAX_GAP)
+        self.flow_trace = None  # Traccia dell'ultimo campione di portata ricevuto dal MONITOR
+        # Timestamp dell'ultima integrazione in modalità query
+        self.previous_time = None
+        self.dummy_volume_used = False
+
+
+dams = {}  # Dighe gestite dal processo: DAM_UNIQUE_ID -> DamVolumeState
+
+
+def checkpoint_lookbacks():
+    """Finestre (s) in cui cercare l'ultimo checkpoint, dalla più corta a VOLUME_CHECKPOINT_MAX_LOOKBACK."""
+    lookback = max(1, VOLUME_CHECKPOINT_LOOKBACK * VOLUME_CHECKPOINT_INTERVAL)
+    lookbacks = []
+    while lookback < VOLUME_CHECKPOINT_MAX_LOOKBACK:
+        lookbacks.append(lookback)
+        lookback *= max(2, VOLUME_CHECKPOINT_LOOKBACK_GROWTH)
+    lookbacks.append(VOLUME_CHECKPOINT_MAX_LOOKBACK)
+    return lookbacks
+
+
+def load_volume_checkpoint(dam):
+    """
+    Recupera l'ultimo checkpoint del volume della diga da InfluxDB (None se non presente).
+    La ricerca parte dagli ultimi VOLUME_CHECKPOINT_LOOKBACK intervalli di checkpoint e si allarga
+    solo se non trova nulla, così al riavvio InfluxDB legge solo gli shard recenti e non l'intera retention.
+    """
+    for lookback in checkpoint_lookbacks():
+        query = f'''
+        from(bucket: "{INFLUXDB_BUCKET}")
+            |> range(start: -{lookback}s)
+            |> filter(fn: (r) => r._measurement == "{VOLUME_CHECKPOINT_DATA}")
+            {flux_dam_filter([dam.dam_id])}
+            |> last()
+            |> pivot(rowKey: ["_time"], columnKey: ["_field"], valueColumn: "_value")
+        '''
+        result = query_api.query(org=INFLUXDB_ORG, query=query)
+        for table in result:
+            for record in table.records:
+                return {
+                    "time": record.get_time(),
+                    "volume": float(record.values.get(VOLUME_FIELD, 0.0)),
+                    "cumulative_inflow": float(record.values.get("cumulative_inflow", 0.0)),
+                    "cumulative_outflow": float(record.values.get("cumulative_outflow", 0.0)),
+                }
+    return None
+
+
+def write_volume_checkpoint(dam, volume):
+    """Scrive un checkpoint della diga (volume e totali cumulati) usato per il ripristino al riavvio."""
+    point = Point(f"{VOLUME_CHECKPOINT_DATA}") \
+        .tag(DAM_TAG, dam.dam_id) \
+        .field(f"{VOLUME_FIELD}", float(volume)) \
+        .field("cumulative_inflow", float(dam.cumulative_inflow)) \
+        .field("cumulative_outflow", float(dam.cumulative_outflow)) \
+        .time(time.strftime("%Y-%m-%dT%H:%M:%SZ"))
+    write_api.write(bucket=INFLUXDB_BUCKET, record=point)
+    dam.last_checkpoint_time = time.time()
+
+
+def checkpoint_due(dam):
+    """Indica se è trascorso VOLUME_CHECKPOINT_INTERVAL dall'ultimo checkpoint della diga."""
+    return time.time() - dam.last_checkpoint_time >= VOLUME_CHECKPOINT_INTERVAL
+
+
+def calculate_initial_volume(dam):
+    """Ripristina il volume della diga dall'ultimo checkpoint rigiocando solo le portate successive."""
     try:
         if USE_DUMMY_VOLUME and DUMMY_VOLUME > 0:
             print(f"INITIAL VOLUME OVERRIDDEN: {DUMMY_VOLUME} m³ (Dummy Volume Enabled)")
             return DUMMY_VOLUME
 
+        checkpoint = load_volume_checkpoint(dam)
+        if checkpoint is not None:
+            start_time = int(checkpoint["time"].timestamp())
+            end_time = int(time.time()) + 1
+            inflow = max(0, get_total_inflow(start_time, end_time, dam.dam_id))
+            outflow = max(0, get_total_outflow(start_time, end_time, dam.dam_id))
+
+            dam.cumulative_inflow = checkpoint["cumulative_inflow"] + inflow
+            dam.cumulative_outflow = checkpoint["cumulative_outflow"] + outflow
+            initial_volume = max(0, checkpoint["volume"] + inflow - outflow)
+            print(f"INITIAL VOLUME ({dam.dam_id}): {initial_volume} m³ from checkpoint at {checkpoint['time']} "
+                  f"(Replayed Inflow: {inflow} m³, Outflow: {outflow} m³)")
+            return initial_volume
+
+        # Nessun checkpoint entro VOLUME_CHECKPOINT_MAX_LOOKBACK (primo avvio): somma l'intera storia delle portate
         inflow_query = f'''
         from(bucket: "{INFLUXDB_BUCKET}")
             |> range(start: 0)
             |> filter(fn: (r) => r._measurement == "{BUCKET_FLOWS_DATA}")
             |> filter(fn: (r) => r._field == "total_inflow")
+            {flux_dam_filter([dam.dam_id])}
             |> sum()
         '''
         outflow_query = f'''
@@ -80,6 +210,7 @@ def calculate_initial_volume():
             |> range(start: 0)
             |> filter(fn: (r) => r._measurement == "{BUCKET_FLOWS_DATA}")
             |> filter(fn: (r) => r._field == "total_outflow")
+            {flux_dam_filter([dam.dam_id])}
             |> sum()
         '''
         inflow_result = query_api.query(org=INFLUXDB_ORG, query=inflow_query)
@@ -88,8 +219,10 @@ def calculate_initial_volume():
         total_inflow = sum([record.get_value() for table in inflow_result for record in table.records])
         total_outflow = sum([record.get_value() for table in outflow_result for record in table.records])
 
+        dam.cumulative_inflow = total_inflow
+        dam.cumulative_outflow = total_outflow
         initial_volume = max(0, total_inflow - total_outflow)
-        print(f"INITIAL VOLUME: {initial_volume} m³ (Inflow: {total_inflow} m³, Outflow: {total_outflow} m³)")
+        print(f"INITIAL VOLUME ({dam.dam_id}): {initial_volume} m³ (Inflow: {total_inflow} m³, Outflow: {total_outflow} m³)")
         return initial_volume
     except Exception as e:
         print(f"Error in calculate_initial_volume: {e}")
@@ -98,64 +231,181 @@ def calculate_initial_volume():
 
 
 def calculate_and_update_volume():
-    """Aggiorna il volume attuale basandosi su inflow e outflow recenti."""
-    global current_volume, previous_time, current_time, dummy_volume_used
+    """Aggiorna il volume attuale di ogni diga basandosi su inflow e outflow recenti."""
+    while True:
+        for dam in list(dams.values()):
+            update_volume_from_queries(dam)
+        time.sleep(QUERY_INTERVAL)
+
 
+def update_volume_from_queries(dam):
+    """Integra le portate della diga scritte su InfluxDB dall'ultimo aggiornamento."""
     # Inizializza il timestamp iniziale
-    if previous_time is None:
-        previous_time = int(time.time()) - 1
+    if dam.previous_time is None:
+        dam.previous_time = int(time.time()) - 1
+
+    try:
+        current_time = int(time.time())
+        print(f"Timestamps ({dam.dam_id}): previous_time={dam.previous_time}, current_time={current_time}")
+        inflow = outflow = 0.0
+
+        # Usa DUMMY_VOLUME solo una volta se abilitato
+        if USE_DUMMY_VOLUME and DUMMY_VOLUME > 0 and not dam.dummy_volume_used:
+            print(f"USING DUMMY VOLUME: {DUMMY_VOLUME} m³ (Dummy Volume Enabled)")
+            dam.current_volume = DUMMY_VOLUME
+            dam.dummy_volume_used = True  # Evita di sovrascrivere nuovamente
+        else:
+            inflow = get_total_inflow(dam.previous_time, current_time, dam.dam_id)
+            outflow = get_total_outflow(dam.previous_time, current_time, dam.dam_id)
+
+            inflow = max(0, inflow)
+            outflow = max(0, outflow)
+
+            # Aggiorna il volume corrente
+            dam.current_volume += inflow - outflow
+            dam.cumulative_inflow += inflow
+            dam.cumulative_outflow += outflow
+
+        print(f"ANALYZER: Updated Volume ({dam.dam_id}): {dam.current_volume} m³ (Inflow: {inflow} m³, Outflow: {outflow} m³)")
+        elapsed = max(1, current_time - dam.previous_time)
+
+        # Calcola l'altezza
+        lake_height = calculate_lake_height(dam.current_volume)
+        print(f"ANALYZER: Calculated Lake Height ({dam.dam_id}): {lake_height} m")
 
+        # Scrivi solo il volume attuale su InfluxDB
+        write_volume(dam, dam.current_volume, lake_height)
+        publish_state(dam, dam.current_volume, lake_height, inflow / elapsed, outflow / elapsed)
+        if checkpoint_due(dam):
+            write_volume_checkpoint(dam, dam.current_volume)
+        # Aggiorna il valore di `previous_time`
+        dam.previous_time = current_time
+
+    except Exception as e:
+        print(f"Error in calculate_and_update_volume ({dam.dam_id}): {e}")
+
+
+
+
+
+def write_volume(dam, volume, lake_height, trace=None):
+    """Scrive su InfluxDB il volume e l'altezza correnti del lago (con i tempi della traccia, se presente)."""
+    point = Point(f"{VOLUME_SENSOR_DATA}") \
+        .tag(DAM_TAG, dam.dam_id) \
+        .field(f"{VOLUME_FIELD}", float(volume)) \
+        .field(f"{HEIGHT_FIELD}", float(lake_height))
+    if trace:
+        point.field("trace_origin", trace["origin"])
+        for stage in ("monitor", "analyzer"):
+            if hop_time(trace, stage) is not None:
+                point.field(f"trace_{stage}", hop_time(trace, stage))
+    write_api.write(bucket=INFLUXDB_BUCKET, record=point.time(time.strftime("%Y-%m-%dT%H:%M:%SZ")))
+
+
+def publish_state(dam, volume, lake_height, inflow, outflow, trace=None):
+    """
+    Notifica al PLANNER lo stato appena scritto: volume, altezza e portate (m³/s).
+    Con PLANNER_TRIGGER=event il PLANNER decide alla ricezione, senza leggere InfluxDB.
+    """
+    payload = {
+        "timestamp": time.time(),
+        "volume": float(volume),
+        "height": float(lake_height),
+        "inflow": float(inflow),
+        "outflow": float(outflow),
+    }
+    if trace:
+        payload[TRACE_KEY] = trace
+    mqtt_client.publish(f"{dam.dam_id}/{STATE_TOPIC_PREFIX}", json.dumps(payload), qos=1)
+    count_message("analyzer", "state")
+
+
+def stream_volume_loop():
+    """Checkpoint periodico su InfluxDB del volume di ogni diga integrato in memoria dal flusso MQTT del MONITOR."""
     while True:
-        try:
-            current_time = int(time.time())
-            print(f"Timestamps: previous_time={previous_time}, current_time={current_time}")
-
-            # Usa DUMMY_VOLUME solo una volta se abilitato
-            if USE_DUMMY_VOLUME and DUMMY_VOLUME > 0 and not dummy_volume_used:
-                print(f"USING DUMMY VOLUME: {DUMMY_VOLUME} m³ (Dummy Volume Enabled)")
-                current_volume = DUMMY_VOLUME
-                dummy_volume_used = True  # Evita di sovrascrivere nuovamente
-            else:
-                inflow = get_total_inflow(previous_time, current_time)
-                outflow = get_total_outflow(previous_time, current_time)
-
-                inflow = max(0, inflow)
-                outflow = max(0, outflow)
-
-                # Aggiorna il volume corrente
-                current_volume += inflow - outflow
-
-            print(f"ANALYZER: Updated Volume: {current_volume} m³ (Inflow: {inflow} m³, Outflow: {outflow} m³)")
-
-            # Calcola l'altezza
-            lake_height = calculate_lake_height(current_volume)
-            print(f"ANALYZER: Calculated Lake Height: {lake_height} m")
-
-                                    # Scrivi solo il volume attuale su InfluxDB
-            point = Point(f"{VOLUME_SENSOR_DATA}") \
-                .field(f"{VOLUME_FIELD}", float(current_volume)) \
-                .field(f"{HEIGHT_FIELD}", float(lake_height)) \
-                .time(time.strftime("%Y-%m-%dT%H:%M:%SZ"))
-            write_api.write(bucket=INFLUXDB_BUCKET, record=point)
-            # Aggiorna il valore di `previous_time`
-            previous_time = current_time
+        for dam in list(dams.values()):
+            try:
+                state = dam.volume_integrator.snapshot()
+                dam.current_volume = state["volume"]
+                dam.cumulative_inflow = state["cumulative_inflow"]
+                dam.cumulative_outflow = state["cumulative_outflow"]
+                lake_height = calculate_lake_height(dam.current_volume)
+                print(f"ANALYZER: Streamed Volume ({dam.dam_id}): {dam.current_volume} m³ (Inflow: {state['inflow']} m³/s, "
+                      f"Outflow: {state['outflow']} m³/s, Samples: {state['samples']})")
+                trace = record_hop(dam.flow_trace, "analyzer")
+                write_volume(dam, dam.current_volume, lake_height, trace)
+                publish_state(dam, dam.current_volume, lake_height, state["inflow"], state["outflow"], trace)
+                if checkpoint_due(dam):
+                    write_volume_checkpoint(dam, dam.current_volume)
+            except Exception as e:
+                print(f"Error in stream_volume_loop ({dam.dam_id}): {e}")
 
-        except Exception as e:
-            print(f"Error in calculate_and_update_volume: {e}")
-        
         time.sleep(QUERY_INTERVAL)
 
 
+def on_connect(client, userdata, flags, rc):
+    """Callback per la connessione al broker."""
+    global is_connected
+    if rc == 0:
+        is_connected = True
+        print("ANALYZER: Connected to MQTT Broker!")
+        if VOLUME_SOURCE == "stream":
+            for dam_id in dams:
+                flows_topic = f"{dam_id}/{FLOWS_TOPIC_PREFIX}"
+                client.subscribe(flows_topic, qos=0)
+                print(f"ANALYZER: Subscribed to {flows_topic}")
+    else:
+        print(f"ANALYZER: Failed to connect, return code {rc}")
+
+
+def on_disconnect(client, userdata, rc):
+    """Callback per la disconnessione dal broker."""
+    global is_connected
+    print("ANALYZER: Disconnected from MQTT Broker.")
+    is_connected = False
+
+
+def on_message(client, userdata, msg):
+    """Integra ogni campione di portata globale pubblicato dal MONITOR nello stato della sua diga."""
+    dam = dams.get(dam_from_topic(msg.topic))
+    if dam is None:
+        return
+    try:
+        payload = json.loads(msg.payload)
+        count_message("analyzer", "flows")
+        trace = record_hop(extract_trace(payload), "analyzer_in")
+        if trace:
+            dam.flow_trace = trace
+        dam.volume_integrator.add_sample(
+            float(payload["timestamp"]),
+            float(payload.get("total_inflow", 0)),
+            float(payload.get("total_outflow", 0)),
+        )
+    except (json.JSONDecodeError, KeyError, TypeError, ValueError) as e:
+        print(f"ANALYZER: Invalid flow payload on topic {msg.topic}: {e}")
+
+
+def reconnect_mqtt():
+    """Gestisce i tentativi di riconnessione al broker."""
+    while not is_connected:
+        try:
+            print("ANALYZER: Attempting to connect to MQTT Broker...")
+            mqtt_client.connect(MQTT_BROKER, MQTT_PORT, 60)
+            mqtt_client.loop_start()
+            time.sleep(2)
+        except Exception as e:
+            print(f"ANALYZER: MQTT connection failed: {e}")
+            time.sleep(5)
 
 
-
-def get_total_inflow(start_time, end_time):
-    """Recupera la somma totale dell'inflow da InfluxDB tra start_time e end_time."""
+def get_total_inflow(start_time, end_time, dam_id=DAM_UNIQUE_ID):
+    """Recupera la somma totale dell'inflow della diga da InfluxDB tra start_time e end_time."""
     query = f'''
     from(bucket: "{INFLUXDB_BUCKET}")
         |> range(start: {start_time}, stop: {end_time})
         |> filter(fn: (r) => r._measurement == "{BUCKET_FLOWS_DATA}")
         |> filter(fn: (r) => r._field == "total_inflow")
+        {flux_dam_filter([dam_id])}
         |> sum()
     '''
     try:
@@ -167,13 +417,14 @@ def get_total_inflow(start_time, end_time):
         print(f"Analyzer: Error retrieving total inflow: {e}")
     return 0.0
 
-def get_total_outflow(start_time, end_time):
-    """Recupera la somma totale dell'outflow da InfluxDB tra start_time e end_time."""
+def get_total_outflow(start_time, end_time, dam_id=DAM_UNIQUE_ID):
+    """Recupera la somma totale dell'outflow della diga da InfluxDB tra start_time e end_time."""
     query = f'''
     from(bucket: "{INFLUXDB_BUCKET}")
         |> range(start: {start_time}, stop: {end_time})
         |> filter(fn: (r) => r._measurement == "{BUCKET_FLOWS_DATA}")
         |> filter(fn: (r) => r._field == "total_outflow")
+        {flux_dam_filter([dam_id])}
         |> sum()
     '''
     try:
@@ -217,57 +468,77 @@ def apply_random_fluctuation(height):
 
 def predict_volume(model, day_of_year, hour_of_day):
     """Prevede la portata basata sul giorno dell'anno e l'ora."""
-    sin_day = np.sin(2 * np.pi * day_of_year / 365)
-    cos_day = np.cos(2 * np.pi * day_of_year / 365)
-    sin_hour = np.sin(2 * np.pi * hour_of_day / 24)
-    cos_hour = np.cos(2 * np.pi * hour_of_day / 24)
+    return model.predict(day_of_year, hour_of_day)
 
-    # Prepara i dati di input per il modello
-    X_input = pd.DataFrame([{
-        'sin_day': sin_day,
-        'cos_day': cos_day,
-        'sin_hour': sin_hour,
-        'cos_hour': cos_hour
-    }])
+def reload_changed_models():
+    """Ricarica i modelli il cui file è cambiato dall'ultimo caricamento."""
+    for river_name, path in MODEL_FILES.items():
+        try:
+            fingerprint = model_fingerprint(inflow_model_source(path))
+            if fingerprint != model_fingerprints[river_name]:
+                forecast_models[river_name] = load_inflow_model(path)
+                model_fingerprints[river_name] = fingerprint
+                print(f"Model {path} changed, reloaded (fingerprint {fingerprint}).")
+        except Exception as e:
+            print(f"Error reloading model {path}: {e}")
 
-    return model.predict(X_input)[0]
 
 def update_influx_with_long_term_predictions():
-    """Genera e aggiorna le previsioni di portata oraria per i prossimi 7 giorni e calcola la media giornaliera."""
-    now = datetime.now()
+    """Aggiorna le previsioni orarie dei prossimi 365 giorni scrivendo solo le ore nuove o invalidate."""
+    reload_changed_models()
+    forecast = forecast_cache.refresh(forecast_models, model_fingerprints, datetime.now())
+    if not forecast["time"].size:
+        print("Long-term predictions already up to date.")
+        publish_forecast_version()
+        return
+    timestamps = np.datetime_as_string(forecast["time"], unit="s")
+
     predictions = []
+    for timestamp, total_inflow, boite_inflow, piave_inflow in zip(
+        timestamps, forecast["total_inflow"], forecast["boite_inflow"], forecast["piave_inflow"]
+    ):
+        # Punto orario per InfluxDB
+        point = Point(f"{BUCKET_PREDICTED_DATA}") \
+            .field("total_inflow", float(total_inflow)) \
+            .field("boite_inflow", float(boite_inflow)) \
+            .field("piave_inflow", float(piave_inflow)) \
+            .time(f"{timestamp}Z")
+        predictions.append(point)
 
-    for day_offset in range(0, 365):  # Prevedi per 365 giorni (1 anno)
-        daily_total = 0
-        for hour in range(0, 24):  # Prevedi per ogni ora del giorno
-            future_date = now + timedelta(days=day_offset, hours=hour)
-            day_of_year = future_date.timetuple().tm_yday
-            hour_of_day = future_date.hour
+    # Scrittura finale su InfluxDB
+    write_api.write(bucket=INFLUXDB_BUCKET, record=predictions)
+    write_api.flush()  # Le previsioni devono essere su InfluxDB prima di annunciare la nuova versione
+    forecast_cache.mark_written(forecast)
+    print(f"Long-term predictions successfully updated ({len(predictions)} hours written).")
+    publish_forecast_version()
 
-            # Prevedi per ciascun fiume
-            boite_inflow = predict_volume(model_boite, day_of_year, hour_of_day)
-            piave_inflow = predict_volume(model_piave, day_of_year, hour_of_day)
-            total_inflow = boite_inflow + piave_inflow
 
-            daily_total += total_inflow  # Somma totale giornaliera
+def forecast_version():
+    """Versione della previsione: impronte dei modelli e fine dell'orizzonte scritto."""
+    fingerprints = "-".join(model_fingerprints[river_name] for river_name in sorted(model_fingerprints))
+    return f"{fingerprints}@{forecast_cache.horizon_end}"
 
-            # Scrivi il risultato orario in InfluxDB
-            point = Point(f"{BUCKET_PREDICTED_DATA}") \
-                .field("total_inflow", float(total_inflow)) \
-                .field("boite_inflow", float(boite_inflow)) \
-                .field("piave_inflow", float(piave_inflow)) \
-                .time(future_date.strftime("%Y-%m-%dT%H:%M:%SZ"))
 
-            predictions.append(point)
-            #print(f"Predicted {future_date}: Boite={boite_inflow:.2f}, Piave={piave_inflow:.2f}, Total={total_inflow:.2f}")
+def publish_forecast_index(version):
+    """Pubblica l'indice a somme prefisse dell'orizzonte corrente nella directory condivisa."""
+    horizon = forecast_cache.horizon()
+    start = int(horizon["time"][0].astype(np.int64))
+    index = ForecastIndex.from_hourly(start, horizon["total_inflow"], version)
+    publish_index(index, FORECAST_INDEX_DIR)
+    print(f"Forecast index {version} published in {FORECAST_INDEX_DIR} ({index.hours} hours).")
 
-        # Calcola la media giornaliera
-        daily_average = daily_total / 24
-        #print(f"Daily Average Prediction for {future_date.date()}: Total Inflow={daily_average:.2f}")
 
-    # Scrittura finale su InfluxDB
-    write_api.write(bucket=INFLUXDB_BUCKET, record=predictions)
-    print("Long-term predictions successfully updated.")
+def publish_forecast_version():
+    """Pubblica l'indice (se configurato) e annuncia (messaggio retained) la versione corrente ai PLANNER."""
+    if forecast_cache.horizon_end is None:
+        return
+    version = forecast_version()
+    if FORECAST_INDEX_DIR and read_index_version(FORECAST_INDEX_DIR) != version:
+        publish_forecast_index(version)
+    payload = {"version": version, "horizon_end": str(forecast_cache.horizon_end)}
+    # La previsione è comune: la versione viene annunciata sul topic di ogni diga configurata
+    for dam_id in DAM_UNIQUE_IDS:
+        mqtt_client.publish(f"{dam_id}/{FORECAST_TOPIC_PREFIX}", json.dumps(payload), qos=1, retain=True)
 
 
 
@@ -283,22 +554,66 @@ def prediction_thread():
         time.sleep(3600)  # Ripeti ogni ora
 
 
-if __name__ == "__main__":
+def init_dams(dam_ids):
+    """Crea lo stato di ogni diga e ne ripristina il volume dall'ultimo checkpoint."""
+    for dam_id in dam_ids:
+        dam = DamVolumeState(dam_id)
+        dam.current_volume = calculate_initial_volume(dam)  # Calcola il volume iniziale una sola volta
+        dam.volume_integrator.reset(dam.current_volume, dam.cumulative_inflow, dam.cumulative_outflow)
+        dams[dam_id] = dam
+        print(f"Starting Analyzer for {dam_id} with initial volume: {dam.current_volume} m³")
+
+
+def connect_mqtt():
+    """MQTT: flusso delle portate dal MONITOR e annuncio delle versioni della previsione."""
+    mqtt_client.on_connect = on_connect
+    mqtt_client.on_disconnect = on_disconnect
+    mqtt_client.on_message = on_message
+    reconnect_mqtt()
 
 
+def start_volume_thread():
+    """Avvia il ciclo di aggiornamento del volume in un thread separato."""
+    target = stream_volume_loop if VOLUME_SOURCE == "stream" else calculate_and_update_volume
+    volume_thread = threading.Thread(target=target, daemon=True)
+    volume_thread.start()
+    return volume_thread
+
+
+def run_analyzer_shard(dam_ids):
+    """Worker di uno shard: integra i volumi delle dighe indicate con una sola connessione MQTT."""
     try:
-        print("Initializing Analyzer...")
-        current_volume = calculate_initial_volume()  # Calcola il volume iniziale una sola volta
-        print(f"Starting Analyzer with initial volume: {current_volume} m³")
+        start_metrics_server(shard_metrics_port(METRICS_PORT))
+        init_dams(dam_ids)
+        connect_mqtt()
+        start_volume_thread()
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        print("Analyzer shard stopped.")
 
-        # Avvia il ciclo di aggiornamento del volume in un thread separato
-        volume_thread = threading.Thread(target=calculate_and_update_volume, daemon=True)
-        volume_thread.start()
 
-        
+if __name__ == "__main__":
+
+
+    try:
+        print("Initializing Analyzer...")
+        start_metrics_server()
+        # Con un solo shard il processo principale integra anche i volumi
+        single_shard = len(shard_plan(DAM_UNIQUE_IDS, DAM_SHARDS)) == 1
+        if single_shard:
+            init_dams(DAM_UNIQUE_IDS)
+        connect_mqtt()
+        if single_shard:
+            start_volume_thread()
+
+        # Previsioni (comuni a tutte le dighe) solo nel processo principale
         prediction_thread_handle = threading.Thread(target=prediction_thread, daemon=True)
         prediction_thread_handle.start()
 
+        if not single_shard:
+            raise SystemExit(run_sharded(run_analyzer_shard, DAM_UNIQUE_IDS, DAM_SHARDS))
+
         # Mantieni il programma in esecuzione
         while True:
             time.sleep(1)  # Mantieni il main thread attivo
@@ -0,0 +1,84 @@
+import os
+import sys
+import argparse
+import time
+from datetime import datetime, timedelta
+
+import joblib  # type: ignore
+import numpy as np  # type: ignore
+import pandas as pd  # type: ignore
+
+# inflow_table è condiviso con i servizi nella directory COMMON
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "COMMON"))
+from forecast import forecast_inflows
+from inflow_table import SklearnInflowModel, inflow_model_source, load_inflow_model
+
+
+def predict_volume_per_row(model, day_of_year, hour_of_day):
+    """Percorso storico: un DataFrame di una riga e una predict per ogni ora."""
+    sin_day = np.sin(2 * np.pi * day_of_year / 365)
+    cos_day = np.cos(2 * np.pi * day_of_year / 365)
+    sin_hour = np.sin(2 * np.pi * hour_of_day / 24)
+    cos_hour = np.cos(2 * np.pi * hour_of_day / 24)
+
+    X_input = pd.DataFrame([{
+        'sin_day': sin_day,
+        'cos_day': cos_day,
+        'sin_hour': sin_hour,
+        'cos_hour': cos_hour
+    }])
+    return model.predict(X_input)[0]
+
+
+def forecast_per_hour(models, start, hours):
+    """Replica il ciclo ora per ora di update_influx_with_long_term_predictions."""
+    forecast = {f"{river_name}_inflow": np.empty(hours) for river_name in models}
+    for offset in range(hours):
+        future_date = start + timedelta(hours=offset)
+        day_of_year = future_date.timetuple().tm_yday
+        for river_name, model in models.items():
+            forecast[f"{river_name}_inflow"][offset] = predict_volume_per_row(model, day_of_year, future_date.hour)
+    forecast["total_inflow"] = sum(forecast[f"{river_name}_inflow"] for river_name in models)
+    return forecast
+
+
+def timed(function, *args, repeat=1):
+    """Restituisce il risultato e il tempo migliore su 'repeat' esecuzioni."""
+    best = float("inf")
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function(*args)
+        best = min(best, time.perf_counter() - start)
+    return result, best
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Confronto tra previsione ora per ora e previsione batch.")
+    parser.add_argument("--boite", default="boite_random_forest.pkl", help="Modello del Boite")
+    parser.add_argument("--piave", default="piave_random_forest.pkl", help="Modello del Piave")
+    parser.add_argument("--hours", type=int, default=365 * 24, help="Ore di orizzonte (default 8760)")
+    parser.add_argument("--repeat", type=int, default=3, help="Ripetizioni della versione batch")
+    args = parser.parse_args()
+
+    model_files = {"boite": args.boite, "piave": args.piave}
+    models = {river_name: joblib.load(path) for river_name, path in model_files.items()}
+    batch_models = {river_name: SklearnInflowModel(model) for river_name, model in models.items()}
+    start = datetime.now().replace(minute=0, second=0, microsecond=0)
+
+    loop_forecast, loop_time = timed(forecast_per_hour, models, start, args.hours)
+    batch_forecast, batch_time = timed(forecast_inflows, batch_models, start, args.hours, repeat=args.repeat)
+
+    max_error = float(np.max(np.abs(loop_forecast["total_inflow"] - batch_forecast["total_inflow"])))
+    print(f"Horizon: {args.hours} hours, {len(models)} models")
+    print(f"Per-hour loop: {loop_time:.3f} s")
+    print(f"Batched:       {batch_time:.3f} s")
+    print(f"Speedup:       {loop_time / batch_time:.1f}x")
+    print(f"Max abs difference on total_inflow: {max_error:.3e}")
+
+    # Tabelle precalcolate (se esportate dal training accanto ai .pkl)
+    if all(inflow_model_source(path) != path for path in model_files.values()):
+        table_models = {river_name: load_inflow_model(path) for river_name, path in model_files.items()}
+        table_forecast, table_time = timed(forecast_inflows, table_models, start, args.hours, repeat=args.repeat)
+        table_error = float(np.max(np.abs(loop_forecast["total_inflow"] - table_forecast["total_inflow"])))
+        print(f"Lookup table:  {table_time:.3f} s (max abs difference {table_error:.3e})")
@@ -0,0 +1,159 @@
+import os
+import hashlib
+import numpy as np  # type: ignore
+
+from inflow_table import DAYS_PER_LEAP_YEAR, HOURS_PER_DAY, build_lookup_table
+
+HOURS_PER_YEAR = 365 * 24
+
+
+def hourly_horizon(start, hours=HOURS_PER_YEAR):
+    """Restituisce i timestamp orari (datetime64[s]) a partire da start."""
+    origin = np.datetime64(start, "s")
+    return origin + np.arange(hours).astype("timedelta64[h]")
+
+
+def calendar_features(times):
+    """Calcola giorno dell'anno (1-366) e ora del giorno (0-23) per un array di datetime64."""
+    days = times.astype("datetime64[D]")
+    day_of_year = (days - days.astype("datetime64[Y]")).astype(np.int64) + 1
+    hour_of_day = (times.astype("datetime64[h]") - days).astype(np.int64)
+    return day_of_year, hour_of_day
+
+
+def forecast_inflows(models, start, hours=HOURS_PER_YEAR):
+    """
+    Previsione oraria batch dell'inflow per uno o più modelli.
+    :param models: Dizionario nome fiume -> modello di inflow (vedi inflow_table.load_inflow_model).
+    :param start: Istante iniziale dell'orizzonte (datetime).
+    :param hours: Numero di ore da prevedere (default 365 giorni).
+    :return: Dizionario colonnare con 'time', '<fiume>_inflow' per ogni modello e 'total_inflow'.
+    """
+    times = hourly_horizon(start, hours)
+    day_of_year, hour_of_day = calendar_features(times)
+
+    forecast = {"time": times}
+    total_inflow = np.zeros(hours, dtype=np.float64)
+    for river_name, model in models.items():
+        river_inflow = model.predict_many(day_of_year, hour_of_day)
+        forecast[f"{river_name}_inflow"] = river_inflow
+        total_inflow += river_inflow
+    forecast["total_inflow"] = total_inflow
+    return forecast
+
+
+def model_fingerprint(path):
+    """Impronta (SHA-256 troncato) del file del modello, usata per invalidare la cache."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as model_file:
+        for chunk in iter(lambda: model_file.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()[:16]
+
+
+class ForecastCache:
+    """
+    Cache persistente delle previsioni orarie.
+    Le feature dipendono solo da (giorno dell'anno, ora), quindi per ogni fiume si conserva una
+    tabella indicizzata per [giorno_dell_anno - 1, ora] insieme all'impronta del modello che l'ha prodotta,
+    più la fine dell'orizzonte già scritto su InfluxDB.
+    """
+
+    def __init__(self, path, hours=HOURS_PER_YEAR):
+        self.path = path
+        self.hours = hours
+        self.tables = {}         # fiume -> tabella (366, 24)
+        self.fingerprints = {}   # fiume -> impronta del modello
+        self.horizon_end = None  # prima ora (datetime64[h]) non ancora scritta
+        self.load()
+
+    def load(self):
+        """Carica lo stato della cache dal disco, se presente."""
+        if not self.path or not os.path.exists(self.path):
+            return
+        try:
+            with np.load(self.path) as data:
+                for key in data.files:
+                    if key.startswith("table_") and data[key].shape == (DAYS_PER_LEAP_YEAR, HOURS_PER_DAY):
+                        river_name = key[len("table_"):]
+                        self.tables[river_name] = data[key]
+                        self.fingerprints[river_name] = str(data[f"fingerprint_{river_name}"])
+                if "horizon_end" in data.files:
+                    self.horizon_end = np.datetime64(int(data["horizon_end"]), "h")
+            print(f"Forecast cache loaded from {self.path} (horizon end: {self.horizon_end})")
+        except Exception as e:
+            print(f"Error loading forecast cache {self.path}: {e}")
+            self.tables, self.fingerprints, self.horizon_end = {}, {}, None
+
+    def save(self):
+        """Salva lo stato della cache su disco in modo atomico."""
+        if not self.path:
+            return
+        arrays = {}
+        for river_name, table in self.tables.items():
+            arrays[f"table_{river_name}"] = table
+            arrays[f"fingerprint_{river_name}"] = np.array(self.fingerprints[river_name])
+        if self.horizon_end is not None:
+            arrays["horizon_end"] = np.array(self.horizon_end.astype(np.int64))
+
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        temp_path = f"{self.path}.tmp"
+        with open(temp_path, "wb") as cache_file:
+            np.savez(cache_file, **arrays)
+        os.replace(temp_path, self.path)
+
+    def refresh(self, models, fingerprints, start):
+        """
+        Restituisce solo le ore da scrivere: quelle entrate nell'orizzonte dall'ultimo aggiornamento,
+        oppure l'intero orizzonte se un modello è cambiato.
+        :param models: Dizionario nome fiume -> modello.
+        :param fingerprints: Dizionario nome fiume -> impronta del modello.
+        :param start: Istante corrente (datetime); l'orizzonte è allineato all'ora.
+        :return: Dizionario colonnare come forecast_inflows (eventualmente con zero righe).
+        """
+        start_hour = np.datetime64(start, "h")
+        end_hour = start_hour + np.timedelta64(self.hours, "h")
+
+        changed = [
+            river_name for river_name in models
+            if river_name not in self.tables or self.fingerprints.get(river_name) != fingerprints[river_name]
+        ]
+        for river_name in changed:
+            print(f"Forecast cache: recomputing table for {river_name} (model {fingerprints[river_name]})")
+            self.tables[river_name] = build_lookup_table(models[river_name], dtype=np.float64)
+            self.fingerprints[river_name] = fingerprints[river_name]
+
+        if changed or self.horizon_end is None or self.horizon_end < start_hour:
+            write_from = start_hour  # Orizzonte invalidato: si riscrive tutto
+        else:
+            write_from = self.horizon_end
+
+        return self.lookup(np.arange(write_from, max(write_from, end_hour)))
+
+    def lookup(self, hours):
+        """Previsione colonnare (come forecast_inflows) per un array di ore, letta dalle tabelle in cache."""
+        times = np.asarray(hours).astype("datetime64[s]")
+        day_of_year, hour_of_day = calendar_features(times)
+
+        forecast = {"time": times}
+        total_inflow = np.zeros(times.size, dtype=np.float64)
+        for river_name, table in self.tables.items():
+            river_inflow = table[day_of_year - 1, hour_of_day]
+            forecast[f"{river_name}_inflow"] = river_inflow
+            total_inflow += river_inflow
+        forecast["total_inflow"] = total_inflow
+        return forecast
+
+    def horizon(self):
+        """Intero orizzonte già scritto su InfluxDB (None se la cache è vuota)."""
+        if self.horizon_end is None:
+            return None
+        return self.lookup(np.arange(self.horizon_end - np.timedelta64(self.hours, "h"), self.horizon_end))
+
+    def mark_written(self, forecast):
+        """Registra come scritte le ore restituite da refresh e salva la cache."""
+        if forecast["time"].size:
+            self.horizon_end = forecast["time"][-1].astype("datetime64[h]") + np.timedelta64(1, "h")
+        self.save()
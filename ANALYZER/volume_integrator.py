@@ -0,0 +1,66 @@
+import threading
+
+
+class VolumeIntegrator:
+    """
+    Integra in memoria il bilancio inflow - outflow ricevuto dal MONITOR.
+    Ogni coppia di campioni consecutivi contribuisce con l'area del trapezio
+    (media delle portate per l'intervallo di tempo effettivo tra i due campioni).
+    """
+
+    def __init__(self, volume=0.0, max_gap=10.0):
+        self._lock = threading.Lock()
+        self.max_gap = max_gap          # Oltre questo intervallo (s) il buco non viene integrato
+        self.volume = float(volume)
+        self.cumulative_inflow = 0.0
+        self.cumulative_outflow = 0.0
+        self.last_timestamp = None
+        self.last_inflow = 0.0
+        self.last_outflow = 0.0
+        self.samples = 0
+
+    def reset(self, volume, cumulative_inflow=None, cumulative_outflow=None):
+        """Reimposta il volume (ed eventualmente i totali cumulati) mantenendo l'ultimo campione ricevuto."""
+        with self._lock:
+            self.volume = float(volume)
+            if cumulative_inflow is not None:
+                self.cumulative_inflow = float(cumulative_inflow)
+            if cumulative_outflow is not None:
+                self.cumulative_outflow = float(cumulative_outflow)
+
+    def add_sample(self, timestamp, inflow, outflow):
+        """
+        Aggiunge un campione di portata (m³/s) con il suo timestamp Unix.
+        :return: True se il campione è stato accettato, False se fuori ordine o duplicato.
+        """
+        inflow = max(0.0, float(inflow))
+        outflow = max(0.0, float(outflow))
+        with self._lock:
+            if self.last_timestamp is not None:
+                elapsed = timestamp - self.last_timestamp
+                if elapsed <= 0:
+                    return False
+                if elapsed <= self.max_gap:
+                    inflow_volume = 0.5 * (self.last_inflow + inflow) * elapsed
+                    outflow_volume = 0.5 * (self.last_outflow + outflow) * elapsed
+                    self.cumulative_inflow += inflow_volume
+                    self.cumulative_outflow += outflow_volume
+                    self.volume += inflow_volume - outflow_volume
+            self.last_timestamp = timestamp
+            self.last_inflow = inflow
+            self.last_outflow = outflow
+            self.samples += 1
+            return True
+
+    def snapshot(self):
+        """Restituisce uno stato coerente dell'integratore."""
+        with self._lock:
+            return {
+                "volume": self.volume,
+                "cumulative_inflow": self.cumulative_inflow,
+                "cumulative_outflow": self.cumulative_outflow,
+                "timestamp": self.last_timestamp,
+                "inflow": self.last_inflow,
+                "outflow": self.last_outflow,
+                "samples": self.samples,
+            }
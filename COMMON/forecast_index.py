@@ -0,0 +1,121 @@
+import os
+import json
+import math
+import hashlib
+import numpy as np  # type: ignore
+
+INDEX_POINTER = "forecast_index.json"
+INDEX_PREFIX = "forecast_index_"
+
+
+class ForecastIndex:
+    """
+    Indice a somme prefisse sulla previsione oraria di inflow.
+    cumulative[i] è la somma delle prime i ore a partire da start, quindi totale
+    e media su qualsiasi finestra [t, t + h) costano una sottrazione.
+    """
+
+    def __init__(self, start, cumulative, version=None, step=3600):
+        self.start = float(start)      # Timestamp Unix della prima ora
+        self.step = step               # Passo della previsione (s)
+        self.cumulative = cumulative   # Array float64 di lunghezza ore + 1, cumulative[0] = 0
+        self.version = version
+
+    @classmethod
+    def from_hourly(cls, start, values, version=None, step=3600):
+        """Costruisce l'indice da una serie oraria contigua che parte da start."""
+        values = np.asarray(values, dtype=np.float64)
+        cumulative = np.empty(values.size + 1, dtype=np.float64)
+        cumulative[0] = 0.0
+        np.cumsum(values, out=cumulative[1:])
+        return cls(start, cumulative, version, step)
+
+    @property
+    def hours(self):
+        """Numero di ore coperte dall'indice."""
+        return len(self.cumulative) - 1
+
+    @property
+    def end(self):
+        """Timestamp Unix della fine (esclusa) dell'orizzonte coperto."""
+        return self.start + self.hours * self.step
+
+    def _position(self, timestamp):
+        """Prima ora con timestamp >= timestamp, limitata all'intervallo dell'indice."""
+        position = math.ceil((timestamp - self.start) / self.step)  # math: chiamato per ogni orizzonte a ogni ciclo
+        return min(max(position, 0), len(self.cumulative) - 1)
+
+    def window(self, timestamp, hours):
+        """Posizioni [first, last) delle ore previste nella finestra [timestamp, timestamp + hours)."""
+        return self._position(timestamp), self._position(timestamp + hours * 3600)
+
+    def total(self, timestamp, hours):
+        """Somma e numero di previsioni orarie nella finestra [timestamp, timestamp + hours)."""
+        first, last = self.window(timestamp, hours)
+        return float(self.cumulative[last] - self.cumulative[first]), last - first
+
+    def mean(self, timestamp, hours):
+        """Media delle previsioni nella finestra; 0 se la finestra è vuota."""
+        total, count = self.total(timestamp, hours)
+        return total / count if count else 0
+
+    def hourly(self, timestamp, hours):
+        """Previsioni orarie della finestra come array (ricavate dalle differenze delle somme prefisse)."""
+        first, last = self.window(timestamp, hours)
+        return np.diff(self.cumulative[first:last + 1])
+
+
+def publish_index(index, directory, keep=2):
+    """
+    Pubblica l'indice in directory come artefatto versionato.
+    Il file .npy della versione viene scritto per primo, poi il puntatore JSON
+    viene sostituito in modo atomico: chi legge vede sempre una coppia coerente.
+    """
+    os.makedirs(directory, exist_ok=True)
+    digest = hashlib.sha1(str(index.version).encode()).hexdigest()[:12]
+    filename = f"{INDEX_PREFIX}{digest}.npy"
+
+    temp_path = os.path.join(directory, f".{filename}.tmp")
+    with open(temp_path, "wb") as index_file:
+        np.save(index_file, np.ascontiguousarray(index.cumulative, dtype=np.float64))
+    os.replace(temp_path, os.path.join(directory, filename))
+
+    pointer = {
+        "version": index.version,
+        "file": filename,
+        "start": index.start,
+        "step": index.step,
+        "hours": index.hours,
+    }
+    temp_pointer = os.path.join(directory, f".{INDEX_POINTER}.tmp")
+    with open(temp_pointer, "w") as pointer_file:
+        json.dump(pointer, pointer_file)
+    os.replace(temp_pointer, os.path.join(directory, INDEX_POINTER))
+
+    # Mantiene solo le ultime 'keep' versioni (chi ha ancora mappato un file vecchio continua a leggerlo)
+    published = sorted(
+        (entry for entry in os.scandir(directory) if entry.name.startswith(INDEX_PREFIX) and entry.name.endswith(".npy")),
+        key=lambda entry: entry.stat().st_mtime,
+    )
+    for entry in published[:-keep]:
+        if entry.name != filename:
+            os.remove(entry.path)
+
+
+def read_index_version(directory):
+    """Versione dell'indice attualmente pubblicato (None se assente)."""
+    try:
+        with open(os.path.join(directory, INDEX_POINTER)) as pointer_file:
+            return json.load(pointer_file).get("version")
+    except (OSError, ValueError):
+        return None
+
+
+def load_published_index(directory):
+    """Carica l'indice pubblicato mappandolo in memoria (nessuna copia)."""
+    with open(os.path.join(directory, INDEX_POINTER)) as pointer_file:
+        pointer = json.load(pointer_file)
+    cumulative = np.load(os.path.join(directory, pointer["file"]), mmap_mode="r")
+    if len(cumulative) != pointer["hours"] + 1:
+        raise ValueError(f"Forecast index {pointer['file']} does not match its pointer ({pointer['hours']} hours)")
+    return ForecastIndex(pointer["start"], cumulative, pointer["version"], pointer["step"])
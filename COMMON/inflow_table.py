@@ -0,0 +1,178 @@
+import os
+import math
+import threading
+import numpy as np  # type: ignore
+
+# Feature usate in fase di training (stesso ordine di Training_RF_w_Grid_search.py)
+FEATURES = ["sin_day", "cos_day", "sin_hour", "cos_hour"]
+DAYS_PER_LEAP_YEAR = 366
+HOURS_PER_DAY = 24
+TABLE_SUFFIX = "_lut.npy"
+
+
+def lookup_table_path(model_file):
+    """Percorso della tabella precalcolata associata a un file .pkl."""
+    return os.path.splitext(model_file)[0] + TABLE_SUFFIX
+
+
+def inflow_model_source(model_file):
+    """File effettivamente usato a runtime: la tabella se esiste, altrimenti il .pkl."""
+    table_path = lookup_table_path(model_file)
+    return table_path if os.path.exists(table_path) else model_file
+
+
+def cyclical_features(day_of_year, hour_of_day, out=None):
+    """
+    Costruisce la matrice (n, 4) delle feature sin/cos in un'unica passata vettoriale.
+    Se out è un buffer (almeno n righe) le feature vengono scritte nelle sue prime n righe.
+    """
+    day_angle = 2 * np.pi * np.asarray(day_of_year, dtype=np.float64).ravel() / 365
+    hour_angle = 2 * np.pi * np.asarray(hour_of_day, dtype=np.float64).ravel() / 24
+
+    if out is None:
+        X = np.empty((day_angle.size, len(FEATURES)), dtype=np.float64)
+    else:
+        X = out[:day_angle.size]
+    np.sin(day_angle, out=X[:, 0])
+    np.cos(day_angle, out=X[:, 1])
+    np.sin(hour_angle, out=X[:, 2])
+    np.cos(hour_angle, out=X[:, 3])
+    return X
+
+
+class FeatureEncoder:
+    """
+    Codifica (giorno dell'anno, ora) nelle feature cicliche dentro buffer NumPy preallocati:
+    una riga per la predizione singola e un blocco che copre un anno intero per quelle in batch.
+    I buffer sono riusati tra le chiamate, quindi il risultato è valido fino alla codifica successiva.
+    """
+
+    def __init__(self, capacity=DAYS_PER_LEAP_YEAR * HOURS_PER_DAY):
+        self.row = np.empty((1, len(FEATURES)), dtype=np.float64)
+        self.batch = np.empty((capacity, len(FEATURES)), dtype=np.float64)
+
+    def encode_one(self, day_of_year, hour_of_day):
+        """Matrice (1, 4) per un singolo (giorno dell'anno, ora), calcolata con math senza array temporanei."""
+        day_angle = 2 * math.pi * day_of_year / 365
+        hour_angle = 2 * math.pi * hour_of_day / 24
+        row = self.row[0]
+        row[0] = math.sin(day_angle)
+        row[1] = math.cos(day_angle)
+        row[2] = math.sin(hour_angle)
+        row[3] = math.cos(hour_angle)
+        return self.row
+
+    def encode_many(self, day_of_year, hour_of_day):
+        """Matrice (n, 4) per array di (giorno dell'anno, ora); il buffer cresce solo se n supera la capacità."""
+        size = np.size(day_of_year)
+        if size > len(self.batch):
+            self.batch = np.empty((size, len(FEATURES)), dtype=np.float64)
+        return cyclical_features(day_of_year, hour_of_day, out=self.batch)
+
+
+def validate_feature_names(model):
+    """Verifica che il modello sia stato addestrato sulle FEATURES, nello stesso ordine."""
+    names = getattr(model, "feature_names_in_", None)
+    if names is not None and list(names) != FEATURES:
+        raise ValueError(f"Modello addestrato con le feature {list(names)}, attese {FEATURES}")
+    n_features = getattr(model, "n_features_in_", len(FEATURES))
+    if n_features != len(FEATURES):
+        raise ValueError(f"Modello addestrato con {n_features} feature, attese {len(FEATURES)}")
+
+
+def _strip_feature_names(estimator):
+    """
+    Rimuove i nomi delle feature (già validati) dal modello e dai passi di una pipeline:
+    così scikit-learn accetta gli ndarray senza ricontrollare i nomi né avvisare a ogni predict.
+    """
+    for _, step in getattr(estimator, "steps", []):
+        _strip_feature_names(step)
+    if "feature_names_in_" in getattr(estimator, "__dict__", {}):
+        del estimator.feature_names_in_
+
+
+def calendar_grid():
+    """Tutte le coppie (giorno dell'anno, ora) nell'ordine delle righe della tabella."""
+    day_grid, hour_grid = np.meshgrid(
+        np.arange(1, DAYS_PER_LEAP_YEAR + 1), np.arange(HOURS_PER_DAY), indexing="ij"
+    )
+    return day_grid.ravel(), hour_grid.ravel()
+
+
+class SklearnInflowModel:
+    """
+    Modello scikit-learn (caricato con joblib) esposto con l'interfaccia (giorno, ora).
+    I nomi delle feature sono validati una sola volta alla creazione, poi il modello riceve
+    direttamente gli ndarray del FeatureEncoder (niente DataFrame per chiamata).
+    Nota: il modello passato viene modificato in place (senza feature_names_in_).
+    """
+
+    def __init__(self, model):
+        validate_feature_names(model)
+        _strip_feature_names(model)
+        self.model = model
+        self.encoder = FeatureEncoder()
+        # I buffer dell'encoder sono condivisi: una codifica + predict alla volta
+        self.lock = threading.Lock()
+
+    def predict(self, day_of_year, hour_of_day):
+        """Portata prevista per un singolo (giorno dell'anno, ora)."""
+        with self.lock:
+            return float(self.model.predict(self.encoder.encode_one(day_of_year, hour_of_day))[0])
+
+    def predict_many(self, day_of_year, hour_of_day):
+        """Portata prevista per array di (giorno dell'anno, ora) con una sola predict."""
+        with self.lock:
+            return np.asarray(self.model.predict(self.encoder.encode_many(day_of_year, hour_of_day)), dtype=np.float64)
+
+
+class InflowLookupTable:
+    """Modello precalcolato: tabella float32 (366, 24) mappata in memoria, indicizzata per [giorno - 1, ora]."""
+
+    def __init__(self, path):
+        self.path = path
+        self.table = np.load(path, mmap_mode="r")
+        if self.table.shape != (DAYS_PER_LEAP_YEAR, HOURS_PER_DAY) or self.table.dtype != np.float32:
+            raise ValueError(
+                f"Tabella {path} non valida: attesa float32 {(DAYS_PER_LEAP_YEAR, HOURS_PER_DAY)}, "
+                f"trovata {self.table.dtype} {self.table.shape}"
+            )
+
+    def predict(self, day_of_year, hour_of_day):
+        """Portata prevista per un singolo (giorno dell'anno, ora)."""
+        return float(self.table[day_of_year - 1, hour_of_day])
+
+    def predict_many(self, day_of_year, hour_of_day):
+        """Portata prevista per array di (giorno dell'anno, ora)."""
+        day_index = np.asarray(day_of_year, dtype=np.int64) - 1
+        return self.table[day_index, np.asarray(hour_of_day, dtype=np.int64)].astype(np.float64)
+
+
+def build_lookup_table(model, dtype=np.float32):
+    """Valuta il modello su tutte le 366 x 24 = 8.784 combinazioni (giorno dell'anno, ora)."""
+    day_of_year, hour_of_day = calendar_grid()
+    values = model.predict_many(day_of_year, hour_of_day)
+    return np.asarray(values, dtype=dtype).reshape(DAYS_PER_LEAP_YEAR, HOURS_PER_DAY)
+
+
+def save_lookup_table(table, path):
+    """Salva la tabella in formato .npy (mappabile in memoria) con scrittura atomica."""
+    temp_path = f"{path}.tmp"
+    with open(temp_path, "wb") as table_file:
+        np.save(table_file, np.ascontiguousarray(table, dtype=np.float32))
+    os.replace(temp_path, path)
+
+
+def load_inflow_model(model_file):
+    """
+    Carica il modello di inflow per il percorso runtime.
+    Usa la tabella precalcolata accanto al .pkl se presente (niente joblib, sklearn e pandas),
+    altrimenti ricade sul modello scikit-learn.
+    """
+    source = inflow_model_source(model_file)
+    if source != model_file:
+        return InflowLookupTable(source)
+
+    import joblib  # type: ignore
+
+    return SklearnInflowModel(joblib.load(model_file))
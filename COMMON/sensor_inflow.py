@@ -0,0 +1,32 @@
+import numpy as np  # type: ignore
+
+# Curva della pompa solare: produzione 0 fino alle 06:00, crescita fino a 20 alle 12:00, decrescita fino a 0 alle 18:00
+SOLAR_CURVE_MINUTES = (360, 720, 1080)
+SOLAR_CURVE_INFLOW = (0, 20, 0)
+
+_rng = np.random.default_rng()
+
+
+def calculate_inflow(hour, minute):
+    """
+    Portata della pompa solare per ora e minuto del giorno.
+    Accetta scalari (sensore reale) o array NumPy (generatore di carico, simulatore).
+    """
+    total_minutes = np.asarray(hour) * 60 + np.asarray(minute)  # Convertiamo ore e minuti in minuti totali
+    if np.any((total_minutes < 0) | (total_minutes > 1440)):
+        raise ValueError("Hour must be between 0 and 24, minute between 0 and 59")
+    inflow = np.interp(total_minutes, SOLAR_CURVE_MINUTES, SOLAR_CURVE_INFLOW)
+    return float(inflow) if inflow.ndim == 0 else inflow
+
+
+def apply_random_variability(value, min_percentage=5, max_percentage=10, rng=None):
+    """
+    Applica una variabilità casuale compresa tra il min_percentage e il max_percentage al valore,
+    aggiunta o sottratta con la stessa probabilità. Con un array la variazione è indipendente per ogni elemento.
+    """
+    rng = rng or _rng
+    values = np.asarray(value, dtype=np.float64)
+    percentage_variation = rng.uniform(min_percentage, max_percentage, size=values.shape) / 100
+    signs = rng.choice((-1.0, 1.0), size=values.shape)
+    result = values * (1 + signs * percentage_variation)
+    return float(result) if result.ndim == 0 else result
@@ -0,0 +1,207 @@
+import os
+import time
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+TRACE_KEY = "trace"
+METRICS_PORT = int(os.getenv("METRICS_PORT", 9100))  # Porta dell'endpoint /metrics (0 = disabilitato)
+
+# Limiti (s) degli istogrammi di latenza, dal singolo messaggio MQTT al ciclo di controllo completo
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120)
+
+
+def _labels_text(labels):
+    """Etichette nel formato di esposizione di Prometheus ({a="1",b="2"})."""
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{value}"' for name, value in labels) + "}"
+
+
+class Counter:
+    """Contatore monotono per insieme di etichette (es. messaggi ricevuti per stadio)."""
+
+    kind = "counter"
+
+    def __init__(self, name, description):
+        self.name = name
+        self.description = description
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def inc(self, amount=1.0, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def samples(self):
+        with self._lock:
+            return [(self.name, key, value) for key, value in self._values.items()]
+
+
+class Gauge(Counter):
+    """Valore istantaneo per insieme di etichette (es. profondità di una coda)."""
+
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = float(value)
+
+
+class Histogram:
+    """Istogramma cumulativo alla Prometheus (bucket, somma e conteggio) per insieme di etichette."""
+
+    kind = "histogram"
+
+    def __init__(self, name, description, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.description = description
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        self._values = {}  # etichette -> [conteggi per bucket, somma, conteggio]
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            counts, total, count = self._values.get(key, ([0] * len(self.buckets), 0.0, 0))
+            for position, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[position] += 1
+            self._values[key] = (counts, total + value, count + 1)
+
+    def samples(self):
+        samples = []
+        with self._lock:
+            for key, (counts, total, count) in self._values.items():
+                for bound, bucket_count in zip(self.buckets, counts):
+                    samples.append((f"{self.name}_bucket", key + (("le", bound),), bucket_count))
+                samples.append((f"{self.name}_bucket", key + (("le", "+Inf"),), count))
+                samples.append((f"{self.name}_sum", key, total))
+                samples.append((f"{self.name}_count", key, count))
+        return samples
+
+
+class MetricsRegistry:
+    """Raccolta delle metriche del servizio, esposta in formato testo Prometheus."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics = {}
+
+    def _get(self, metric_class, name, description, **kwargs):
+        with self._lock:
+            if name not in self._metrics:
+                self._metrics[name] = metric_class(name, description, **kwargs)
+            return self._metrics[name]
+
+    def counter(self, name, description):
+        return self._get(Counter, name, description)
+
+    def gauge(self, name, description):
+        return self._get(Gauge, name, description)
+
+    def histogram(self, name, description, buckets=LATENCY_BUCKETS):
+        return self._get(Histogram, name, description, buckets=buckets)
+
+    def render(self):
+        lines = []
+        with self._lock:
+            metrics = list(self._metrics.values())
+        for metric in metrics:
+            lines.append(f"# HELP {metric.name} {metric.description}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for name, labels, value in metric.samples():
+                lines.append(f"{name}{_labels_text(labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+
+registry = MetricsRegistry()
+HOP_LATENCY = registry.histogram(
+    "mapek_hop_latency_seconds", "Latenza tra lo stadio precedente della traccia e lo stadio corrente")
+TRACE_AGE = registry.histogram(
+    "mapek_trace_age_seconds", "Tempo trascorso dalla pubblicazione del sensore all'arrivo nello stadio")
+MESSAGES = registry.counter(
+    "mapek_messages_total", "Messaggi elaborati per stadio e tipo (la frequenza si ottiene con rate())")
+
+
+def new_trace(stage, now=None):
+    """Crea il contesto di traccia all'origine (timestamp di pubblicazione del sensore)."""
+    now = time.time() if now is None else now
+    return {"origin": now, "hops": [[stage, now]]}
+
+
+def extract_trace(payload):
+    """Restituisce la traccia contenuta in un payload, None se assente o malformata."""
+    trace = payload.get(TRACE_KEY) if isinstance(payload, dict) else None
+    if not isinstance(trace, dict) or not isinstance(trace.get("origin"), (int, float)):
+        return None
+    if not isinstance(trace.get("hops"), list):
+        trace = dict(trace, hops=[])
+    return trace
+
+
+def record_hop(trace, stage, now=None):
+    """
+    Aggiunge lo stadio alla traccia e registra la latenza dall'hop precedente e dall'origine.
+    :return: Nuova traccia (quella ricevuta non viene modificata), None se trace è None.
+    """
+    if trace is None:
+        return None
+    now = time.time() if now is None else now
+    hops = list(trace.get("hops", []))
+    if hops:
+        previous_stage, previous_time = hops[-1]
+        HOP_LATENCY.observe(max(0.0, now - previous_time), stage=stage, previous=previous_stage)
+    TRACE_AGE.observe(max(0.0, now - trace["origin"]), stage=stage)
+    hops.append([stage, now])
+    return {"origin": trace["origin"], "hops": hops}
+
+
+def hop_time(trace, stage):
+    """Timestamp dell'ultimo passaggio della traccia per lo stadio indicato (None se assente)."""
+    for hop_stage, timestamp in reversed((trace or {}).get("hops", [])):
+        if hop_stage == stage:
+            return timestamp
+    return None
+
+
+def latest_trace(traces):
+    """Traccia con l'origine più recente (es. tra quelle dei sensori aggregati dal MONITOR)."""
+    traces = [trace for trace in traces if trace is not None]
+    return max(traces, key=lambda trace: trace["origin"]) if traces else None
+
+
+def count_message(stage, kind):
+    """Conta un messaggio elaborato dallo stadio."""
+    MESSAGES.inc(stage=stage, kind=kind)
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = registry.render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # Nessun log per ogni scrape
+
+
+def start_metrics_server(port=METRICS_PORT):
+    """Avvia in un thread l'endpoint HTTP /metrics; restituisce il server (None se disabilitato)."""
+    if not port:
+        return None
+    try:
+        server = ThreadingHTTPServer(("", port), _MetricsHandler)
+    except OSError as e:
+        print(f"TELEMETRY: Unable to start metrics endpoint on port {port}: {e}")
+        return None
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print(f"TELEMETRY: Metrics available on :{port}/metrics")
+    return server
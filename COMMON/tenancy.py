@@ -0,0 +1,105 @@
+import os
+import zlib
+import multiprocessing
+from multiprocessing.connection import wait
+
+DAM_TAG = "dam_id"        # Tag InfluxDB con l'identificativo della diga
+SHARD_ENV = "DAM_SHARD"   # Indice dello shard, impostato nell'ambiente dei processi worker
+
+
+def configured_dam_ids():
+    """Dighe gestite dal servizio: DAM_UNIQUE_IDS (separati da virgola) oppure la sola DAM_UNIQUE_ID."""
+    dam_ids = [dam_id.strip() for dam_id in os.getenv("DAM_UNIQUE_IDS", "").split(",") if dam_id.strip()]
+    return dam_ids or [os.getenv("DAM_UNIQUE_ID")]
+
+
+def configured_shards():
+    """Numero di processi worker tra cui dividere le dighe (DAM_SHARDS, default 1)."""
+    return max(1, int(os.getenv("DAM_SHARDS", 1)))
+
+
+def multi_dam():
+    """True se il servizio gestisce più dighe: i dati su InfluxDB vanno filtrati per DAM_TAG."""
+    return len(configured_dam_ids()) > 1
+
+
+def shard_of(dam_id, shards):
+    """Shard di una diga: crc32 dell'identificativo, stabile tra riavvii e uguale in tutti i servizi."""
+    return zlib.crc32(dam_id.encode()) % shards
+
+
+def shard_plan(dam_ids, shards):
+    """Dighe assegnate a ogni shard (gli shard vuoti sono omessi)."""
+    plan = [[] for _ in range(max(1, shards))]
+    for dam_id in dam_ids:
+        plan[shard_of(dam_id, len(plan))].append(dam_id)
+    return [shard_dams for shard_dams in plan if shard_dams]
+
+
+def current_shard():
+    """Indice dello shard del processo corrente (None nel processo principale)."""
+    value = os.getenv(SHARD_ENV)
+    return int(value) if value else None
+
+
+def shard_client_id(name):
+    """Client id MQTT univoco per shard (il broker disconnette due client con lo stesso id)."""
+    shard = current_shard()
+    return name if shard is None else f"{name}_shard{shard}"
+
+
+def shard_metrics_port(port):
+    """Porta /metrics del processo: METRICS_PORT nel processo principale, le successive negli shard."""
+    shard = current_shard()
+    return port if shard is None or not port else port + 1 + shard
+
+
+def flux_dam_filter(dam_ids):
+    """Filtro Flux sulle dighe indicate; vuoto con una sola diga (compatibile con i dati senza tag)."""
+    if not multi_dam():
+        return ""
+    dam_set = ", ".join(f'"{dam_id}"' for dam_id in dam_ids)
+    return f'|> filter(fn: (r) => contains(value: r.{DAM_TAG}, set: [{dam_set}]))'
+
+
+def dam_from_topic(topic):
+    """Identificativo della diga dal topic MQTT (<DAM_UNIQUE_ID>/...)."""
+    return topic.split("/", 1)[0]
+
+
+def run_sharded(worker, dam_ids, shards):
+    """
+    Esegue worker(dighe dello shard) per ogni shard. Con un solo shard gira nel processo corrente,
+    altrimenti ogni shard ha il suo processo 'spawn' (client MQTT/InfluxDB e thread creati da zero).
+    Se un worker termina vengono fermati anche gli altri, così il container viene riavviato.
+    :return: Codice di uscita del primo worker terminato (0 con un solo shard).
+    """
+    plan = shard_plan(dam_ids, shards)
+    if len(plan) == 1:
+        worker(plan[0])
+        return 0
+
+    context = multiprocessing.get_context("spawn")
+    processes = []
+    try:
+        for index, shard_dams in enumerate(plan):
+            os.environ[SHARD_ENV] = str(index)
+            process = context.Process(target=worker, args=(shard_dams,), name=f"shard-{index}")
+            process.start()
+            processes.append(process)
+            print(f"TENANCY: Shard {index} (pid {process.pid}) manages {len(shard_dams)} dams: {', '.join(shard_dams)}")
+        os.environ.pop(SHARD_ENV, None)
+
+        finished = wait([process.sentinel for process in processes])
+        process = next(process for process in processes if process.sentinel in finished)
+        process.join()
+        print(f"TENANCY: {process.name} exited with code {process.exitcode}, stopping the other shards.")
+        return process.exitcode or 1
+    except KeyboardInterrupt:
+        return 0
+    finally:
+        os.environ.pop(SHARD_ENV, None)
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+            process.join()
@@ -2,8 +2,10 @@ import os
 import json
 import time
 import threading
-from paho.mqtt.client import Client  # type: ignore
+from paho.mqtt.client import MQTT_ERR_SUCCESS, Client  # type: ignore
 from dotenv import load_dotenv  # type: ignore
+from telemetry import METRICS_PORT, TRACE_KEY, count_message, extract_trace, record_hop, registry, start_metrics_server
+from tenancy import configured_dam_ids, configured_shards, dam_from_topic, run_sharded, shard_client_id, shard_metrics_port
 
 # Carica le variabili dal file .env
 load_dotenv()
@@ -16,15 +18,32 @@ MQTT_USER = os.getenv("MQTT_USER")
 MQTT_PASSWORD = os.getenv("MQTT_PASSWORD")
 PLANNER_TOPIC_PREFIX = os.getenv("PLANNER_TOPIC_PREFIX")
 GATE_TOPIC_PREFIX = os.getenv("GATE_TOPIC_PREFIX")
+# Dighe gestite (DAM_UNIQUE_IDS) e processi worker tra cui dividerle (DAM_SHARDS)
+DAM_UNIQUE_IDS = configured_dam_ids()
+DAM_SHARDS = configured_shards()
+# Attuazione solo delle variazioni: scarto minimo (punti percentuali) rispetto all'ultimo comando inviato,
+# finestra (s) in cui i comandi di un gate sono accorpati nel più recente (0 = invio immediato)
+# e intervallo (s) dopo cui un comando invariato viene comunque reinviato (0 = mai)
+EXECUTOR_DEADBAND = float(os.getenv("EXECUTOR_DEADBAND", 0.5))
+EXECUTOR_COALESCE_INTERVAL = float(os.getenv("EXECUTOR_COALESCE_INTERVAL", 1))
+EXECUTOR_RESEND_INTERVAL = float(os.getenv("EXECUTOR_RESEND_INTERVAL", 300))
+EXECUTOR_STATS_INTERVAL = 60  # Intervallo (s) del riepilogo dei comandi inviati e soppressi
 
 # Stato MQTT
 is_connected = False
-gate_states = {}
+gate_states = {}  # Stato dei gate per diga: dam_id -> gate_id -> stato
+last_sent = {}  # Ultimo comando inviato: (dam_id, gate_id) -> (open_percentage, istante di invio)
+pending_commands = {}  # Comando più recente in attesa di invio: (dam_id, gate_id) -> (open_percentage, trace)
+command_stats = {"sent": 0, "deadband": 0, "coalesced": 0}
 data_lock = threading.Lock()
+flush_lock = threading.Lock()  # Un solo invio alla volta (thread di flush, callback MQTT, arresto)
 stop_event = threading.Event()
 
+GATE_COMMANDS = registry.counter(
+    "mapek_executor_gate_commands_total", "Comandi dei gate per esito (sent, deadband, coalesced)")
+
 # Configurazione MQTT
-mqtt_client = Client("Executor")
+mqtt_client = Client(shard_client_id("Executor"))
 mqtt_client.username_pw_set(MQTT_USER, MQTT_PASSWORD)
 
 def on_connect(client, userdata, flags, rc):
@@ -33,9 +52,10 @@ def on_connect(client, userdata, flags, rc):
     if rc == 0:
         print("EXECUTOR: Connected to MQTT Broker!")
         is_connected = True
-        action_topic = f"{DAM_UNIQUE_ID}/{PLANNER_TOPIC_PREFIX}"
-        mqtt_client.subscribe(action_topic)
-        print(f"EXECUTOR: Subscribed to {action_topic}")
+        for dam_id in gate_states:
+            action_topic = f"{dam_id}/{PLANNER_TOPIC_PREFIX}"
+            mqtt_client.subscribe(action_topic)
+            print(f"EXECUTOR: Subscribed to {action_topic}")
     else:
         print(f"EXECUTOR: Connection failed with return code {rc}")
 
@@ -55,37 +75,105 @@ def on_message(client, userdata, msg):
         print(f"EXECUTOR: Invalid JSON payload on topic {topic}")
         return
 
-    if topic == f"{DAM_UNIQUE_ID}/{PLANNER_TOPIC_PREFIX}":
-        process_command(payload)
+    dam_id = dam_from_topic(topic)
+    if dam_id in gate_states and topic == f"{dam_id}/{PLANNER_TOPIC_PREFIX}":
+        process_command(payload, dam_id)
 
-def process_command(payload):
-    """Elabora i comandi ricevuti dal Planner."""
+def process_command(payload, dam_id=DAM_UNIQUE_ID):
+    """Elabora i comandi ricevuti dal Planner per una diga."""
     global gate_states
     try:
+        count_message("executor", "command")
+        trace = record_hop(extract_trace(payload), "executor")
         for gate_id, open_percentage in payload.items():
+            if gate_id == TRACE_KEY:
+                continue
             if not isinstance(open_percentage, (int, float)):
                 print(f"EXECUTOR: Invalid open_percentage for gate {gate_id}: {open_percentage}")
                 continue
 
+            open_percentage = max(0, min(100, open_percentage))  # Limita tra 0 e 100
             with data_lock:
-                gate_states[gate_id] = {
-                    "open_percentage": max(0, min(100, open_percentage))  # Limita tra 0 e 100
-                }
-                print(f"EXECUTOR: Command processed - Gate {gate_id} set to {open_percentage}%")
-                send_gate_command(gate_id, open_percentage)
+                gate_states.setdefault(dam_id, {})[gate_id] = {"open_percentage": open_percentage}
+                if (dam_id, gate_id) in pending_commands:
+                    record_suppressed("coalesced")  # Sostituito dal comando più recente prima dell'invio
+                pending_commands[(dam_id, gate_id)] = (open_percentage, trace)
+        if EXECUTOR_COALESCE_INTERVAL <= 0:
+            flush_commands()
     except Exception as e:
         print(f"EXECUTOR: Error processing command: {e}")
 
-def send_gate_command(gate_id, open_percentage):
-    """Pubblica il comando per una specifica porta sul topic MQTT appropriato."""
+def record_suppressed(reason):
+    """Conta un comando non inviato (deadband o accorpato)."""
+    command_stats[reason] += 1
+    GATE_COMMANDS.inc(outcome=reason)
+
+def needs_update(previous, open_percentage, now):
+    """
+    True se il comando va inviato: primo comando del gate, scarto oltre la deadband, apertura/chiusura
+    completa richiesta (non resta mai un residuo dentro la deadband) o comando invariato da più di
+    EXECUTOR_RESEND_INTERVAL secondi (il gate riparte da 0% se viene riavviato).
+    """
+    if previous is None:
+        return True
+    sent_percentage, sent_time = previous
+    if abs(open_percentage - sent_percentage) >= EXECUTOR_DEADBAND:
+        return True
+    if open_percentage in (0, 100) and open_percentage != sent_percentage:
+        return True
+    return EXECUTOR_RESEND_INTERVAL > 0 and now - sent_time >= EXECUTOR_RESEND_INTERVAL
+
+def flush_commands():
+    """Invia il comando più recente di ogni gate in attesa, se supera la deadband."""
+    with flush_lock:
+        with data_lock:
+            commands = dict(pending_commands)
+            pending_commands.clear()
+        now = time.time()
+        for (dam_id, gate_id), (open_percentage, trace) in commands.items():
+            if not needs_update(last_sent.get((dam_id, gate_id)), open_percentage, now):
+                record_suppressed("deadband")
+                continue
+            if send_gate_command(gate_id, open_percentage, trace, dam_id):
+                last_sent[(dam_id, gate_id)] = (open_percentage, now)
+                command_stats["sent"] += 1
+                GATE_COMMANDS.inc(outcome="sent")
+                print(f"EXECUTOR: Command processed - {dam_id} gate {gate_id} set to {open_percentage}%")
+
+def flush_loop():
+    """Invia i comandi accorpati ogni EXECUTOR_COALESCE_INTERVAL secondi."""
+    while not stop_event.wait(EXECUTOR_COALESCE_INTERVAL):
+        try:
+            flush_commands()
+        except Exception as e:
+            print(f"EXECUTOR: Error flushing commands: {e}")
+
+def print_command_stats():
+    """Riepilogo dei comandi inviati e soppressi dall'avvio."""
+    suppressed = command_stats["deadband"] + command_stats["coalesced"]
+    total = command_stats["sent"] + suppressed
+    print(f"EXECUTOR: Gate commands - sent {command_stats['sent']}, suppressed {suppressed} "
+          f"(deadband {command_stats['deadband']}, coalesced {command_stats['coalesced']}, "
+          f"{suppressed / total if total else 0:.0%} of {total})")
+
+def send_gate_command(gate_id, open_percentage, trace=None, dam_id=DAM_UNIQUE_ID):
+    """Pubblica il comando per una specifica porta sul topic MQTT appropriato; restituisce True se pubblicato."""
     try:
-        command_topic = f"{DAM_UNIQUE_ID}/{GATE_TOPIC_PREFIX}/{gate_id}/command"
+        command_topic = f"{dam_id}/{GATE_TOPIC_PREFIX}/{gate_id}/command"
 
         payload = {"open_percentage": open_percentage}
-        mqtt_client.publish(command_topic, json.dumps(payload), qos=1)
+        if trace:
+            payload[TRACE_KEY] = trace
+        info = mqtt_client.publish(command_topic, json.dumps(payload), qos=1)
+        if info.rc != MQTT_ERR_SUCCESS:
+            # Es. MQTT_ERR_NO_CONN durante una disconnessione: il comando non va registrato come inviato
+            print(f"EXECUTOR: Failed to publish command for Gate {gate_id} (rc {info.rc})")
+            return False
         print(f"EXECUTOR: Published command - Gate {gate_id}: {open_percentage}% on topic {command_topic}")
+        return True
     except Exception as e:
         print(f"EXECUTOR: Error sending gate command: {e}")
+        return False
 
 def reconnect_mqtt():
     """Gestisce i tentativi di riconnessione al broker."""
@@ -100,24 +188,41 @@ def reconnect_mqtt():
             print(f"EXECUTOR: Reconnection failed: {e}")
             time.sleep(10)
 
-if __name__ == "__main__":
+def run_executor(dam_ids):
+    """Worker di uno shard: una connessione MQTT per tutte le dighe dello shard."""
+    for dam_id in dam_ids:
+        gate_states[dam_id] = {}
     try:
+        start_metrics_server(shard_metrics_port(METRICS_PORT))
         mqtt_client.on_connect = on_connect
         mqtt_client.on_disconnect = on_disconnect
         mqtt_client.on_message = on_message
 
         reconnect_mqtt_thread = threading.Thread(target=reconnect_mqtt, daemon=True)
         reconnect_mqtt_thread.start()
+        if EXECUTOR_COALESCE_INTERVAL > 0:
+            threading.Thread(target=flush_loop, daemon=True).start()
 
         print("EXECUTOR: Processing commands...")
+        last_stats = time.time()
         while not stop_event.is_set():
             time.sleep(1)
+            if time.time() - last_stats >= EXECUTOR_STATS_INTERVAL:
+                print_command_stats()
+                last_stats = time.time()
     except KeyboardInterrupt:
         print("EXECUTOR: Stopping gracefully.")
     except Exception as e:
         print(f"EXECUTOR: Critical error: {e}")
     finally:
         stop_event.set()
+        flush_commands()  # Ultimi comandi accorpati ancora in attesa
+        print_command_stats()
         mqtt_client.loop_stop()
         mqtt_client.disconnect()
         print("EXECUTOR: Resources released.")
+
+
+if __name__ == "__main__":
+    raise SystemExit(run_sharded(run_executor, DAM_UNIQUE_IDS, DAM_SHARDS))
+
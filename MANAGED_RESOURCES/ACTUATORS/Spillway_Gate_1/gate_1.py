@@ -3,6 +3,7 @@ import json
 import time
 import paho.mqtt.client as mqtt  # type: ignore
 from dotenv import load_dotenv  # type: ignore
+from telemetry import count_message, extract_trace, record_hop, start_metrics_server
 
 # Carica le variabili dal file .env
 load_dotenv()
@@ -40,6 +41,12 @@ def on_message(client, userdata, msg):
         if "open_percentage" in command:
             gate_open_percentage = max(0, min(100, command["open_percentage"]))
             print(f"{GATE_ID}: Set to {gate_open_percentage}%")
+            count_message("gate", "command")
+            # Ultimo passaggio della traccia: il gate si è mosso
+            trace = record_hop(extract_trace(command), "gate")
+            if trace:
+                print(f"{GATE_ID}: Control loop latency {trace['hops'][-1][1] - trace['origin']:.2f} s "
+                      f"({' -> '.join(stage for stage, _ in trace['hops'])})")
     except Exception as e:
         print(f"{GATE_ID}: Error processing command: {e}")
 
@@ -61,6 +68,7 @@ if __name__ == "__main__":
     client.on_message = on_message
 
     try:
+        start_metrics_server()
         client.connect(MQTT_BROKER, MQTT_PORT, 180)
         client.loop_start()
 
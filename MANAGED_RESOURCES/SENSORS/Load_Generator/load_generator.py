@@ -0,0 +1,213 @@
+import os
+import time
+import json
+import argparse
+import threading
+from datetime import datetime
+import numpy as np  # type: ignore
+import paho.mqtt.client as mqtt  # type: ignore
+from dotenv import load_dotenv  # type: ignore
+from inflow_table import inflow_model_source, load_inflow_model
+from sensor_inflow import apply_random_variability, calculate_inflow
+from telemetry import MESSAGES, new_trace, start_metrics_server
+
+# Carica le variabili dal file .env
+load_dotenv()
+
+DAM_UNIQUE_ID = os.getenv("DAM_UNIQUE_ID")
+SENSORS_TOPIC_PREFIX = os.getenv("SENSORS_TOPIC_PREFIX")
+SENSORS_PUBLISH_DELAY = int(os.getenv("SENSORS_PUBLISH_DELAY", 1))
+
+MQTT_BROKER = os.getenv("MQTT_BROKER")
+MQTT_PORT = int(os.getenv("MQTT_PORT", 1883))
+MQTT_USER = os.getenv("MQTT_USER")
+MQTT_PASSWORD = os.getenv("MQTT_PASSWORD")
+
+# Parametri del generatore di carico
+LOADGEN_SENSORS = int(os.getenv("LOADGEN_SENSORS", 100))            # Numero di sensori virtuali
+LOADGEN_RATE = float(os.getenv("LOADGEN_RATE", 1 / SENSORS_PUBLISH_DELAY))  # Pubblicazioni al secondo per sensore
+LOADGEN_CONNECTIONS = int(os.getenv("LOADGEN_CONNECTIONS", 4))      # Connessioni MQTT condivise dai sensori
+LOADGEN_DURATION = float(os.getenv("LOADGEN_DURATION", 0))          # Durata del test (s), 0 = senza fine
+LOADGEN_QOS = int(os.getenv("LOADGEN_QOS", 0))
+LOADGEN_REPORT_INTERVAL = float(os.getenv("LOADGEN_REPORT_INTERVAL", 10))
+LOADGEN_SENSOR_PREFIX = os.getenv("LOADGEN_SENSOR_PREFIX", "Virtual")
+# Modelli dei fiumi (separati da virgola) e quota di sensori solari (curva di calculate_inflow)
+LOADGEN_MODEL_FILES = [path.strip() for path in os.getenv(
+    "LOADGEN_MODEL_FILES", "piave_random_forest.pkl,boite_random_forest.pkl").split(",") if path.strip()]
+LOADGEN_SOLAR_SHARE = float(os.getenv("LOADGEN_SOLAR_SHARE", 0.1))
+# Se true l'inflow totale resta quello dei sensori reali (ogni sensore porta una quota del suo fiume)
+LOADGEN_NORMALIZE = os.getenv("LOADGEN_NORMALIZE", "true").lower() == "true"
+
+
+class SensorShard:
+    """Gruppo di sensori virtuali che pubblicano sulla stessa connessione MQTT."""
+
+    def __init__(self, index, sensor_ids, kinds, scales, models, rate, qos, seed=None):
+        self.index = index
+        self.sensor_ids = sensor_ids
+        self.topics = [f"{DAM_UNIQUE_ID}/{SENSORS_TOPIC_PREFIX}/{sensor_id}" for sensor_id in sensor_ids]
+        self.kinds = np.asarray(kinds)       # Indice del modello, -1 per i sensori solari
+        self.scales = np.asarray(scales)     # Quota del fiume rappresentata da ogni sensore
+        self.models = models
+        self.period = 1 / rate
+        self.qos = qos
+        self.rng = np.random.default_rng(seed)
+        self.sent = 0
+        self.completed = 0
+        self.errors = 0
+        self.max_lag = 0.0                   # Ritardo massimo di un tick rispetto alla pianificazione (s)
+        self.connected = threading.Event()
+        self.client = mqtt.Client(f"LoadGenerator_{index}")
+        self.client.username_pw_set(MQTT_USER, MQTT_PASSWORD)
+        self.client.max_queued_messages_set(0)
+        self.client.on_connect = self.on_connect
+        self.client.on_disconnect = self.on_disconnect
+        self.client.on_publish = self.on_publish
+
+    def on_connect(self, client, userdata, flags, rc):
+        if rc == 0:
+            self.connected.set()
+        else:
+            print(f"LOADGEN: Connection {self.index} failed, return code {rc}")
+
+    def on_disconnect(self, client, userdata, rc):
+        self.connected.clear()
+
+    def on_publish(self, client, userdata, mid):
+        self.completed += 1
+
+    def inflows(self, now):
+        """Portate di tutti i sensori del gruppo per l'istante corrente."""
+        values = np.full(len(self.sensor_ids), calculate_inflow(now.hour, now.minute))
+        day_of_year = now.timetuple().tm_yday
+        for kind, model in enumerate(self.models):
+            mask = self.kinds == kind
+            if mask.any():
+                values[mask] = model.predict(day_of_year, now.hour)
+        return apply_random_variability(values, rng=self.rng) * self.scales
+
+    def publish_tick(self):
+        now = datetime.now()
+        timestamp = now.strftime("%Y-%m-%d %H:%M:%S")
+        published = 0
+        for sensor_id, topic, inflow in zip(self.sensor_ids, self.topics, self.inflows(now)):
+            data = {
+                "sensor_id": sensor_id,
+                "inflow": float(inflow),
+                "timestamp": timestamp,
+                "trace": new_trace("sensor")
+            }
+            info = self.client.publish(topic, json.dumps(data), qos=self.qos)
+            if info.rc == mqtt.MQTT_ERR_SUCCESS:
+                published += 1
+            else:
+                self.errors += 1
+        self.sent += published
+        MESSAGES.inc(published, stage="sensor", kind="publish")
+
+    def run(self, stop_event):
+        self.client.connect_async(MQTT_BROKER, MQTT_PORT, 180)
+        self.client.loop_start()
+        self.connected.wait(30)
+        next_tick = time.monotonic()
+        while not stop_event.is_set():
+            lag = time.monotonic() - next_tick
+            self.max_lag = max(self.max_lag, lag)
+            if self.connected.is_set():
+                self.publish_tick()
+            next_tick += self.period
+            # Se il gruppo è in ritardo di più di un periodo salta i tick persi invece di accumularli
+            if time.monotonic() - next_tick > self.period:
+                next_tick = time.monotonic()
+            stop_event.wait(max(0.0, next_tick - time.monotonic()))
+        self.client.loop_stop()
+        self.client.disconnect()
+
+
+def build_shards(sensors, connections, rate, qos, model_files, solar_share, normalize):
+    """Crea i sensori virtuali e li distribuisce in modo uniforme sulle connessioni."""
+    models = []
+    for path in model_files:
+        models.append(load_inflow_model(path))
+        print(f"LOADGEN: Model {inflow_model_source(path)} loaded")
+
+    # Indice del modello per ogni sensore (-1 = pompa solare)
+    solar_count = int(round(sensors * solar_share)) if models else sensors
+    kinds = np.full(sensors, -1)
+    if models:
+        kinds[solar_count:] = np.arange(sensors - solar_count) % len(models)
+    rng = np.random.default_rng(0)
+    scales = rng.uniform(0.5, 1.5, size=sensors)
+    if normalize:
+        # Ogni gruppo (fiume o pompe solari) somma in media alla portata del sensore reale
+        for kind in np.unique(kinds):
+            mask = kinds == kind
+            scales[mask] /= scales[mask].sum()
+
+    sensor_ids = [f"{LOADGEN_SENSOR_PREFIX}_{position:05d}" for position in range(sensors)]
+    connections = max(1, min(connections, sensors))
+    shards = []
+    for index in range(connections):
+        selection = slice(index, None, connections)
+        shards.append(SensorShard(
+            index, sensor_ids[selection], kinds[selection], scales[selection], models, rate, qos, seed=index
+        ))
+    return shards
+
+
+def report(shards, elapsed, previous=None):
+    """Stampa il throughput dall'avvio (e dall'ultimo report) e restituisce i contatori correnti."""
+    sent = sum(shard.sent for shard in shards)
+    completed = sum(shard.completed for shard in shards)
+    errors = sum(shard.errors for shard in shards)
+    max_lag = max(shard.max_lag for shard in shards)
+    target = sum(len(shard.sensor_ids) / shard.period for shard in shards)
+    line = (f"LOADGEN: {elapsed:.0f}s - sent {sent}, completed {completed}, errors {errors}, "
+            f"sustained {completed / elapsed if elapsed else 0:.0f} msg/s (target {target:.0f} msg/s), "
+            f"max tick lag {max_lag * 1000:.0f} ms")
+    if previous:
+        interval = elapsed - previous[0]
+        line += f", last interval {(completed - previous[1]) / interval if interval else 0:.0f} msg/s"
+    print(line)
+    return elapsed, completed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generatore di carico: N sensori virtuali su poche connessioni MQTT.")
+    parser.add_argument("--sensors", type=int, default=LOADGEN_SENSORS, help="Numero di sensori virtuali")
+    parser.add_argument("--rate", type=float, default=LOADGEN_RATE, help="Pubblicazioni al secondo per sensore")
+    parser.add_argument("--connections", type=int, default=LOADGEN_CONNECTIONS, help="Connessioni MQTT")
+    parser.add_argument("--duration", type=float, default=LOADGEN_DURATION, help="Durata in secondi (0 = senza fine)")
+    parser.add_argument("--qos", type=int, default=LOADGEN_QOS, choices=(0, 1, 2), help="QoS delle pubblicazioni")
+    args = parser.parse_args()
+
+    shards = build_shards(args.sensors, args.connections, args.rate, args.qos,
+                          LOADGEN_MODEL_FILES, LOADGEN_SOLAR_SHARE, LOADGEN_NORMALIZE)
+    print(f"LOADGEN: {args.sensors} sensors on {len(shards)} connections, "
+          f"{args.rate} msg/s per sensor (target {args.sensors * args.rate:.0f} msg/s)")
+
+    start_metrics_server()
+    stop_event = threading.Event()
+    threads = [threading.Thread(target=shard.run, args=(stop_event,), daemon=True) for shard in shards]
+    start = time.monotonic()
+    for thread in threads:
+        thread.start()
+
+    previous = None
+    try:
+        while not stop_event.is_set():
+            elapsed = time.monotonic() - start
+            remaining = args.duration - elapsed if args.duration else LOADGEN_REPORT_INTERVAL
+            stop_event.wait(max(0.0, min(LOADGEN_REPORT_INTERVAL, remaining)))
+            elapsed = time.monotonic() - start
+            previous = report(shards, elapsed, previous)
+            if args.duration and elapsed >= args.duration:
+                break
+    except KeyboardInterrupt:
+        print("LOADGEN: Shutting down.")
+    finally:
+        stop_event.set()
+        for thread in threads:
+            thread.join(timeout=5)
+        print("LOADGEN: Final report")
+        report(shards, time.monotonic() - start)
@@ -1,13 +1,12 @@
 import os
 import time
 import json
-import joblib  # type: ignore
-import numpy as np  # type: ignore
-import pandas as pd  # type: ignore
 import paho.mqtt.client as mqtt  # type: ignore
 from datetime import datetime
-import random
 from dotenv import load_dotenv  # type: ignore
+from telemetry import count_message, new_trace, start_metrics_server
+from inflow_table import inflow_model_source, load_inflow_model
+from sensor_inflow import apply_random_variability
 
 # Carica le variabili dal file .env
 load_dotenv()
@@ -32,10 +31,10 @@ MQTT_PASSWORD = os.getenv("MQTT_PASSWORD")
 # Stato del client MQTT
 is_connected = False
 
-# Carica il modello
+# Carica il modello (tabella precalcolata se presente, altrimenti il .pkl)
 try:
-    model = joblib.load(MODEL_FILE)
-    print(f"Modello {MODEL_FILE} caricato con successo.")
+    model = load_inflow_model(MODEL_FILE)
+    print(f"Modello {inflow_model_source(MODEL_FILE)} caricato con successo.")
 except Exception as e:
     print(f"Errore nel caricamento del modello {MODEL_FILE}: {e}")
     exit(1)
@@ -70,31 +69,7 @@ def reconnect(client):
 
 def predict_volume(day_of_year, hour_of_day):
     """Calcola la portata basata sul giorno dell'anno e l'ora."""
-    sin_day = np.sin(2 * np.pi * day_of_year / 365)
-    cos_day = np.cos(2 * np.pi * day_of_year / 365)
-    sin_hour = np.sin(2 * np.pi * hour_of_day / 24)
-    cos_hour = np.cos(2 * np.pi * hour_of_day / 24)
-
-    # Prepara i dati per il modello
-    X_input = pd.DataFrame([{
-        'sin_day': sin_day,
-        'cos_day': cos_day,
-        'sin_hour': sin_hour,
-        'cos_hour': cos_hour
-    }])
-
-    # Predizione
-    return model.predict(X_input)[0]
-
-def apply_random_variability(value, min_percentage=5, max_percentage=10):
-    """Applica una variabilità casuale compresa tra il min_percentage e il max_percentage al valore."""
-    percentage_variation = random.uniform(min_percentage, max_percentage) / 100
-    variation = value * percentage_variation
-    # Decidi se aggiungere o sottrarre la variazione
-    if random.choice([True, False]):
-        return value + variation
-    else:
-        return value - variation
+    return model.predict(day_of_year, hour_of_day)
 
 def publish_data(client, sensor_id):
     """Pubblica i dati del sensore su MQTT."""
@@ -118,9 +93,11 @@ def publish_data(client, sensor_id):
             data = {
                 "sensor_id": sensor_id,
                 "inflow": float(inflow),
-                "timestamp": now.strftime("%Y-%m-%d %H:%M:%S")
+                "timestamp": now.strftime("%Y-%m-%d %H:%M:%S"),
+                "trace": new_trace("sensor")  # Origine della traccia del ciclo MAPE-K
             }
             client.publish(MQTT_TOPIC, json.dumps(data))  # Converte il dizionario in una stringa JSON
+            count_message("sensor", "publish")
 
             #print(f"Sensor {sensor_id} published: {data}")
         except Exception as e:
@@ -137,6 +114,7 @@ if __name__ == "__main__":
 
     # Avvia la pubblicazione dei dati
     try:
+        start_metrics_server()
         reconnect(client)
         publish_data(client, SENSOR_ID)
     except KeyboardInterrupt:
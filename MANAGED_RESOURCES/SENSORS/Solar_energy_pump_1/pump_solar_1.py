@@ -6,8 +6,9 @@ import numpy as np  # type: ignore
 import pandas as pd  # type: ignore
 import paho.mqtt.client as mqtt  # type: ignore
 from datetime import datetime
-import random
 from dotenv import load_dotenv  # type: ignore
+from telemetry import count_message, new_trace, start_metrics_server
+from sensor_inflow import apply_random_variability, calculate_inflow
 
 # Carica le variabili dal file .env
 load_dotenv()
@@ -58,34 +59,6 @@ def reconnect(client):
             print(f"Sensor {SENSOR_ID}: Reconnection failed: {e}")
             time.sleep(5)
 
-def calculate_inflow(hour, minute):
-    total_minutes = hour * 60 + minute  # Convertiamo ore e minuti in minuti totali
-    # Test di esempio
-
-    if 0 <= total_minutes < 360:  # Da 00:00 a 05:59 (360 minuti)
-        return 0  # Produzione 0 tra le 00:00 e le 06:00
-    elif 360 <= total_minutes <= 720:  # Da 06:00 a 11:59 (720 minuti)
-        percentage = (total_minutes - 360) / 360  # Calcolo della percentuale su 360 minuti
-        return percentage * 20  # Crescita progressiva da 0 a 20
-    elif 720 < total_minutes <= 1080:  # Da 12:00 a 17:59 (1080 minuti)
-        percentage = (1080 - total_minutes) / 360  # Calcolo della percentuale decrescente
-        return percentage * 20  # Decrescita progressiva da 20 a 0
-    elif 1080 < total_minutes <= 1440:  # Da 18:00 a 23:59 (1440 minuti)
-        return 0  # Produzione 0 tra le 18:00 e le 00:00
-    else:
-        raise ValueError("Hour must be between 0 and 24, minute between 0 and 59")
-    
-
-def apply_random_variability(value, min_percentage=5, max_percentage=10):
-    """Applica una variabilità casuale compresa tra il min_percentage e il max_percentage al valore."""
-    percentage_variation = random.uniform(min_percentage, max_percentage) / 100
-    variation = value * percentage_variation
-    # Decidi se aggiungere o sottrarre la variazione
-    if random.choice([True, False]):
-        return value + variation
-    else:
-        return value - variation
-
 def publish_data(client, sensor_id):
     """Pubblica i dati del sensore su MQTT."""
     global is_connected
@@ -107,9 +80,11 @@ def publish_data(client, sensor_id):
             data = {
                 "sensor_id": sensor_id,
                 "inflow": float(inflow),
-                "timestamp": now.strftime("%Y-%m-%d %H:%M:%S")
+                "timestamp": now.strftime("%Y-%m-%d %H:%M:%S"),
+                "trace": new_trace("sensor")  # Origine della traccia del ciclo MAPE-K
             }
             client.publish(MQTT_TOPIC, json.dumps(data))  # Converte il dizionario in una stringa JSON
+            count_message("sensor", "publish")
 
             #print(f"Sensor {sensor_id} published: {data}")
         except Exception as e:
@@ -126,6 +101,7 @@ if __name__ == "__main__":
 
    
     try:
+        start_metrics_server()
         reconnect(client)
         publish_data(client, SENSOR_ID)
     except KeyboardInterrupt:
@@ -0,0 +1,157 @@
+import time
+from influxdb_client import Point  # type: ignore
+from rolling_stats import SensorStats
+from telemetry import extract_trace, hop_time, latest_trace, record_hop
+from tenancy import DAM_TAG
+from monitor_config import (BUCKET_FLOWS_DATA, BUCKET_GATE_DATA, BUCKET_SENSOR_DATA, GATE_FIELD_FLOW, GATE_FIELD_STATE,
+                            GATE_OUTFLOW, GATE_TAG, POWER_GATE_ID, POWER_GATE_OUTFLOW, SENSOR_FIELD, SENSOR_TAG,
+                            STATS_DATA, TIMESTAMP)
+
+
+class DamFlowState:
+    """Stato in memoria dei flussi di una diga: inflow dei sensori, aperture dei gate e tracce."""
+
+    def __init__(self, dam_id):
+        self.dam_id = dam_id
+        self.sensor_data = {}
+        self.sensor_last_update = {}
+        self.gate_states = {}
+        self.sensor_traces = {}  # Ultima traccia ricevuta da ogni sensore
+        self.sensor_stats = {}   # Statistiche mobili di ogni sensore (SensorStats)
+
+    def record_sensor(self, sensor_id, payload):
+        """Aggiorna inflow, traccia e statistiche del sensore e restituisce il punto InfluxDB della lettura."""
+        self.sensor_data[sensor_id] = payload.get(SENSOR_FIELD, 0)
+        self.sensor_last_update[sensor_id] = time.time()
+        self.sensor_traces[sensor_id] = record_hop(extract_trace(payload), "monitor_in")
+        self.update_stats(sensor_id, self.sensor_data[sensor_id])
+        return Point(f"{BUCKET_SENSOR_DATA}") \
+            .tag(DAM_TAG, self.dam_id) \
+            .tag(f"{SENSOR_TAG}", sensor_id) \
+            .field(f"{SENSOR_FIELD}", payload.get(f"{SENSOR_FIELD}", 0)) \
+            .time(payload.get(f"{TIMESTAMP}", time.strftime("%Y-%m-%dT%H:%M:%SZ")))
+
+    def record_gate(self, gate_id, payload):
+        """Aggiorna l'apertura del gate (senza calcolare l'outflow) e restituisce il punto InfluxDB della percentuale."""
+        open_percentage = payload.get("open_percentage", 0)
+        self.gate_states[gate_id] = {
+            "open_percentage": open_percentage
+        }
+        return Point(f"{BUCKET_GATE_DATA}") \
+            .tag(DAM_TAG, self.dam_id) \
+            .tag(f"{GATE_TAG}", gate_id) \
+            .field(f"{GATE_FIELD_STATE}", float(open_percentage)) \
+            .time(payload.get(f"{TIMESTAMP}", time.strftime("%Y-%m-%dT%H:%M:%SZ")))
+
+    def gate_outflows(self):
+        """Portata (m³/s) di ogni gate secondo l'apertura ricevuta: Power Gate e Spillway hanno capacità diverse."""
+        outflows = {}
+        for gate_id, gate_data in self.gate_states.items():
+            if str(gate_id) == str(POWER_GATE_ID):
+                outflows[gate_id] = (gate_data.get("open_percentage", 0) / 100) * POWER_GATE_OUTFLOW
+            else:
+                outflows[gate_id] = (gate_data.get("open_percentage", 0) / 100) * GATE_OUTFLOW
+        return outflows
+
+    def flows(self):
+        """
+        Portate globali della diga: punti InfluxDB (portata di ogni gate e flussi totali) e payload
+        pubblicato per l'integrazione del volume nell'ANALYZER.
+        :return: Tupla (punti, flows).
+        """
+        flow_timestamp = time.time()
+        timestamp = time.strftime("%Y-%m-%dT%H:%M:%SZ")
+        total_inflow = float(sum(self.sensor_data.values()))  # Somma gli inflow
+        # Traccia del campione più recente tra quelli aggregati
+        trace = record_hop(latest_trace(self.sensor_traces.values()), "monitor")
+
+        points = []
+        outflows = self.gate_outflows()
+        for gate_id, gate_outflow in outflows.items():
+            points.append(
+                Point(f"{BUCKET_SENSOR_DATA}")
+                .tag(DAM_TAG, self.dam_id)
+                .tag(f"{GATE_TAG}", gate_id)
+                .field(f"{GATE_FIELD_FLOW}", gate_outflow)
+                .time(timestamp)
+            )
+        total_outflow = float(sum(outflows.values()))
+
+        flow_point = Point(f"{BUCKET_FLOWS_DATA}") \
+            .tag(DAM_TAG, self.dam_id) \
+            .field("total_inflow", total_inflow) \
+            .field("total_outflow", total_outflow)
+        if trace:
+            flow_point.field("trace_origin", trace["origin"]).field("trace_monitor", hop_time(trace, "monitor"))
+        points.append(flow_point.time(timestamp))
+
+        flows = {
+            "total_inflow": total_inflow,
+            "total_outflow": total_outflow,
+            "timestamp": flow_timestamp
+        }
+        if trace:
+            flows["trace"] = trace
+        return points, flows
+
+    def stats(self):
+        """
+        Statistiche mobili dei sensori: punti InfluxDB e riepilogo da pubblicare, con un avviso
+        per i sensori bloccati. None se la diga non ha ancora sensori.
+        :return: Tupla (punti, stats) oppure None.
+        """
+        summary = self.stats_summary()
+        if not summary:
+            return None
+        points = stats_points(self.dam_id, summary, STATS_DATA, DAM_TAG, SENSOR_TAG, time.strftime("%Y-%m-%dT%H:%M:%SZ"))
+        stuck = [sensor_id for sensor_id, stats in summary.items() if stats["stuck"]]
+        if stuck:
+            print(f"MONITOR: Sensors with a stuck value ({self.dam_id}): {', '.join(stuck)}")
+        return points, {"timestamp": time.time(), "sensors": summary}
+
+    def update_stats(self, sensor_id, value):
+        """Aggiunge il campione alle statistiche mobili del sensore (i valori non numerici sono ignorati)."""
+        try:
+            value = float(value)
+        except (TypeError, ValueError):
+            return
+        stats = self.sensor_stats.get(sensor_id)
+        if stats is None:
+            stats = self.sensor_stats[sensor_id] = SensorStats()
+        stats.add(value)
+
+    def stats_summary(self):
+        """Statistiche mobili di tutti i sensori attivi."""
+        return {sensor_id: stats.summary() for sensor_id, stats in self.sensor_stats.items()}
+
+    def remove_inactive_sensors(self, max_age=60):
+        """Rimuove i sensori che non pubblicano da più di max_age secondi."""
+        current_time = time.time()
+        for sensor_id, last_update in list(self.sensor_last_update.items()):
+            if current_time - last_update > max_age:
+                self.sensor_data.pop(sensor_id, None)
+                self.sensor_last_update.pop(sensor_id, None)
+                self.sensor_traces.pop(sensor_id, None)
+                self.sensor_stats.pop(sensor_id, None)
+
+
+def stats_points(dam_id, summary, measurement, dam_tag, sensor_tag, timestamp):
+    """Punti InfluxDB delle statistiche mobili: uno per sensore e finestra (tag window: campioni della finestra)."""
+    points = []
+    for sensor_id, stats in summary.items():
+        for window, values in stats["windows"].items():
+            point = Point(measurement) \
+                .tag(dam_tag, dam_id) \
+                .tag(sensor_tag, sensor_id) \
+                .tag("window", window) \
+                .field("ewma", float(stats["ewma"])) \
+                .field("stuck", bool(stats["stuck"]))
+            for name, value in values.items():
+                point = point.field(name, float(value))
+            points.append(point.time(timestamp))
+    return points
+
+
+def manage_dams(dam_ids):
+    """Stato isolato per ogni diga gestita dal processo."""
+    return {dam_id: DamFlowState(dam_id) for dam_id in dam_ids}
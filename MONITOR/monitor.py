@@ -3,41 +3,19 @@ import json
 import time
 import threading
 import paho.mqtt.client as mqtt  # type: ignore
-from dotenv import load_dotenv  # type: ignore
-from influxdb_client import InfluxDBClient, Point, WriteOptions  # type: ignore
-
-# Carica le variabili dal file .env
-load_dotenv()
-
-DAM_UNIQUE_ID = os.getenv("DAM_UNIQUE_ID")
-# Topic dinamici
-SENSORS_TOPIC_PREFIX = os.getenv("SENSORS_TOPIC_PREFIX")
-GATE_TOPIC_PREFIX = os.getenv("GATE_TOPIC_PREFIX")
-# Parametri MQTT
-
-MQTT_BROKER = os.getenv("MQTT_BROKER")
-MQTT_PORT = int(os.getenv("MQTT_PORT"))
-MQTT_USER = os.getenv("MQTT_USER")
-MQTT_PASSWORD = os.getenv("MQTT_PASSWORD")
-
-INFLUXDB_URL = os.getenv("INFLUXDB_URL")
-INFLUXDB_TOKEN = os.getenv("INFLUXDB_TOKEN")
-INFLUXDB_ORG = os.getenv("DOCKER_INFLUXDB_INIT_ORG")
-INFLUXDB_BUCKET = os.getenv("DOCKER_INFLUXDB_INIT_BUCKET")
-
-BUCKET_SENSOR_DATA=os.getenv("BUCKET_SENSOR_DATA")
-BUCKET_GATE_DATA=os.getenv("BUCKET_GATE_DATA")
-BUCKET_FLOWS_DATA=os.getenv("BUCKET_FLOWS_DATA")
-SENSOR_TAG =os.getenv("SENSOR_TAG")
-SENSOR_FIELD =os.getenv("SENSOR_FIELD")
-GATE_TAG =os.getenv("GATE_TAG")
-GATE_FIELD_STATE =os.getenv("GATE_FIELD_STATE")
-GATE_FIELD_FLOW =os.getenv("GATE_FIELD_FLOW")
-GATE_OUTFLOW = float(os.getenv("GATE_OUTFLOW")) 
-TIMESTAMP =os.getenv("TIMESTAMP")
-
-POWER_GATE_ID = os.getenv("POWER_GATE_ID")
-POWER_GATE_OUTFLOW = float(os.getenv("POWER_GATE_OUTFLOW"))
+from influxdb_client import InfluxDBClient, WriteOptions  # type: ignore
+from telemetry import METRICS_PORT, count_message, start_metrics_server
+from tenancy import configured_dam_ids, configured_shards, dam_from_topic, run_sharded, shard_client_id, shard_metrics_port
+from monitor_config import (FLOWS_TOPIC_PREFIX, GATE_TOPIC_PREFIX, INFLUXDB_BUCKET, INFLUXDB_ORG, INFLUXDB_TOKEN,
+                            INFLUXDB_URL, MQTT_BROKER, MQTT_PASSWORD, MQTT_PORT, MQTT_USER, SENSORS_TOPIC_PREFIX,
+                            STATS_INTERVAL, STATS_TOPIC_PREFIX)
+from flow_state import manage_dams
+
+# Dighe gestite (DAM_UNIQUE_IDS) e processi worker tra cui dividerle (DAM_SHARDS)
+DAM_UNIQUE_IDS = configured_dam_ids()
+DAM_SHARDS = configured_shards()
+# Modalità di ingestione: "thread" (storica) o "async" (monitor_async.py)
+MONITOR_INGESTION_MODE = os.getenv("MONITOR_INGESTION_MODE", "thread")
 
 # Configurazione client InfluxDB
 client = InfluxDBClient(
@@ -58,9 +36,7 @@ write_api = client.write_api(
 
 # Stato del client MQTT
 is_connected = False
-sensor_data = {}
-sensor_last_update = {}  
-gate_states = {}
+dams = {}  # Stato isolato di ogni diga dello shard (DamFlowState)
 data_lock = threading.Lock()
 
 
@@ -75,12 +51,13 @@ def on_connect(client, userdata, flags, rc):
         print("MONITOR: Connected to MQTT Broker!")
         is_connected = True
 
-        # Sottoscrivi ai topic dinamici
-        sensor_topic = f"{DAM_UNIQUE_ID}/{SENSORS_TOPIC_PREFIX}/#"
-        gate_topic = f"{DAM_UNIQUE_ID}/{GATE_TOPIC_PREFIX}/#"
-        client.subscribe(sensor_topic, qos=2)
-        client.subscribe(gate_topic, qos=2)
-        print(f"MONITOR: Subscribed to {sensor_topic} and {gate_topic}")
+        # Sottoscrivi ai topic dinamici di ogni diga gestita
+        for dam_id in dams:
+            sensor_topic = f"{dam_id}/{SENSORS_TOPIC_PREFIX}/#"
+            gate_topic = f"{dam_id}/{GATE_TOPIC_PREFIX}/#"
+            client.subscribe(sensor_topic, qos=2)
+            client.subscribe(gate_topic, qos=2)
+            print(f"MONITOR: Subscribed to {sensor_topic} and {gate_topic}")
     else:
         print(f"MONITOR: Failed to connect, return code {rc}")
 
@@ -91,8 +68,10 @@ def on_disconnect(client, userdata, rc):
     is_connected = False
 
 def on_message(client, userdata, msg):
-    global sensor_data, gate_states
     topic = msg.topic
+    dam = dams.get(dam_from_topic(topic))
+    if dam is None:
+        return
     try:
         payload = json.loads(msg.payload)
     except json.JSONDecodeError:
@@ -100,84 +79,50 @@ def on_message(client, userdata, msg):
         return
 
     with data_lock:
-        if topic.startswith(f"{DAM_UNIQUE_ID}/{SENSORS_TOPIC_PREFIX}"):
+        if topic.startswith(f"{dam.dam_id}/{SENSORS_TOPIC_PREFIX}"):
             sensor_id = topic.split("/")[-1]
-            sensor_data[sensor_id] = payload.get(SENSOR_FIELD, 0)
-            sensor_last_update[sensor_id] = time.time()
+            point = dam.record_sensor(sensor_id, payload)
+            count_message("monitor", "sensor")
             try:
-                point = Point(f"{BUCKET_SENSOR_DATA}") \
-                    .tag(f"{SENSOR_TAG}", sensor_id) \
-                    .field(f"{SENSOR_FIELD}", payload.get(f"{SENSOR_FIELD}", 0)) \
-                    .time(payload.get(f"{TIMESTAMP}", time.strftime("%Y-%m-%dT%H:%M:%SZ")))
                 write_api.write(bucket=INFLUXDB_BUCKET, record=point)
             except Exception as e:
                 print(f"MONITOR: Error writing sensor data to InfluxDB for {sensor_id}: {e}")
 
-        elif topic.startswith(f"{DAM_UNIQUE_ID}/{GATE_TOPIC_PREFIX}"):
+        elif topic.startswith(f"{dam.dam_id}/{GATE_TOPIC_PREFIX}"):
             gate_id = topic.split("/")[-2]
-            open_percentage = payload.get("open_percentage", 0)
-            #open_percentage_v = validate_percentage(open_percentage, 0, 100)
-            # Aggiorna lo stato del gate (senza calcolare l'outflow)
-            gate_states[gate_id] = {
-                "open_percentage": open_percentage
-            }
+            point = dam.record_gate(gate_id, payload)
+            count_message("monitor", "gate")
             try:
                 # Scrive solo la percentuale di apertura su InfluxDB
-                point = Point(f"{BUCKET_GATE_DATA}") \
-                    .tag(f"{GATE_TAG}", gate_id) \
-                    .field(f"{GATE_FIELD_STATE}", float(open_percentage)) \
-                    .time(payload.get(f"{TIMESTAMP}", time.strftime("%Y-%m-%dT%H:%M:%SZ")))
                 write_api.write(bucket=INFLUXDB_BUCKET, record=point)
             except Exception as e:
                 print(f"MONITOR: Error writing gate state to InfluxDB for {gate_id}: {e}")
 
 def remove_inactive_sensors():
-    """Rimuove i sensori inattivi dallo stato."""
-    global sensor_data, sensor_last_update
+    """Rimuove i sensori inattivi dallo stato di ogni diga."""
     with data_lock:
-        current_time = time.time()
-        for sensor_id, last_update in list(sensor_last_update.items()):
-            if current_time - last_update > 60:
-                sensor_data.pop(sensor_id, None)
-                sensor_last_update.pop(sensor_id, None)        
-
-def calculate_and_write_global_flow():
-    """Calcola e scrive il flusso globale e i flussi specifici di ogni gate su InfluxDB."""
+        for dam in dams.values():
+            dam.remove_inactive_sensors()
+
+def calculate_and_write_global_flow(mqtt_client):
+    """Calcola e scrive il flusso globale e i flussi specifici di ogni gate su InfluxDB, per ogni diga."""
     counter = 0  # Contatore per eseguire la pulizia ogni 20 iterazioni
+    last_stats = time.time()
     while True:
+        points = []  # Per raccogliere tutti i dati (di tutte le dighe) da scrivere in un batch
+        for dam in list(dams.values()):
+            try:
+                publish_dam_flows(mqtt_client, dam, points)
+            except Exception as e:
+                print(f"MONITOR: Error computing flows for {dam.dam_id}: {e}")
+        if time.time() - last_stats >= STATS_INTERVAL:
+            last_stats = time.time()
+            for dam in list(dams.values()):
+                try:
+                    publish_dam_stats(mqtt_client, dam, points)
+                except Exception as e:
+                    print(f"MONITOR: Error computing sensor statistics for {dam.dam_id}: {e}")
         try:
-            points = []  # Per raccogliere tutti i dati da scrivere in un batch
-            with data_lock:
-                total_inflow = float(sum(sensor_data.values()))  # Somma gli inflow
-                print(f"sensor_data: {sensor_data}")
-                total_outflow = 0.0  # Inizializza il totale dell'outflow
-
-                # Calcola i flussi specifici di ogni gate e li aggiunge al batch
-                for gate_id, gate_data in gate_states.items():
-                    if str(gate_id) == str(POWER_GATE_ID):
-                        gate_outflow = (gate_data.get("open_percentage", 0) / 100) * POWER_GATE_OUTFLOW
-                    else:
-                        gate_outflow = (gate_data.get("open_percentage", 0) / 100) * GATE_OUTFLOW
-
-                    # Aggiungi al batch il flusso specifico del gate
-                    points.append(
-                        Point(f"{BUCKET_SENSOR_DATA}")
-                        .tag(f"{GATE_TAG}", gate_id)
-                        .field(f"{GATE_FIELD_FLOW}", gate_outflow)
-                        .time(time.strftime("%Y-%m-%dT%H:%M:%SZ"))
-                    )
-
-                    # Somma l'outflow corrente al totale
-                    total_outflow += gate_outflow
-
-                # Aggiungi al batch i flussi globali
-                points.append(
-                    Point(f"{BUCKET_FLOWS_DATA}")
-                    .field("total_inflow", total_inflow)
-                    .field("total_outflow", total_outflow)
-                    .time(time.strftime("%Y-%m-%dT%H:%M:%SZ"))
-                )
-
             # Scrivi tutti i punti in un unico batch
             write_api.write(bucket=INFLUXDB_BUCKET, record=points)
             #print("MONITOR: Written global flow and individual gate flows to InfluxDB")
@@ -193,6 +138,27 @@ def calculate_and_write_global_flow():
         time.sleep(1)
 
 
+def publish_dam_flows(mqtt_client, dam, points):
+    """Calcola le portate di una diga, aggiunge i punti al batch e le pubblica per l'ANALYZER."""
+    with data_lock:
+        print(f"sensor_data ({dam.dam_id}): {dam.sensor_data}")
+        flow_points, flows = dam.flows()
+    points.extend(flow_points)
+    # Pubblica le portate globali per l'integrazione del volume nell'ANALYZER
+    mqtt_client.publish(f"{dam.dam_id}/{FLOWS_TOPIC_PREFIX}", json.dumps(flows), qos=0)
+
+
+def publish_dam_stats(mqtt_client, dam, points):
+    """Aggiunge al batch le statistiche mobili dei sensori della diga e le pubblica come riepilogo."""
+    with data_lock:
+        result = dam.stats()
+    if result is None:
+        return
+    stats_points, stats = result
+    points.extend(stats_points)
+    mqtt_client.publish(f"{dam.dam_id}/{STATS_TOPIC_PREFIX}", json.dumps(stats), qos=0)
+
+
 def reconnect(client):
     """Gestisce i tentativi di riconnessione al broker."""
     global is_connected
@@ -206,18 +172,26 @@ def reconnect(client):
             print(f"MONITOR: Reconnection failed: {e}")
             time.sleep(5)
 
-if __name__ == "__main__":
-    client = mqtt.Client("Monitor")
-    client.username_pw_set(MQTT_USER, MQTT_PASSWORD)
-    client.on_connect = on_connect
-    client.on_disconnect = on_disconnect
-    client.on_message = on_message
+def run_monitor(dam_ids):
+    """Worker di uno shard: una connessione MQTT e un client InfluxDB per tutte le dighe indicate."""
+    if MONITOR_INGESTION_MODE == "async":
+        import monitor_async
+        monitor_async.main(dam_ids)
+        return
+
+    dams.update(manage_dams(dam_ids))
+    start_metrics_server(shard_metrics_port(METRICS_PORT))
+    mqtt_client = mqtt.Client(shard_client_id("Monitor"))
+    mqtt_client.username_pw_set(MQTT_USER, MQTT_PASSWORD)
+    mqtt_client.on_connect = on_connect
+    mqtt_client.on_disconnect = on_disconnect
+    mqtt_client.on_message = on_message
 
     try:
-        threading.Thread(target=calculate_and_write_global_flow, daemon=True).start()
+        threading.Thread(target=calculate_and_write_global_flow, args=(mqtt_client,), daemon=True).start()
 
-        reconnect(client)
-        print("MONITOR: Processing messages...")
+        reconnect(mqtt_client)
+        print(f"MONITOR: Processing messages for {len(dams)} dams...")
         while True:
             time.sleep(1)
     except KeyboardInterrupt:
@@ -225,9 +199,13 @@ if __name__ == "__main__":
     except Exception as e:
         print(f"MONITOR: Critical error: {e}")
     finally:
-        client.loop_stop()
-        client.disconnect()
+        mqtt_client.loop_stop()
+        mqtt_client.disconnect()
         if write_api:
             write_api.__del__()
         client.close()
         print("MONITOR: Resources released.")
+
+
+if __name__ == "__main__":
+    raise SystemExit(run_sharded(run_monitor, DAM_UNIQUE_IDS, DAM_SHARDS))
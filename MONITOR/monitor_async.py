@@ -0,0 +1,349 @@
+import os
+import json
+import time
+import asyncio
+from collections import deque
+import paho.mqtt.client as mqtt  # type: ignore
+from influxdb_client import Point  # type: ignore
+from influxdb_client.client.influxdb_client_async import InfluxDBClientAsync  # type: ignore
+from telemetry import METRICS_PORT, count_message, registry, start_metrics_server
+from tenancy import configured_dam_ids, dam_from_topic, shard_client_id, shard_metrics_port
+from monitor_config import (FLOWS_TOPIC_PREFIX, GATE_TOPIC_PREFIX, INFLUXDB_BUCKET, INFLUXDB_ORG, INFLUXDB_TOKEN,
+                            INFLUXDB_URL, MQTT_BROKER, MQTT_PASSWORD, MQTT_PORT, MQTT_USER, SENSORS_TOPIC_PREFIX,
+                            STATS_INTERVAL, STATS_TOPIC_PREFIX)
+from flow_state import manage_dams
+
+# Parametri della pipeline asincrona
+WRITE_QUEUE_SIZE = int(os.getenv("MONITOR_WRITE_QUEUE_SIZE", 10000))    # Punti in attesa di scrittura
+WRITE_BATCH_SIZE = int(os.getenv("MONITOR_WRITE_BATCH_SIZE", 500))      # Punti per singola scrittura
+WRITE_FLUSH_INTERVAL = float(os.getenv("MONITOR_WRITE_FLUSH_INTERVAL", 1.0))  # Attesa massima di un batch (s)
+METRICS_INTERVAL = float(os.getenv("MONITOR_METRICS_INTERVAL", 10))    # Periodo dei log/metriche (s)
+METRICS_DATA = os.getenv("MONITOR_METRICS_DATA", "monitor_metrics")
+
+QUEUE_DEPTH = registry.gauge("monitor_write_queue_depth", "Punti in attesa di scrittura su InfluxDB")
+INGEST_LATENCY = registry.histogram(
+    "monitor_ingest_latency_seconds", "Latenza dall'arrivo del messaggio alla scrittura su InfluxDB")
+DROPPED_POINTS = registry.counter("monitor_dropped_points_total", "Punti scartati per coda piena")
+
+
+class IngestionMetrics:
+    """Profondità della coda e latenze end-to-end (arrivo del messaggio -> scrittura su InfluxDB)."""
+
+    def __init__(self, history=2000):
+        self.received = 0
+        self.written = 0
+        self.dropped = 0
+        self.write_errors = 0
+        self.max_queue_depth = 0
+        self.latencies = deque(maxlen=history)        # Latenze end-to-end dei punti scritti (s)
+        self.write_durations = deque(maxlen=history)  # Durata delle singole scritture batch (s)
+
+    def observe_queue(self, depth):
+        self.max_queue_depth = max(self.max_queue_depth, depth)
+
+    def snapshot(self, queue_depth):
+        """Restituisce le metriche correnti (latenze in ms) e azzera il massimo della coda."""
+        latencies = sorted(self.latencies)
+        durations = list(self.write_durations)
+
+        def percentile(values, fraction):
+            return values[min(len(values) - 1, int(fraction * len(values)))] * 1000 if values else 0.0
+
+        metrics = {
+            "queue_depth": queue_depth,
+            "max_queue_depth": self.max_queue_depth,
+            "received": self.received,
+            "written": self.written,
+            "dropped": self.dropped,
+            "write_errors": self.write_errors,
+            "latency_p50_ms": percentile(latencies, 0.5),
+            "latency_p95_ms": percentile(latencies, 0.95),
+            "latency_max_ms": latencies[-1] * 1000 if latencies else 0.0,
+            "write_mean_ms": sum(durations) / len(durations) * 1000 if durations else 0.0,
+        }
+        self.max_queue_depth = queue_depth
+        return metrics
+
+
+class AsyncioMqttHelper:
+    """Collega il socket del client paho all'event loop asyncio (niente thread di rete)."""
+
+    def __init__(self, loop, client):
+        self.loop = loop
+        self.client = client
+        self.misc_task = None
+        client.on_socket_open = self.on_socket_open
+        client.on_socket_close = self.on_socket_close
+        client.on_socket_register_write = self.on_socket_register_write
+        client.on_socket_unregister_write = self.on_socket_unregister_write
+
+    def call_in_loop(self, callback, *args):
+        """
+        Esegue la callback nel thread dell'event loop: paho invoca le callback dei socket anche dal
+        thread di client.connect (run_in_executor), e add_reader/add_writer/create_task non sono thread-safe.
+        """
+        try:
+            in_loop = asyncio.get_running_loop() is self.loop
+        except RuntimeError:
+            in_loop = False
+        if in_loop:
+            callback(*args)
+        else:
+            self.loop.call_soon_threadsafe(callback, *args)
+
+    def on_socket_open(self, client, userdata, sock):
+        self.call_in_loop(self.watch_socket, client, sock)
+
+    def on_socket_close(self, client, userdata, sock):
+        self.call_in_loop(self.unwatch_socket, sock)
+
+    def on_socket_register_write(self, client, userdata, sock):
+        self.call_in_loop(self.loop.add_writer, sock, client.loop_write)
+
+    def on_socket_unregister_write(self, client, userdata, sock):
+        self.call_in_loop(self.loop.remove_writer, sock)
+
+    def watch_socket(self, client, sock):
+        self.loop.add_reader(sock, client.loop_read)
+        self.misc_task = self.loop.create_task(self.misc_loop())
+
+    def unwatch_socket(self, sock):
+        self.loop.remove_reader(sock)
+        if self.misc_task:
+            self.misc_task.cancel()
+
+    async def misc_loop(self):
+        """Keepalive e ritrasmissioni QoS gestiti da loop_misc una volta al secondo."""
+        while self.client.loop_misc() == mqtt.MQTT_ERR_SUCCESS:
+            try:
+                await asyncio.sleep(1)
+            except asyncio.CancelledError:
+                break
+
+
+class AsyncMonitor:
+    """
+    MONITOR con ingestione asincrona: le callback MQTT aggiornano lo stato e accodano i punti
+    in una coda limitata, un unico writer li scrive su InfluxDB a batch senza bloccare la ricezione.
+    """
+
+    def __init__(self, dam_ids):
+        self.loop = None
+        self.queue = None
+        self.metrics = IngestionMetrics()
+        self.connected = None
+        self.disconnected = None
+        # Stato di ogni diga: modificato solo dal thread dell'event loop, quindi senza lock
+        self.dams = manage_dams(dam_ids)
+        self.client = mqtt.Client(shard_client_id("Monitor"))
+        self.client.username_pw_set(MQTT_USER, MQTT_PASSWORD)
+        self.client.on_connect = self.on_connect
+        self.client.on_disconnect = self.on_disconnect
+        self.client.on_message = self.on_message
+
+    def on_connect(self, client, userdata, flags, rc):
+        """Callback per la connessione al broker."""
+        if rc == 0:
+            print("MONITOR: Connected to MQTT Broker!")
+            self.disconnected.clear()
+            self.connected.set()
+
+            # Sottoscrivi ai topic dinamici di ogni diga gestita
+            for dam_id in self.dams:
+                sensor_topic = f"{dam_id}/{SENSORS_TOPIC_PREFIX}/#"
+                gate_topic = f"{dam_id}/{GATE_TOPIC_PREFIX}/#"
+                client.subscribe(sensor_topic, qos=2)
+                client.subscribe(gate_topic, qos=2)
+                print(f"MONITOR: Subscribed to {sensor_topic} and {gate_topic}")
+        else:
+            print(f"MONITOR: Failed to connect, return code {rc}")
+
+    def on_disconnect(self, client, userdata, rc):
+        """Callback per la disconnessione dal broker."""
+        print("MONITOR: Disconnected from MQTT Broker.")
+        self.connected.clear()
+        self.disconnected.set()
+
+    def enqueue(self, point, received_at):
+        """Accoda un punto per il writer; se la coda è piena il punto più vecchio viene scartato."""
+        if self.queue.full():
+            self.queue.get_nowait()
+            self.metrics.dropped += 1
+            DROPPED_POINTS.inc()
+        self.queue.put_nowait((received_at, point))
+        self.metrics.observe_queue(self.queue.qsize())
+
+    def on_message(self, client, userdata, msg):
+        """Aggiorna lo stato in memoria e accoda il punto: nessuna I/O verso InfluxDB qui."""
+        received_at = time.monotonic()
+        self.metrics.received += 1
+        topic = msg.topic
+        dam = self.dams.get(dam_from_topic(topic))
+        if dam is None:
+            return
+        try:
+            payload = json.loads(msg.payload)
+        except json.JSONDecodeError:
+            print(f"MONITOR: Invalid JSON payload on topic {topic}")
+            return
+
+        try:
+            if topic.startswith(f"{dam.dam_id}/{SENSORS_TOPIC_PREFIX}"):
+                point = dam.record_sensor(topic.split("/")[-1], payload)
+                count_message("monitor", "sensor")
+                self.enqueue(point, received_at)
+
+            elif topic.startswith(f"{dam.dam_id}/{GATE_TOPIC_PREFIX}"):
+                # Scrive solo la percentuale di apertura su InfluxDB
+                point = dam.record_gate(topic.split("/")[-2], payload)
+                count_message("monitor", "gate")
+                self.enqueue(point, received_at)
+        except Exception as e:
+            print(f"MONITOR: Error processing message on topic {topic}: {e}")
+
+    async def writer(self, write_api):
+        """Svuota la coda a batch (fino a WRITE_BATCH_SIZE punti o WRITE_FLUSH_INTERVAL secondi)."""
+        while True:
+            batch = [await self.queue.get()]
+            deadline = self.loop.time() + WRITE_FLUSH_INTERVAL
+            while len(batch) < WRITE_BATCH_SIZE:
+                if self.queue.empty():
+                    timeout = deadline - self.loop.time()
+                    if timeout <= 0:
+                        break
+                    try:
+                        batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                    except asyncio.TimeoutError:
+                        break
+                else:
+                    batch.append(self.queue.get_nowait())
+
+            start = time.monotonic()
+            try:
+                await write_api.write(bucket=INFLUXDB_BUCKET, record=[point for _, point in batch])
+            except Exception as e:
+                self.metrics.write_errors += 1
+                print(f"MONITOR: Error writing {len(batch)} points to InfluxDB: {e}")
+                continue
+            written_at = time.monotonic()
+            self.metrics.write_durations.append(written_at - start)
+            for received_at, _ in batch:
+                self.metrics.latencies.append(written_at - received_at)
+                INGEST_LATENCY.observe(written_at - received_at)
+            QUEUE_DEPTH.set(self.queue.qsize())
+            self.metrics.written += len(batch)
+
+    async def global_flow_loop(self):
+        """Calcola ogni secondo, per ogni diga, il flusso globale e quello di ogni gate, li accoda e li pubblica."""
+        counter = 0  # Contatore per eseguire la pulizia ogni 20 iterazioni
+        while True:
+            for dam in self.dams.values():
+                try:
+                    self.publish_dam_flows(dam)
+                except Exception as e:
+                    print(f"MONITOR: Error computing flows for {dam.dam_id}: {e}")
+
+            counter += 1
+            if counter >= 20:  # Esegue la pulizia ogni 20 iterazioni (~20 secondi)
+                for dam in self.dams.values():
+                    dam.remove_inactive_sensors()
+                counter = 0
+
+            await asyncio.sleep(1)
+
+    def publish_dam_flows(self, dam):
+        """Calcola le portate di una diga, accoda i punti e le pubblica per l'ANALYZER."""
+        received_at = time.monotonic()
+        points, flows = dam.flows()
+        for point in points:
+            self.enqueue(point, received_at)
+        # Pubblica le portate globali per l'integrazione del volume nell'ANALYZER
+        self.client.publish(f"{dam.dam_id}/{FLOWS_TOPIC_PREFIX}", json.dumps(flows), qos=0)
+
+    async def stats_loop(self):
+        """Ogni STATS_INTERVAL secondi accoda e pubblica le statistiche mobili dei sensori di ogni diga."""
+        while True:
+            await asyncio.sleep(STATS_INTERVAL)
+            for dam in self.dams.values():
+                try:
+                    self.publish_dam_stats(dam)
+                except Exception as e:
+                    print(f"MONITOR: Error computing sensor statistics for {dam.dam_id}: {e}")
+
+    def publish_dam_stats(self, dam):
+        """Accoda le statistiche mobili dei sensori della diga e le pubblica come riepilogo."""
+        result = dam.stats()
+        if result is None:
+            return
+        received_at = time.monotonic()
+        points, stats = result
+        for point in points:
+            self.enqueue(point, received_at)
+        self.client.publish(f"{dam.dam_id}/{STATS_TOPIC_PREFIX}", json.dumps(stats), qos=0)
+
+    async def metrics_loop(self):
+        """Stampa e scrive su InfluxDB profondità della coda e latenze di scrittura."""
+        while True:
+            await asyncio.sleep(METRICS_INTERVAL)
+            metrics = self.metrics.snapshot(self.queue.qsize())
+            QUEUE_DEPTH.set(metrics["queue_depth"])
+            print(
+                f"MONITOR: queue={metrics['queue_depth']} (max {metrics['max_queue_depth']}), "
+                f"received={metrics['received']}, written={metrics['written']}, dropped={metrics['dropped']}, "
+                f"latency p50={metrics['latency_p50_ms']:.1f} ms p95={metrics['latency_p95_ms']:.1f} ms, "
+                f"write={metrics['write_mean_ms']:.1f} ms"
+            )
+            point = Point(METRICS_DATA).tag("mode", "async")
+            for name, value in metrics.items():
+                point = point.field(name, float(value))
+            self.enqueue(point.time(time.strftime("%Y-%m-%dT%H:%M:%SZ")), time.monotonic())
+
+    async def mqtt_loop(self):
+        """Connessione al broker e riconnessione quando cade."""
+        while True:
+            try:
+                print("MONITOR: Attempting to connect to MQTT Broker...")
+                # La connect TCP è bloccante: viene eseguita fuori dall'event loop
+                # (le callback dei socket tornano nel loop tramite AsyncioMqttHelper.call_in_loop)
+                await self.loop.run_in_executor(None, self.client.connect, MQTT_BROKER, MQTT_PORT, 3600)
+                await self.disconnected.wait()
+            except Exception as e:
+                print(f"MONITOR: Reconnection failed: {e}")
+            await asyncio.sleep(5)
+
+    async def run(self):
+        self.loop = asyncio.get_running_loop()
+        self.queue = asyncio.Queue(maxsize=WRITE_QUEUE_SIZE)
+        self.connected = asyncio.Event()
+        self.disconnected = asyncio.Event()
+        AsyncioMqttHelper(self.loop, self.client)
+
+        async with InfluxDBClientAsync(url=INFLUXDB_URL, token=INFLUXDB_TOKEN, org=INFLUXDB_ORG) as influx:
+            tasks = [
+                asyncio.create_task(self.writer(influx.write_api())),
+                asyncio.create_task(self.global_flow_loop()),
+                asyncio.create_task(self.stats_loop()),
+                asyncio.create_task(self.metrics_loop()),
+                asyncio.create_task(self.mqtt_loop()),
+            ]
+            print(f"MONITOR: Processing messages for {len(self.dams)} dams (async ingestion)...")
+            try:
+                await asyncio.gather(*tasks)
+            finally:
+                for task in tasks:
+                    task.cancel()
+                self.client.disconnect()
+
+
+def main(dam_ids=None):
+    start_metrics_server(shard_metrics_port(METRICS_PORT))
+    try:
+        asyncio.run(AsyncMonitor(dam_ids or configured_dam_ids()).run())
+    except KeyboardInterrupt:
+        print("MONITOR: Shutting down gracefully.")
+    finally:
+        print("MONITOR: Resources released.")
+
+
+if __name__ == "__main__":
+    main()
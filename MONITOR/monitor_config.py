@@ -0,0 +1,41 @@
+import os
+from dotenv import load_dotenv  # type: ignore
+
+# Configurazione comune alle due modalità di ingestione del MONITOR (monitor.py e monitor_async.py)
+load_dotenv()
+
+DAM_UNIQUE_ID = os.getenv("DAM_UNIQUE_ID")
+# Topic dinamici
+SENSORS_TOPIC_PREFIX = os.getenv("SENSORS_TOPIC_PREFIX")
+GATE_TOPIC_PREFIX = os.getenv("GATE_TOPIC_PREFIX")
+FLOWS_TOPIC_PREFIX = os.getenv("FLOWS_TOPIC_PREFIX", "monitor/flows")
+STATS_TOPIC_PREFIX = os.getenv("STATS_TOPIC_PREFIX", "monitor/stats")
+# Parametri MQTT
+
+MQTT_BROKER = os.getenv("MQTT_BROKER")
+MQTT_PORT = int(os.getenv("MQTT_PORT"))
+MQTT_USER = os.getenv("MQTT_USER")
+MQTT_PASSWORD = os.getenv("MQTT_PASSWORD")
+
+INFLUXDB_URL = os.getenv("INFLUXDB_URL")
+INFLUXDB_TOKEN = os.getenv("INFLUXDB_TOKEN")
+INFLUXDB_ORG = os.getenv("DOCKER_INFLUXDB_INIT_ORG")
+INFLUXDB_BUCKET = os.getenv("DOCKER_INFLUXDB_INIT_BUCKET")
+
+BUCKET_SENSOR_DATA=os.getenv("BUCKET_SENSOR_DATA")
+BUCKET_GATE_DATA=os.getenv("BUCKET_GATE_DATA")
+BUCKET_FLOWS_DATA=os.getenv("BUCKET_FLOWS_DATA")
+SENSOR_TAG =os.getenv("SENSOR_TAG")
+SENSOR_FIELD =os.getenv("SENSOR_FIELD")
+GATE_TAG =os.getenv("GATE_TAG")
+GATE_FIELD_STATE =os.getenv("GATE_FIELD_STATE")
+GATE_FIELD_FLOW =os.getenv("GATE_FIELD_FLOW")
+GATE_OUTFLOW = float(os.getenv("GATE_OUTFLOW"))
+TIMESTAMP =os.getenv("TIMESTAMP")
+
+POWER_GATE_ID = os.getenv("POWER_GATE_ID")
+POWER_GATE_OUTFLOW = float(os.getenv("POWER_GATE_OUTFLOW"))
+
+# Statistiche mobili dei sensori (rolling_stats.py): periodo di pubblicazione (s) e misura InfluxDB
+STATS_INTERVAL = float(os.getenv("MONITOR_STATS_INTERVAL", 10))
+STATS_DATA = os.getenv("MONITOR_STATS_DATA", "sensor_stats")
@@ -0,0 +1,118 @@
+import os
+import math
+from collections import deque
+import numpy as np  # type: ignore
+
+# Finestre in numero di campioni: con SENSORS_PUBLISH_DELAY=1 circa 1 e 10 minuti
+STATS_WINDOWS = tuple(int(size) for size in os.getenv("MONITOR_STATS_WINDOWS", "60,600").split(",") if size.strip())
+STATS_EWMA_ALPHA = float(os.getenv("MONITOR_STATS_EWMA_ALPHA", 0.1))      # Peso del nuovo campione nella EWMA
+STATS_STUCK_SAMPLES = int(os.getenv("MONITOR_STATS_STUCK_SAMPLES", 30))  # Campioni identici di un sensore bloccato
+# Valori che un sensore può legittimamente ripetere (es. 0 della pompa solare di notte): mai segnalati come bloccati
+STATS_STUCK_IGNORE = tuple(float(value) for value in os.getenv("MONITOR_STATS_STUCK_IGNORE", "0").split(",") if value.strip())
+
+
+class RollingWindow:
+    """
+    Statistiche degli ultimi 'size' campioni su un ring buffer NumPy di dimensione fissa.
+    Media e varianza si aggiornano in O(1) (Welford, togliendo il campione che esce dalla finestra,
+    con un ricalcolo esatto a ogni giro del buffer); minimo e massimo con code monotone
+    (O(1) ammortizzato, al più 'size' elementi).
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.values = np.zeros(size)
+        self.count = 0          # Campioni nella finestra (al più size)
+        self.position = 0       # Prossima cella del buffer da scrivere
+        self.sequence = 0       # Numero progressivo del prossimo campione
+        self.mean = 0.0
+        self.m2 = 0.0           # Somma dei quadrati degli scarti dalla media
+        self.minima = deque()   # (progressivo, valore) con valori crescenti: il primo è il minimo
+        self.maxima = deque()   # (progressivo, valore) con valori decrescenti: il primo è il massimo
+
+    def add(self, value):
+        if self.count < self.size:
+            self.count += 1
+            delta = value - self.mean
+            self.mean += delta / self.count
+            self.m2 += delta * (value - self.mean)
+        else:
+            old = float(self.values[self.position])
+            old_mean = self.mean
+            self.mean += (value - old) / self.size
+            self.m2 = max(0.0, self.m2 + (value - old) * (value - self.mean + old - old_mean))
+        self.values[self.position] = value
+        self.position = (self.position + 1) % self.size
+        if self.position == 0 and self.count == self.size:
+            # Ricalcolo esatto a ogni giro del buffer (O(1) ammortizzato): niente deriva numerica
+            self.mean = float(self.values.mean())
+            self.m2 = float(np.square(self.values - self.mean).sum())
+
+        expired = self.sequence - self.size  # Progressivo del campione appena uscito dalla finestra
+        while self.minima and self.minima[-1][1] >= value:
+            self.minima.pop()
+        self.minima.append((self.sequence, value))
+        if self.minima[0][0] <= expired:
+            self.minima.popleft()
+        while self.maxima and self.maxima[-1][1] <= value:
+            self.maxima.pop()
+        self.maxima.append((self.sequence, value))
+        if self.maxima[0][0] <= expired:
+            self.maxima.popleft()
+        self.sequence += 1
+
+    @property
+    def variance(self):
+        """Varianza campionaria della finestra (0 con meno di due campioni)."""
+        return self.m2 / (self.count - 1) if self.count > 1 else 0.0
+
+    def summary(self):
+        return {
+            "count": self.count,
+            "mean": self.mean,
+            "min": self.minima[0][1] if self.minima else 0.0,
+            "max": self.maxima[0][1] if self.maxima else 0.0,
+            "variance": self.variance,
+            "std": math.sqrt(self.variance),
+        }
+
+
+class SensorStats:
+    """Statistiche mobili di un sensore: una RollingWindow per finestra, EWMA e rilevamento dei valori bloccati."""
+
+    def __init__(self, windows=STATS_WINDOWS, alpha=STATS_EWMA_ALPHA, stuck_samples=STATS_STUCK_SAMPLES,
+                 stuck_ignore=STATS_STUCK_IGNORE):
+        self.windows = {size: RollingWindow(size) for size in windows}
+        self.alpha = alpha
+        self.stuck_samples = stuck_samples
+        self.stuck_ignore = stuck_ignore
+        self.samples = 0
+        self.last = None
+        self.ewma = None
+        self.repeats = 0  # Campioni consecutivi uguali all'ultimo valore
+
+    def add(self, value):
+        for window in self.windows.values():
+            window.add(value)
+        self.ewma = value if self.ewma is None else self.ewma + self.alpha * (value - self.ewma)
+        self.repeats = self.repeats + 1 if value == self.last else 0
+        self.last = value
+        self.samples += 1
+
+    @property
+    def stuck(self):
+        """
+        True se il sensore ha inviato lo stesso valore per almeno stuck_samples campioni (es. valore congelato).
+        I sensori reali applicano una variabilità casuale, quindi un valore ripetuto è sospetto, tranne quelli
+        in stuck_ignore che restano costanti per motivi fisici (la pompa solare invia 0 dalle 18:00 alle 06:00).
+        """
+        return self.last not in self.stuck_ignore and self.repeats + 1 >= self.stuck_samples
+
+    def summary(self):
+        return {
+            "samples": self.samples,
+            "last": self.last,
+            "ewma": self.ewma,
+            "stuck": self.stuck,
+            "windows": {str(size): window.summary() for size, window in self.windows.items()},
+        }
@@ -0,0 +1,107 @@
+import time
+import numpy as np  # type: ignore
+
+from forecast_index import ForecastIndex, load_published_index, read_index_version
+
+
+class ForecastHorizonCache:
+    """
+    Previsioni orarie di inflow in memoria per il planner, come ForecastIndex a somme prefisse:
+    la media su qualsiasi orizzonte costa una sottrazione, quindi aggiungere orizzonti è gratuito.
+    Se index_dir è configurata l'indice pubblicato dall'ANALYZER viene mappato in memoria senza copie,
+    altrimenti viene costruito da un'unica query su InfluxDB.
+    La cache si aggiorna solo quando l'ANALYZER pubblica una nuova versione della previsione.
+    """
+
+    def __init__(self, query_api, org, bucket, measurement, field="total_inflow",
+                 max_horizon_hours=180 * 24, max_age=3600, index_dir=None):
+        self.query_api = query_api
+        self.org = org
+        self.bucket = bucket
+        self.measurement = measurement
+        self.field = field
+        self.max_horizon_hours = max_horizon_hours
+        self.max_age = max_age            # Aggiornamento forzato se non arrivano versioni (s)
+        self.index_dir = index_dir        # Directory condivisa con l'indice pubblicato dall'ANALYZER
+        self.version = None               # Ultima versione pubblicata dall'ANALYZER
+        self.loaded_version = None        # Versione attualmente in cache
+        self.loaded_at = 0.0
+        self.index = None
+
+    def set_version(self, version):
+        """Registra la versione della previsione annunciata dall'ANALYZER."""
+        self.version = version
+
+    def needs_refresh(self, now=None):
+        """Indica se la cache va ricaricata (nuova versione, cache vuota o troppo vecchia)."""
+        now = time.time() if now is None else now
+        if self.index is None or self.loaded_version != self.version:
+            return True
+        return now - self.loaded_at > self.max_age
+
+    def refresh(self, now=None):
+        """Ricarica l'indice: dalla directory condivisa se disponibile, altrimenti da InfluxDB."""
+        now = time.time() if now is None else now
+        version = self.version
+        try:
+            if self.index_dir and read_index_version(self.index_dir) is not None:
+                index = load_published_index(self.index_dir)
+                # La versione dell'indice pubblicato prevale su quella annunciata via MQTT
+                version = index.version
+                if self.version is None:
+                    self.version = version
+                print(f"FORECAST CACHE: Mapped forecast index {version} ({index.hours} hours)")
+            else:
+                index = self.fetch_index(now, version)
+                print(f"FORECAST CACHE: Loaded {index.hours} hourly predictions (version {version})")
+            self.index = index
+            self.loaded_version = version
+            self.loaded_at = now
+        except Exception as e:
+            print(f"FORECAST CACHE: Error refreshing predictions: {e}")
+
+    def fetch_index(self, now, version=None):
+        """Legge con una sola query le previsioni orarie dell'orizzonte massimo (più un giorno di margine)."""
+        start_time = int(now) - 3600
+        end_time = int(now) + (self.max_horizon_hours + 24) * 3600
+        query = f'''
+        from(bucket: "{self.bucket}")
+            |> range(start: {start_time}, stop: {end_time})
+            |> filter(fn: (r) => r._measurement == "{self.measurement}")
+            |> filter(fn: (r) => r._field == "{self.field}")
+            |> keep(columns: ["_time", "_value"])
+            |> sort(columns: ["_time"])
+        '''
+        result = self.query_api.query(org=self.org, query=query)
+        rows = sorted(
+            (record.get_time().timestamp(), float(record.get_value()))
+            for table in result for record in table.records
+        )
+        return self.load(rows, version, now)
+
+    def load(self, rows, version=None, now=None):
+        """Carica una serie oraria contigua (timestamp, valore) ordinata come indice a somme prefisse."""
+        start = rows[0][0] if rows else 0.0
+        self.index = ForecastIndex.from_hourly(start, [value for _, value in rows], version)
+        self.loaded_version = version
+        self.loaded_at = time.time() if now is None else now
+        return self.index
+
+    def total(self, hours, now=None):
+        """Somma e numero di previsioni nella finestra [now, now + hours)."""
+        now = time.time() if now is None else now
+        if self.index is None:
+            return 0.0, 0
+        return self.index.total(now, hours)
+
+    def hourly(self, hours, now=None):
+        """Previsioni orarie (m³/s) della finestra [now, now + hours); array vuoto se la cache è vuota."""
+        now = time.time() if now is None else now
+        if self.index is None:
+            return np.zeros(0)
+        return self.index.hourly(now, hours)
+
+    def mean(self, hours, now=None):
+        """Media delle previsioni nella finestra [now, now + hours); 0 se la finestra è vuota."""
+        total, count = self.total(hours, now)
+        return total / count if count else 0
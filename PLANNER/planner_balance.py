@@ -1,15 +1,26 @@
 import os
 import time
 import json
+import queue
+import numpy as np  # type: ignore
 from influxdb_client import InfluxDBClient, QueryApi  # type: ignore
 from dotenv import load_dotenv  # type: ignore
 import paho.mqtt.client as mqtt  # type: ignore
+from state_snapshot import DamSnapshot, SnapshotReader
+from forecast_cache import ForecastHorizonCache
+from predictive_balance import PredictiveBalance
+from telemetry import METRICS_PORT, TRACE_KEY, count_message, extract_trace, record_hop, start_metrics_server
+from tenancy import (DAM_TAG, configured_dam_ids, configured_shards, dam_from_topic, multi_dam, run_sharded,
+                     shard_client_id, shard_metrics_port)
 
 # Carica le variabili dal file .env
 load_dotenv()
 
 # Variabili dal .env
 DAM_UNIQUE_ID = os.getenv("DAM_UNIQUE_ID")
+# Dighe gestite (DAM_UNIQUE_IDS) e processi worker tra cui dividerle (DAM_SHARDS)
+DAM_UNIQUE_IDS = configured_dam_ids()
+DAM_SHARDS = configured_shards()
 INFLUXDB_URL = os.getenv("INFLUXDB_URL")
 INFLUXDB_TOKEN = os.getenv("INFLUXDB_TOKEN")
 INFLUXDB_ORG = os.getenv("DOCKER_INFLUXDB_INIT_ORG")
@@ -24,6 +35,7 @@ GATE_TOPIC_PREFIX = os.getenv("GATE_TOPIC_PREFIX")
 POWER_GATE_ID = os.getenv("POWER_GATE_ID")
 SPILLWAY_GATE_COUNT = int(os.getenv("SPILLWAY_GATE_COUNT"))
 DAM_HEIGHT = float(os.getenv("DAM_HEIGHT"))
+DAM_TOTAL_VOLUME = float(os.getenv("DAM_TOTAL_VOLUME"))
 DAM_CRITICAL_HEIGHT = float(os.getenv("DAM_CRITICAL_HEIGHT"))
 DAM_MIN_HEIGHT  = float(os.getenv("DAM_MIN_HEIGHT"))
 QUERY_INTERVAL = int(os.getenv("QUERY_INTERVAL"))
@@ -32,19 +44,105 @@ VOLUME_SENSOR_DATA = os.getenv("VOLUME_SENSOR_DATA")
 VOLUME_FIELD = os.getenv("VOLUME_FIELD")
 HEIGHT_FIELD = os.getenv("HEIGHT_FIELD")
 POWER_GATE_OUTFLOW = float(os.getenv("POWER_GATE_OUTFLOW"))
+GATE_OUTFLOW = float(os.getenv("GATE_OUTFLOW"))
+# Controllo dello stato BALANCE: "fsm" (BalanceFSM) oppure "mpc" (PredictiveBalance, orizzonte mobile)
+BALANCE_MODE = os.getenv("BALANCE_MODE", "fsm").lower()
 BUCKET_PREDICTED_DATA = os.getenv("BUCKET_PREDICTED_DATA")
+FORECAST_TOPIC_PREFIX = os.getenv("FORECAST_TOPIC_PREFIX", "analyzer/forecast")
+FORECAST_INDEX_DIR = os.getenv("FORECAST_INDEX_DIR")  # Indice delle previsioni pubblicato dall'ANALYZER
+STATE_TOPIC_PREFIX = os.getenv("STATE_TOPIC_PREFIX", "analyzer/state")
+# "event": decide a ogni notifica di stato dell'ANALYZER; "poll": legge InfluxDB ogni QUERY_INTERVAL
+PLANNER_TRIGGER = os.getenv("PLANNER_TRIGGER", "event").lower()
+# Secondi senza notifiche dopo i quali lo stato della diga viene letto da InfluxDB (modalità event)
+PLANNER_STATE_TIMEOUT = float(os.getenv("PLANNER_STATE_TIMEOUT", 3 * QUERY_INTERVAL))
 # Connessione a InfluxDB
 client = InfluxDBClient(url=INFLUXDB_URL, token=INFLUXDB_TOKEN, org=INFLUXDB_ORG)
 query_api = client.query_api()
+# Lettura in un'unica query di inflow, outflow, volume e altezza
+snapshot_reader = SnapshotReader(
+    query_api, INFLUXDB_ORG, INFLUXDB_BUCKET,
+    BUCKET_FLOWS_DATA, VOLUME_SENSOR_DATA, VOLUME_FIELD, HEIGHT_FIELD
+)
+# Previsioni orarie in memoria (comuni a tutte le dighe), ricaricate solo quando l'ANALYZER pubblica una nuova versione
+forecast_cache = ForecastHorizonCache(
+    query_api, INFLUXDB_ORG, INFLUXDB_BUCKET, BUCKET_PREDICTED_DATA, index_dir=FORECAST_INDEX_DIR
+)
 
 # Stato MQTT
-mqtt_client = mqtt.Client("FSM")
+mqtt_client = mqtt.Client(shard_client_id("FSM"))
 mqtt_client.username_pw_set(MQTT_USER, MQTT_PASSWORD)
 
+def _minimum(a, b):
+    """Minimo elemento per elemento: builtin per gli scalari del PLANNER, NumPy per gli array di simulate_batch."""
+    return np.minimum(a, b) if isinstance(a, np.ndarray) else min(a, b)
+
+
+def _maximum(a, b):
+    """Massimo elemento per elemento, come _minimum."""
+    return np.maximum(a, b) if isinstance(a, np.ndarray) else max(a, b)
+
+
 class BalanceFSM:
     import time
-    def __init__(self):
+
+    # Frazione dell'inflow rilasciata dal Power Gate negli stati INITIAL e MID
+    INITIAL_INFLOW_RATIO = 0.5
+    MID_INFLOW_RATIO = 0.7
+    # Soglie di passaggio a MID e a FINAL come frazione dell'intervallo tra altezza minima e critica
+    MID_THRESHOLD = 0.80
+    FINAL_THRESHOLD = 0.95
+    # Frazione dello scarto verso l'apertura obiettivo applicata a ogni ciclo
+    INTERPOLATION_GAIN = 0.1
+    # Peso dell'inflow attuale e orizzonti di previsione (ore, peso) usati nello stato FINAL
+    CURRENT_INFLOW_WEIGHT = 0.5
+    HORIZON_WEIGHTS = [
+        (24, 0.2),         # Giornaliero
+        (7 * 24, 0.1),     # Settimanale
+        (30 * 24, 0.1),    # Mensile
+        (90 * 24, 0.05),   # Trimestrale
+        (180 * 24, 0.05),  # Semestrale
+    ]
+
+    PARAMETERS = ("INITIAL_INFLOW_RATIO", "MID_INFLOW_RATIO", "MID_THRESHOLD", "FINAL_THRESHOLD",
+                  "INTERPOLATION_GAIN", "CURRENT_INFLOW_WEIGHT", "HORIZON_WEIGHTS")
+
+    def __init__(self, forecast=None, clock=None, params=None):
         self.state = "INITIAL"
+        self.forecast = forecast if forecast is not None else forecast_cache
+        self.clock = clock or self.time.time  # Orologio dell'orizzonte di previsione (virtuale in simulazione)
+        self.last_horizon_inflows = None  # Ultime medie stampate da get_horizon_predictions
+        for name, value in (params or {}).items():
+            self.set_parameter(name, value)
+
+    @classmethod
+    def default_parameters(cls):
+        """Parametri della politica (nomi minuscoli); horizon_weights contiene solo i pesi, nell'ordine degli orizzonti."""
+        params = {name.lower(): getattr(cls, name) for name in cls.PARAMETERS}
+        params["horizon_weights"] = [weight for _, weight in cls.HORIZON_WEIGHTS]
+        return params
+
+    def set_parameter(self, name, value):
+        """Sostituisce un parametro della politica per questa istanza (es. mid_threshold=0.85)."""
+        attribute = name.upper()
+        if attribute not in self.PARAMETERS:
+            raise ValueError(f"Unknown BalanceFSM parameter: {name}")
+        if attribute == "HORIZON_WEIGHTS":
+            if len(value) != len(self.HORIZON_WEIGHTS):
+                raise ValueError(f"horizon_weights needs {len(self.HORIZON_WEIGHTS)} weights, got {len(value)}")
+            value = [(hours, float(weight)) for (hours, _), weight in zip(self.HORIZON_WEIGHTS, value)]
+        else:
+            value = float(value)
+        setattr(self, attribute, value)
+
+    # Le regole numeriche della politica sono metodi statici validi anche su array NumPy:
+    # SIMULATION/sweep.py (simulate_batch) li applica a molte configurazioni in un solo passo.
+    @staticmethod
+    def threshold(parent_fsm, fraction):
+        """Altezza assoluta a una frazione dell'intervallo tra altezza minima e critica."""
+        return (
+            fraction * (parent_fsm.DAM_CRITICAL_HEIGHT - parent_fsm.DAM_MIN_HEIGHT) * parent_fsm.DAM_HEIGHT
+            + (parent_fsm.DAM_MIN_HEIGHT * parent_fsm.DAM_HEIGHT)
+        )
 
     def execute(self, parent_fsm):
         if self.state == "INITIAL":
@@ -62,19 +160,15 @@ class BalanceFSM:
             parent_fsm.actions[f"Spillway_Gate_{i}"] = 0
 
         inflow = parent_fsm.inflow
-        target_outflow = min(inflow * 0.5, parent_fsm.POWER_GATE_OUTFLOW)
-        target_percentage = min((target_outflow / parent_fsm.POWER_GATE_OUTFLOW) * 100, 100)
+        target_percentage = float(self.target_percentage(inflow * self.INITIAL_INFLOW_RATIO, parent_fsm.POWER_GATE_OUTFLOW))
         print("INITIALLLLLLLLLLLLLLLLLLLLLLLLLLLLLLLLLL")
         new_percentage = self.interpolate(parent_fsm, target_percentage)
         parent_fsm.actions[parent_fsm.POWER_GATE_ID] = new_percentage
 
         print(f"INITIAL: Target: {target_percentage:.2f}%, New: {new_percentage:.2f}%")
 
-        threshold = (
-            0.80 * (parent_fsm.DAM_CRITICAL_HEIGHT - parent_fsm.DAM_MIN_HEIGHT) * parent_fsm.DAM_HEIGHT
-            + (parent_fsm.DAM_MIN_HEIGHT * parent_fsm.DAM_HEIGHT)
-        )
-        # Passa a MID se l'altezza supera l'80%
+        threshold = self.threshold(parent_fsm, self.MID_THRESHOLD)
+        # Passa a MID se l'altezza supera MID_THRESHOLD (80%)
         if parent_fsm.height >= threshold:
             self.state = "MID"
 
@@ -86,17 +180,13 @@ class BalanceFSM:
             parent_fsm.actions[f"Spillway_Gate_{i}"] = 0
 
         inflow = parent_fsm.inflow
-        target_outflow = min(inflow * 0.7, parent_fsm.POWER_GATE_OUTFLOW)
-        target_percentage = min((target_outflow / parent_fsm.POWER_GATE_OUTFLOW) * 100, 100)
+        target_percentage = float(self.target_percentage(inflow * self.MID_INFLOW_RATIO, parent_fsm.POWER_GATE_OUTFLOW))
         print("MIDDDDDDDDDDDDDDDDDDDDDDDDDDDDDDDDDDDDDDDD")
         new_percentage = self.interpolate(parent_fsm, target_percentage)
         parent_fsm.actions[parent_fsm.POWER_GATE_ID] = new_percentage
 
         print(f"MID: Target: {target_percentage:.2f}%, New: {new_percentage:.2f}%")
-        threshold = (
-            0.95 * (parent_fsm.DAM_CRITICAL_HEIGHT - parent_fsm.DAM_MIN_HEIGHT) * parent_fsm.DAM_HEIGHT
-            + (parent_fsm.DAM_MIN_HEIGHT * parent_fsm.DAM_HEIGHT)
-        )
+        threshold = self.threshold(parent_fsm, self.FINAL_THRESHOLD)
         print(f"Threshold: {threshold:.2f}, Current Height: {parent_fsm.height:.2f}")
         # Passa a FINAL se l'altezza supera il threshold
         if parent_fsm.height >= threshold:
@@ -109,33 +199,14 @@ class BalanceFSM:
         for i in range(1, parent_fsm.SPILLWAY_GATE_COUNT + 1):
             parent_fsm.actions[f"Spillway_Gate_{i}"] = 0
 
-        daily_term = self.get_daily_predictions()
-        weekly_term = self.get_weekly_predictions()
-        monthly_term = self.get_monthly_predictions()
-        quarterly_term = self.get_quarterly_predictions()
-        semiannual_term = self.get_semiannual_predictions()
-
-        daily_inflow = sum(value for _, value in daily_term) / len(daily_term) if daily_term else 0
-        weekly_inflow = sum(value for _, value in weekly_term) / len(weekly_term) if weekly_term else 0
-        monthly_inflow = sum(value for _, value in monthly_term) / len(monthly_term) if monthly_term else 0
-        quarterly_inflow = sum(value for _, value in quarterly_term) / len(quarterly_term) if quarterly_term else 0
-        semiannual_inflow = sum(value for _, value in semiannual_term) / len(semiannual_term) if semiannual_term else 0
-
-      
+        horizon_inflows = self.get_horizon_predictions()
 
         inflow = parent_fsm.inflow
-        predicted_inflow = (
-            0.5 * inflow +
-            0.2 * daily_inflow +
-            0.1 * weekly_inflow +
-            0.1 * monthly_inflow +
-            0.05 * quarterly_inflow +
-            0.05 * semiannual_inflow  
+        predicted_inflow = self.CURRENT_INFLOW_WEIGHT * inflow + sum(
+            weight * horizon_inflows[hours] for hours, weight in self.HORIZON_WEIGHTS
         )
-  
-       
-        target_outflow = min(predicted_inflow, parent_fsm.POWER_GATE_OUTFLOW)
-        target_percentage = min((target_outflow / parent_fsm.POWER_GATE_OUTFLOW) * 100, 100)
+
+        target_percentage = float(self.target_percentage(predicted_inflow, parent_fsm.POWER_GATE_OUTFLOW))
         print("FINALLLLLLLLLLLLLLLLLLLLL")
         new_percentage = self.interpolate(parent_fsm, target_percentage)
         parent_fsm.actions[parent_fsm.POWER_GATE_ID] = new_percentage
@@ -143,12 +214,9 @@ class BalanceFSM:
         print(f"FINAL: Target: {target_percentage:.2f}%, New: {new_percentage:.2f}%")
         
 
-        threshold = (
-            0.95 * (parent_fsm.DAM_CRITICAL_HEIGHT - parent_fsm.DAM_MIN_HEIGHT) * parent_fsm.DAM_HEIGHT
-            + (parent_fsm.DAM_MIN_HEIGHT * parent_fsm.DAM_HEIGHT)
-        )
+        threshold = self.threshold(parent_fsm, self.FINAL_THRESHOLD)
         print(f"Threshold: {threshold:.2f}, Current Height: {parent_fsm.height:.2f}")
-        # Passa a MID se l'altezza supera l'80%
+        # Torna a MID se l'altezza scende sotto FINAL_THRESHOLD
         if parent_fsm.height <= threshold:
             self.state = "MID"
 
@@ -156,86 +224,63 @@ class BalanceFSM:
             parent_fsm.set_state("EMERGENCY")
 
 
-    def interpolate(self, parent_fsm, target_percentage):
-        current_percentage = parent_fsm.actions.get(parent_fsm.POWER_GATE_ID, 0)
-        new_percentage = current_percentage + (target_percentage - current_percentage) * 0.1
-        # Limita il valore al massimo del 100%
-        return min(max(new_percentage, 0), 100)
-
-    
+    @staticmethod
+    def target_percentage(target_outflow, power_gate_outflow):
+        """Apertura (%) del Power Gate per rilasciare target_outflow, limitata alla portata massima."""
+        target_outflow = _minimum(target_outflow, power_gate_outflow)
+        return _minimum((target_outflow / power_gate_outflow) * 100, 100)
 
-    def get_daily_predictions(self):
-        """Recupera le previsioni delle prossime 24 ore aggregate orariamente."""
-        return self.query_predictions_simple(duration_seconds=24 * 3600, aggregation="mean")
-
-
-    def get_weekly_predictions(self):
-        """Recupera le previsioni della prossima settimana aggregate giornalmente."""
-        return self.query_predictions_simple(duration_seconds=7 * 24 * 3600, aggregation="mean")
+    @staticmethod
+    def step_toward(current_percentage, target_percentage, gain):
+        """Avvicina l'apertura corrente all'obiettivo di una frazione gain dello scarto, tra 0 e 100%."""
+        new_percentage = current_percentage + (target_percentage - current_percentage) * gain
+        # Limita il valore al massimo del 100%
+        return _minimum(_maximum(new_percentage, 0), 100)
 
-    def get_monthly_predictions(self):
-        """Recupera le previsioni dei prossimi 30 giorni aggregate settimanalmente."""
-        return self.query_predictions_simple(duration_seconds=30 * 24 * 3600, aggregation="mean")
+    def interpolate(self, parent_fsm, target_percentage):
+        current_percentage = parent_fsm.actions.get(parent_fsm.POWER_GATE_ID, 0)
+        return float(self.step_toward(current_percentage, target_percentage, self.INTERPOLATION_GAIN))
 
-    def get_quarterly_predictions(self):
-        """Recupera le previsioni dei prossimi 90 giorni aggregate settimanalmente."""
-        return self.query_predictions_simple(duration_seconds=90 * 24 * 3600, aggregation="mean")
     
-    def get_semiannual_predictions(self):
-        """Recupera le previsioni dei prossimi 6 mesi aggregate mensilmente."""
-        return self.query_predictions_simple(duration_seconds=180 * 24 * 3600, aggregation="mean")
-
 
-    def query_predictions_simple(self, duration_seconds, aggregation="mean"):
+    def get_horizon_predictions(self):
         """
-        Funzione per recuperare previsioni aggregate usando timestamp Unix.
-        :param duration_seconds: Durata in secondi (es. 86400 per 1 giorno, 604800 per 7 giorni).
-        :param aggregation: Funzione di aggregazione ('mean', 'sum').
-        :return: Lista di tuple (timestamp, valore).
+        Media dell'inflow previsto su ciascun orizzonte di HORIZON_WEIGHTS.
+        Le previsioni sono lette una sola volta per versione dell'ANALYZER e
+        le medie si ottengono dalle somme prefisse della cache.
+        :return: Dizionario ore -> inflow medio previsto (m³/s).
         """
-        # Ottieni i timestamp attuali
-        current_time = int(self.time.time())  # Timestamp attuale
-        start_time = current_time  # Partenza dall'ora corrente
-        end_time = current_time + duration_seconds  # Aggiungi la durata in secondi
-
-        query = f'''
-        from(bucket: "{INFLUXDB_BUCKET}")
-            |> range(start: {start_time}, stop: {end_time})
-            |> filter(fn: (r) => r._measurement == "{BUCKET_PREDICTED_DATA}")
-            |> filter(fn: (r) => r._field == "total_inflow")
-            |> aggregateWindow(every: {duration_seconds}s, fn: {aggregation}, createEmpty: false)
-            |> yield(name: "{aggregation}")
-        '''
-        try:
-            result = query_api.query(org=INFLUXDB_ORG, query=query)
-            predictions = [(record.get_time(), record.get_value()) for table in result for record in table.records]
-
-            print(f"\nPredictions ({aggregation}, {duration_seconds}s):")
-            for time, value in predictions:
-                print(f"{time}: {value:.2f} m³/s")
-            
-            return predictions
-        except Exception as e:
-            print(f"Error retrieving predictions: {e}")
-            return []
-
-
-
-
-
+        now = self.clock()
+        if self.forecast.needs_refresh(now):
+            self.forecast.refresh(now)
 
+        horizon_inflows = {hours: self.forecast.mean(hours, now) for hours, _ in self.HORIZON_WEIGHTS}
+        # Le medie cambiano solo con l'ora o con una nuova versione della previsione: stampate solo quando cambiano
+        if horizon_inflows != self.last_horizon_inflows:
+            self.last_horizon_inflows = horizon_inflows
+            print("Predictions (mean): " + ", ".join(
+                f"{hours}h: {value:.2f} m³/s" for hours, value in horizon_inflows.items()
+            ))
+        return horizon_inflows
 
 
 
 
 # Classe per la macchina a stati finiti
 class DamFSM:
-    def __init__(self):
+    def __init__(self, dam_id=DAM_UNIQUE_ID, forecast=None, clock=None, balance_params=None, balance_mode=BALANCE_MODE):
+        self.dam_id = dam_id  # Diga controllata: stato, azioni e FSM secondaria sono isolati per diga
+        self.forecast = forecast  # Previsioni e orologio passati alla FSM di BALANCE (None: cache e ora reali)
+        self.clock = clock
+        self.balance_params = balance_params  # Parametri della politica di BALANCE (None: valori predefiniti)
+        self.balance_mode = balance_mode  # "fsm" (BalanceFSM) oppure "mpc" (PredictiveBalance)
         self.state = "IDLE"  # Stato iniziale
         self.volume = 0
         self.height = 0
         self.inflow = 0
         self.outflow = 0
+        self.fetch_latency = 0.0  # Durata dell'ultima lettura da InfluxDB (s)
+        self.trace = None  # Traccia dei dati dell'ultima lettura
         self.actions = {}
         self.POWER_GATE_ID = POWER_GATE_ID  # Inizializza POWER_GATE_ID dal file .env
         self.SPILLWAY_GATE_COUNT = SPILLWAY_GATE_COUNT  # Inizializza SPILLWAY_GATE_COUNT dal file .env
@@ -243,6 +288,8 @@ class DamFSM:
         self.DAM_CRITICAL_HEIGHT = DAM_CRITICAL_HEIGHT  # Inizializza DAM_CRITICAL_HEIGHT dal file .env
         self.DAM_MIN_HEIGHT = DAM_MIN_HEIGHT  # Inizializza DAM_MIN_HEIGHT dal file .env
         self.POWER_GATE_OUTFLOW = POWER_GATE_OUTFLOW  # Inizializza POWER_GATE_OUTFLOW dal file .env
+        self.GATE_OUTFLOW = GATE_OUTFLOW  # Portata di uno Spillway Gate, per il modello di PredictiveBalance
+        self.DAM_TOTAL_VOLUME = DAM_TOTAL_VOLUME  # Volume massimo, per convertire i volumi previsti in altezze
 
         # Inizializza la macchina a stati secondaria per BALANCE
         self.balance_fsm = None  # Sarà istanziato al primo ingresso in BALANCE
@@ -251,17 +298,21 @@ class DamFSM:
         print(f"Initial Critical Height: {self.critical_height}")
 
     def set_state(self, new_state):
-        print(f"FSM: Transitioning from {self.state} to {new_state}")
+        print(f"FSM ({self.dam_id}): Transitioning from {self.state} to {new_state}")
         self.state = new_state
 
-    def fetch_data(self):
-        """Recupera i dati da InfluxDB."""
+    def fetch_data(self, snapshot=None):
+        """Recupera i dati da InfluxDB (o li prende dalla lettura già fatta per tutte le dighe dello shard)."""
         try:
-            self.inflow = self.get_last_value(BUCKET_FLOWS_DATA, "total_inflow")
-            self.outflow = self.get_last_value(BUCKET_FLOWS_DATA, "total_outflow")
-            self.volume = self.get_last_value(VOLUME_SENSOR_DATA, VOLUME_FIELD)
-            self.height = self.get_last_value(VOLUME_SENSOR_DATA, HEIGHT_FIELD)
-            print(f"FSM: Data - Inflow: {self.inflow}, Outflow: {self.outflow}, Volume: {self.volume}, Height: {self.height}")
+            if snapshot is None:
+                snapshot = snapshot_reader.fetch()
+            self.inflow = snapshot.inflow
+            self.outflow = snapshot.outflow
+            self.volume = snapshot.volume
+            self.height = snapshot.height
+            self.fetch_latency = snapshot.fetch_latency
+            self.trace = record_hop(snapshot.trace, "planner_in")
+            print(f"FSM ({self.dam_id}): Data - Inflow: {self.inflow}, Outflow: {self.outflow}, Volume: {self.volume}, Height: {self.height}")
             print(f"Critical Height: {self.critical_height}, Min Height: {DAM_MIN_HEIGHT * DAM_HEIGHT}")
         except Exception as e:
             print(f"FSM: Error fetching data: {e}")
@@ -288,7 +339,7 @@ class DamFSM:
 
     def execute_state(self):
         """Esegue la logica associata allo stato corrente."""
-        print(f"FSM: Current State: {self.state}")
+        print(f"FSM ({self.dam_id}): Current State: {self.state}")
         if self.state == "IDLE":
             self.idle()
         elif self.state == "FILL":
@@ -340,8 +391,13 @@ class DamFSM:
         """Stato BALANCE: Mantiene il livello del lago tra il 60% e il 98%."""
         # Inizializza la FSM secondaria per BALANCE se non esiste
         if not self.balance_fsm:
-            self.balance_fsm = BalanceFSM()
-            print("FSM: Initialized Balance FSM.")
+            if self.balance_mode == "mpc":
+                forecast = self.forecast if self.forecast is not None else forecast_cache
+                self.balance_fsm = PredictiveBalance(forecast, self.clock, self.balance_params)
+                print("FSM: Initialized predictive Balance controller.")
+            else:
+                self.balance_fsm = BalanceFSM(self.forecast, self.clock, self.balance_params)
+                print("FSM: Initialized Balance FSM.")
 
         # Esegui lo stato corrente della FSM secondaria
         self.balance_fsm.execute(self)
@@ -361,12 +417,51 @@ class DamFSM:
     def publish_actions(self):
         """Pubblica le azioni correnti come comando MQTT."""
         try:
-            topic = f"{DAM_UNIQUE_ID}/{PLANNER_TOPIC_PREFIX}"
-            mqtt_client.publish(topic, json.dumps(self.actions), qos=2)
-            print(f"FSM: Published actions: {self.actions}")
+            topic = f"{self.dam_id}/{PLANNER_TOPIC_PREFIX}"
+            payload = dict(self.actions)
+            trace = record_hop(self.trace, "planner")
+            if trace:
+                payload[TRACE_KEY] = trace
+            mqtt_client.publish(topic, json.dumps(payload), qos=2)
+            count_message("planner", "actions")
+            print(f"FSM ({self.dam_id}): Published actions: {self.actions}")
         except Exception as e:
             print(f"FSM: Error publishing actions: {e}")
 
+def on_connect(client, userdata, flags, rc):
+    """Callback per la connessione al broker: sottoscrive le versioni della previsione e le notifiche di stato."""
+    if rc == 0:
+        # La previsione è comune a tutte le dighe: basta il topic della prima diga dello shard
+        forecast_topic = f"{userdata['dam_ids'][0]}/{FORECAST_TOPIC_PREFIX}"
+        client.subscribe(forecast_topic, qos=1)
+        print(f"FSM: Connected to MQTT Broker, subscribed to {forecast_topic}")
+        if userdata.get("updates") is not None:
+            for dam_id in userdata["dam_ids"]:
+                client.subscribe(f"{dam_id}/{STATE_TOPIC_PREFIX}", qos=1)
+            print(f"FSM: Subscribed to state notifications of {len(userdata['dam_ids'])} dams")
+    else:
+        print(f"FSM: Failed to connect, return code {rc}")
+
+def on_message(client, userdata, msg):
+    """Aggiorna la versione della previsione o accoda la notifica di stato di una diga per il ciclo di controllo."""
+    try:
+        payload = json.loads(msg.payload)
+        if msg.topic.endswith(f"/{STATE_TOPIC_PREFIX}"):
+            snapshot = DamSnapshot(
+                float(payload["inflow"]), float(payload["outflow"]),
+                float(payload["volume"]), float(payload["height"]),
+                trace=extract_trace(payload),
+            )
+            userdata["updates"].put((dam_from_topic(msg.topic), snapshot, float(payload.get("timestamp", 0))))
+            count_message("planner", "state")
+            return
+        forecast_cache.set_version(payload.get("version"))
+        print(f"FSM: New forecast version {payload.get('version')}")
+    except json.JSONDecodeError:
+        print(f"FSM: Invalid JSON payload on topic {msg.topic}")
+    except (KeyError, TypeError, ValueError) as e:
+        print(f"FSM: Invalid state payload on topic {msg.topic}: {e}")
+
     # Riconnessione MQTT
 def reconnect_mqtt():
     while True:
@@ -379,18 +474,89 @@ def reconnect_mqtt():
             time.sleep(5)
 
 
-# Main
-if __name__ == "__main__":
-    fsm = DamFSM()
+def decide(fsm, snapshot):
+    """Un passo di controllo della diga: stato letto, FSM e pubblicazione delle azioni."""
+    fsm.fetch_data(snapshot)
+    fsm.execute_state()
+    fsm.publish_actions()
+
+
+def poll_loop(fsms, reader):
+    """Modalità poll: una query per tutte le dighe dello shard ogni QUERY_INTERVAL."""
+    while True:
+        snapshots = reader.fetch_all()
+        decision_start = time.perf_counter()
+        for dam_id, fsm in fsms.items():
+            decide(fsm, snapshots[dam_id])
+        decision_time = time.perf_counter() - decision_start
+        latency = reader.latency_stats()
+        print(f"FSM: Cycle timing ({len(fsms)} dams) - fetch {latency['last']:.1f} ms "
+              f"(mean {latency['mean']:.1f} ms, max {latency['max']:.1f} ms), decision {decision_time * 1000:.1f} ms")
+        time.sleep(QUERY_INTERVAL)
+
+
+def event_loop(fsms, reader, updates):
+    """
+    Modalità event: ogni notifica di stato dell'ANALYZER esegue subito la FSM della sua diga, senza query.
+    Le notifiche arrivano dal thread MQTT tramite la coda, così le FSM girano solo in questo thread.
+    Le dighe senza notifiche da PLANNER_STATE_TIMEOUT secondi vengono lette da InfluxDB come in modalità poll.
+    """
+    last_update = dict.fromkeys(fsms, time.time())
+    while True:
+        deadline = min(last_update.values()) + PLANNER_STATE_TIMEOUT
+        try:
+            dam_id, snapshot, published = updates.get(timeout=max(0.1, deadline - time.time()))
+            fsm = fsms.get(dam_id)
+            if fsm is not None:
+                decision_start = time.perf_counter()
+                decide(fsm, snapshot)
+                last_update[dam_id] = time.time()
+                print(f"FSM ({dam_id}): Decision {(time.perf_counter() - decision_start) * 1000:.1f} ms, "
+                      f"{(last_update[dam_id] - published) * 1000:.1f} ms after the ANALYZER update")
+        except queue.Empty:
+            pass
+
+        now = time.time()
+        stale = [dam_id for dam_id, updated in last_update.items() if now - updated >= PLANNER_STATE_TIMEOUT]
+        if stale:
+            print(f"FSM: No state notification for {PLANNER_STATE_TIMEOUT:.0f} s from {', '.join(stale)}, "
+                  f"reading InfluxDB")
+            snapshots = reader.fetch_all()
+            for dam_id in stale:
+                decide(fsms[dam_id], snapshots[dam_id])
+                last_update[dam_id] = now
+
+
+def run_planner(dam_ids):
+    """
+    Worker di uno shard: una FSM per diga e una connessione MQTT. In modalità poll una sola query
+    per ciclo legge lo stato di tutte le dighe dello shard; in modalità event decidono le notifiche dell'ANALYZER.
+    """
+    fsms = {dam_id: DamFSM(dam_id) for dam_id in dam_ids}
+    reader = SnapshotReader(
+        query_api, INFLUXDB_ORG, INFLUXDB_BUCKET,
+        BUCKET_FLOWS_DATA, VOLUME_SENSOR_DATA, VOLUME_FIELD, HEIGHT_FIELD,
+        dam_ids=dam_ids, dam_tag=DAM_TAG if multi_dam() else None
+    )
+    updates = queue.Queue() if PLANNER_TRIGGER == "event" else None
+    start_metrics_server(shard_metrics_port(METRICS_PORT))
+    mqtt_client.user_data_set({"dam_ids": dam_ids, "updates": updates})
+    mqtt_client.on_connect = on_connect
+    mqtt_client.on_message = on_message
     reconnect_mqtt()
+    print(f"FSM: Trigger mode {PLANNER_TRIGGER} for {len(fsms)} dams")
     try:
-        while True:
-            fsm.fetch_data()
-            fsm.execute_state()
-            fsm.publish_actions()
-            time.sleep(QUERY_INTERVAL)
+        if updates is not None:
+            event_loop(fsms, reader, updates)
+        else:
+            poll_loop(fsms, reader)
     except KeyboardInterrupt:
         print("FSM: Stopping...")
     finally:
         mqtt_client.loop_stop()
-        mqtt_client.disconnect()
\ No newline at end of file
+        mqtt_client.disconnect()
+
+
+# Main
+if __name__ == "__main__":
+    raise SystemExit(run_sharded(run_planner, DAM_UNIQUE_IDS, DAM_SHARDS))
@@ -0,0 +1,182 @@
+import time
+import numpy as np  # type: ignore
+
+
+class PredictiveBalance:
+    """
+    Controllo predittivo a orizzonte mobile per lo stato BALANCE, alternativo a BalanceFSM.
+    Valuta in blocco tutte le combinazioni di aperture del Power Gate e degli Spillway
+    (un valore per il primo blocco di ore e uno per il resto dell'orizzonte) sull'inflow orario previsto,
+    sceglie quella che massimizza il rilascio dal Power Gate mantenendo l'altezza tra minima e critica
+    e senza scendere sotto il livello obiettivo lungo l'orizzonte, e applica le aperture del primo blocco.
+    Il programma viene mantenuto fino alla prossima ottimizzazione: ogni RESOLVE_INTERVAL secondi,
+    oppure prima se cambiano la previsione, l'inflow misurato o le aperture impostate da altri stati.
+    """
+
+    STATE = "MPC"  # Unico stato, esposto come BalanceFSM.state per i log e il simulatore
+
+    # Orizzonte (ore) e durata del primo blocco; il secondo blocco copre il resto dell'orizzonte
+    HORIZON_HOURS = 48
+    BLOCK_HOURS = 6
+    # Aperture candidate (0-100%) del Power Gate e degli Spillway (stessa apertura per tutti)
+    POWER_LEVELS = 21
+    SPILLWAY_LEVELS = 3
+    # Margine dai limiti di altezza come frazione dell'intervallo tra altezza minima e critica
+    SAFETY_MARGIN = 0.05
+    # Ore di decadimento della correzione della previsione verso l'inflow misurato
+    BIAS_DECAY_HOURS = 6.0
+    # Livello obiettivo come frazione dell'intervallo tra altezza minima e critica
+    TARGET_LEVEL = 0.9
+    # Secondi tra due ottimizzazioni e variazione relativa dell'inflow misurato che ne anticipa una
+    RESOLVE_INTERVAL = 3600
+    RESOLVE_INFLOW_CHANGE = 0.2
+    # Pesi dell'obiettivo, in m³ equivalenti di rilascio dal Power Gate:
+    SHORTFALL_PENALTY = 2.0   # volume medio mancante al livello obiettivo sull'orizzonte (m³): > 1, il lago non si svuota
+    SPILL_PENALTY = 1.0       # acqua scaricata dagli Spillway (m³)
+    VIOLATION_PENALTY = 1e9   # uscita dai limiti di altezza (m·h)
+    CHANGE_PENALTY = 0.1      # variazione del Power Gate rispetto all'azione corrente (ore di rilascio per 100%)
+
+    PARAMETERS = ("HORIZON_HOURS", "BLOCK_HOURS", "POWER_LEVELS", "SPILLWAY_LEVELS", "SAFETY_MARGIN",
+                  "BIAS_DECAY_HOURS", "TARGET_LEVEL", "RESOLVE_INTERVAL", "RESOLVE_INFLOW_CHANGE",
+                  "SHORTFALL_PENALTY", "SPILL_PENALTY", "VIOLATION_PENALTY", "CHANGE_PENALTY")
+    INTEGER_PARAMETERS = ("HORIZON_HOURS", "BLOCK_HOURS", "POWER_LEVELS", "SPILLWAY_LEVELS", "RESOLVE_INTERVAL")
+
+    def __init__(self, forecast, clock=None, params=None):
+        self.state = self.STATE
+        self.forecast = forecast
+        self.clock = clock or time.time  # Orologio dell'orizzonte di previsione (virtuale in simulazione)
+        for name, value in (params or {}).items():
+            self.set_parameter(name, value)
+        self.build_candidates()
+        self.solve_time = 0.0  # Durata dell'ultima ottimizzazione (s)
+        self.solves = 0        # Ottimizzazioni eseguite
+        self.plan = None       # Programma corrente, mantenuto fino alla prossima ottimizzazione
+        self.solved_at = 0.0
+        self.solved_inflow = 0.0
+        self.solved_version = None
+
+    @classmethod
+    def default_parameters(cls):
+        """Parametri del controllore (nomi minuscoli)."""
+        return {name.lower(): getattr(cls, name) for name in cls.PARAMETERS}
+
+    def set_parameter(self, name, value):
+        """Sostituisce un parametro del controllore per questa istanza (es. horizon_hours=72)."""
+        attribute = name.upper()
+        if attribute not in self.PARAMETERS:
+            raise ValueError(f"Unknown PredictiveBalance parameter: {name}")
+        setattr(self, attribute, int(value) if attribute in self.INTEGER_PARAMETERS else float(value))
+
+    def build_candidates(self):
+        """Tutte le combinazioni (Power Gate, Spillway) x (primo blocco, resto dell'orizzonte), come array piatti."""
+        power = np.linspace(0, 100, self.POWER_LEVELS)
+        spillway = np.linspace(0, 100, self.SPILLWAY_LEVELS)
+        grid = np.meshgrid(power, power, spillway, spillway, indexing="ij")
+        self.power_first, self.power_rest, self.spillway_first, self.spillway_rest = (axis.ravel() for axis in grid)
+
+    def execute(self, parent_fsm):
+        now = self.clock()
+        if self.forecast.needs_refresh(now):
+            self.forecast.refresh(now)
+
+        if self.needs_solve(parent_fsm, now):
+            predicted = self.predicted_inflow(parent_fsm.inflow, self.forecast.hourly(self.HORIZON_HOURS, now))
+            start = time.perf_counter()
+            self.plan = self.solve(parent_fsm, predicted)
+            self.solve_time = time.perf_counter() - start
+            self.solves += 1
+            self.solved_at = now
+            self.solved_inflow = parent_fsm.inflow
+            self.solved_version = self.forecast.loaded_version
+            print(f"MPC: Power Gate {self.plan['power']:.0f}% then {self.plan['power_rest']:.0f}%, "
+                  f"Spillways {self.plan['spillway']:.0f}% then {self.plan['spillway_rest']:.0f}%, "
+                  f"predicted height {self.plan['min_height']:.2f}-{self.plan['max_height']:.2f} m "
+                  f"({len(self.power_first)} schedules in {self.solve_time * 1000:.1f} ms)")
+
+        parent_fsm.actions[parent_fsm.POWER_GATE_ID] = self.plan["power"]
+        for i in range(1, parent_fsm.SPILLWAY_GATE_COUNT + 1):
+            parent_fsm.actions[f"Spillway_Gate_{i}"] = self.plan["spillway"]
+
+        # Come in BalanceFSM, oltre l'altezza critica decide lo stato EMERGENCY della FSM principale
+        if parent_fsm.height >= parent_fsm.DAM_CRITICAL_HEIGHT * parent_fsm.DAM_HEIGHT:
+            parent_fsm.set_state("EMERGENCY")
+
+    def needs_solve(self, parent_fsm, now):
+        """
+        True se il programma corrente va ricalcolato: nessun programma, RESOLVE_INTERVAL scaduto,
+        nuova versione della previsione, inflow misurato cambiato oltre RESOLVE_INFLOW_CHANGE
+        o aperture modificate da un altro stato (es. dopo EMERGENCY).
+        """
+        if self.plan is None or now - self.solved_at >= self.RESOLVE_INTERVAL:
+            return True
+        if self.forecast.loaded_version != self.solved_version:
+            return True
+        if abs(parent_fsm.inflow - self.solved_inflow) > self.RESOLVE_INFLOW_CHANGE * max(abs(self.solved_inflow), 1.0):
+            return True
+        return parent_fsm.actions.get(parent_fsm.POWER_GATE_ID) != self.plan["power"]
+
+    def predicted_inflow(self, inflow, forecast):
+        """
+        Inflow orario (m³/s) sull'orizzonte: la previsione corretta dello scarto dall'inflow misurato,
+        con peso che decade in BIAS_DECAY_HOURS. Senza previsione resta l'inflow misurato.
+        """
+        values = np.full(self.HORIZON_HOURS, float(inflow))
+        count = min(len(forecast), self.HORIZON_HOURS)
+        if count:
+            values[:count] = forecast[:count]
+            values[count:] = forecast[count - 1]
+            values += (inflow - forecast[0]) * np.exp(-np.arange(self.HORIZON_HOURS) / self.BIAS_DECAY_HOURS)
+        return np.maximum(values, 0.0)
+
+    def solve(self, parent_fsm, predicted):
+        """
+        Valuta tutti i programmi candidati con operazioni vettoriali su una matrice (programmi x ore)
+        dell'altezza prevista e restituisce quello con il punteggio migliore.
+        :param predicted: Inflow orario previsto (m³/s) per le ore dell'orizzonte.
+        :return: Dizionario con le aperture dei due blocchi, altezze previste e punteggio.
+        """
+        hours = len(predicted)
+        block = min(self.BLOCK_HOURS, hours)
+        elapsed = np.arange(1, hours + 1)
+        first_hours = np.minimum(elapsed, block)   # Ore trascorse nel primo blocco alla fine di ogni ora
+        rest_hours = elapsed - first_hours
+
+        spillway_capacity = parent_fsm.GATE_OUTFLOW * parent_fsm.SPILLWAY_GATE_COUNT
+        power_first = self.power_first * parent_fsm.POWER_GATE_OUTFLOW / 100
+        power_rest = self.power_rest * parent_fsm.POWER_GATE_OUTFLOW / 100
+        spill_first = self.spillway_first * spillway_capacity / 100
+        spill_rest = self.spillway_rest * spillway_capacity / 100
+
+        # Volume a fine di ogni ora: integrale dell'inflow previsto meno l'outflow costante a blocchi
+        outflow = np.outer(power_first + spill_first, first_hours) + np.outer(power_rest + spill_rest, rest_hours)
+        volume = parent_fsm.volume + 3600 * (np.cumsum(predicted) - outflow)
+        height = volume * (parent_fsm.DAM_HEIGHT / parent_fsm.DAM_TOTAL_VOLUME)
+
+        low_height = parent_fsm.DAM_MIN_HEIGHT * parent_fsm.DAM_HEIGHT
+        high_height = parent_fsm.DAM_CRITICAL_HEIGHT * parent_fsm.DAM_HEIGHT
+        margin = self.SAFETY_MARGIN * (high_height - low_height)
+        violation = (np.maximum(height - (high_height - margin), 0) + np.maximum((low_height + margin) - height, 0)).sum(axis=1)
+        target_height = low_height + self.TARGET_LEVEL * (high_height - low_height)
+        target_volume = target_height * (parent_fsm.DAM_TOTAL_VOLUME / parent_fsm.DAM_HEIGHT)
+
+        power_m3 = 3600 * (power_first * block + power_rest * (hours - block))
+        spill_m3 = 3600 * (spill_first * block + spill_rest * (hours - block))
+        current_power = parent_fsm.actions.get(parent_fsm.POWER_GATE_ID, 0)
+        change_m3 = 3600 * np.abs(self.power_first - current_power) * parent_fsm.POWER_GATE_OUTFLOW / 100
+        score = (power_m3
+                 - self.SHORTFALL_PENALTY * np.maximum(target_volume - volume, 0).mean(axis=1)
+                 - self.SPILL_PENALTY * spill_m3
+                 - self.VIOLATION_PENALTY * violation
+                 - self.CHANGE_PENALTY * change_m3)
+
+        best = int(np.argmax(score))
+        return {
+            "power": float(self.power_first[best]),
+            "power_rest": float(self.power_rest[best]),
+            "spillway": float(self.spillway_first[best]),
+            "spillway_rest": float(self.spillway_rest[best]),
+            "min_height": float(height[best].min()),
+            "max_height": float(height[best].max()),
+            "violation": float(violation[best]),
+            "score": float(score[best]),
+        }
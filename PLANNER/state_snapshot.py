@@ -0,0 +1,105 @@
+import time
+from collections import deque
+from dataclasses import dataclass
+
+
+@dataclass
+class DamSnapshot:
+    """Stato della diga letto da InfluxDB in un singolo ciclo del planner."""
+    inflow: float = 0.0
+    outflow: float = 0.0
+    volume: float = 0.0
+    height: float = 0.0
+    fetch_latency: float = 0.0  # Durata della lettura in secondi
+    trace: dict = None          # Traccia (origine e passaggi) dei dati letti, se presente
+
+
+class SnapshotReader:
+    """
+    Legge tutti gli input del planner con una sola query Flux e registra la latenza di ogni lettura.
+    Con dam_tag la stessa query legge lo stato di tutte le dighe in dam_ids (una serie per diga).
+    """
+
+    def __init__(self, query_api, org, bucket, flows_measurement, volume_measurement,
+                 volume_field, height_field, window="-1m", history=360, dam_ids=(None,), dam_tag=None):
+        self.query_api = query_api
+        self.org = org
+        self.dam_ids = list(dam_ids)
+        self.dam_tag = dam_tag   # Tag della diga sui punti (None: una sola diga, dati senza filtro)
+        self.fields = {
+            (flows_measurement, "total_inflow"): "inflow",
+            (flows_measurement, "total_outflow"): "outflow",
+            (volume_measurement, volume_field): "volume",
+            (volume_measurement, height_field): "height",
+        }
+        self.trace_measurements = (volume_measurement, flows_measurement)  # In ordine di preferenza
+        dam_filter = ""
+        columns = '"_measurement", "_field", "_value"'
+        if dam_tag:
+            dam_set = ", ".join(f'"{dam_id}"' for dam_id in self.dam_ids)
+            dam_filter = f'|> filter(fn: (r) => contains(value: r.{dam_tag}, set: [{dam_set}]))'
+            columns += f', "{dam_tag}"'
+        self.query = f'''
+        from(bucket: "{bucket}")
+            |> range(start: {window})
+            |> filter(fn: (r) =>
+                (r._measurement == "{flows_measurement}" and (r._field == "total_inflow" or r._field == "total_outflow")) or
+                (r._measurement == "{volume_measurement}" and (r._field == "{volume_field}" or r._field == "{height_field}")) or
+                ((r._measurement == "{flows_measurement}" or r._measurement == "{volume_measurement}") and r._field =~ /^trace_/))
+            {dam_filter}
+            |> last()
+            |> keep(columns: [{columns}])
+        '''
+        self.latencies = deque(maxlen=history)  # Latenze delle ultime letture (s)
+
+    def fetch(self):
+        """Esegue la query e restituisce un DamSnapshot (valori a 0.0 se mancanti, come get_last_value)."""
+        return self.fetch_all()[self.dam_ids[0]]
+
+    def fetch_all(self):
+        """Esegue la query e restituisce un DamSnapshot per ogni diga di dam_ids."""
+        snapshots = {dam_id: DamSnapshot() for dam_id in self.dam_ids}
+        traces = {dam_id: {} for dam_id in self.dam_ids}
+        start = time.perf_counter()
+        try:
+            result = self.query_api.query(org=self.org, query=self.query)
+            for table in result:
+                for record in table.records:
+                    dam_id = record.values.get(self.dam_tag) if self.dam_tag else self.dam_ids[0]
+                    snapshot = snapshots.get(dam_id)
+                    if snapshot is None:
+                        continue
+                    attribute = self.fields.get((record.get_measurement(), record.get_field()))
+                    if attribute:
+                        setattr(snapshot, attribute, float(record.get_value()))
+                    elif record.get_field().startswith("trace_"):
+                        traces[dam_id].setdefault(record.get_measurement(), {})[record.get_field()] = float(record.get_value())
+            for dam_id, snapshot in snapshots.items():
+                snapshot.trace = self.build_trace(traces[dam_id])
+        except Exception as e:
+            print(f"FSM: Error fetching state snapshot: {e}")
+        fetch_latency = time.perf_counter() - start
+        for snapshot in snapshots.values():
+            snapshot.fetch_latency = fetch_latency
+        self.latencies.append(fetch_latency)
+        return snapshots
+
+    def build_trace(self, traces):
+        """Ricostruisce la traccia dai campi trace_* (preferendo il volume, che include il passaggio dall'ANALYZER)."""
+        for measurement in self.trace_measurements:
+            values = traces.get(measurement, {})
+            if "trace_origin" in values:
+                hops = [["sensor", values["trace_origin"]]]
+                hops += [[stage, values[f"trace_{stage}"]] for stage in ("monitor", "analyzer") if f"trace_{stage}" in values]
+                return {"origin": values["trace_origin"], "hops": hops}
+        return None
+
+    def latency_stats(self):
+        """Statistiche (in ms) sulle latenze di lettura registrate."""
+        if not self.latencies:
+            return {"last": 0.0, "mean": 0.0, "max": 0.0}
+        return {
+            "last": self.latencies[-1] * 1000,
+            "mean": sum(self.latencies) / len(self.latencies) * 1000,
+            "max": max(self.latencies) * 1000,
+        }
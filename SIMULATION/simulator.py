@@ -0,0 +1,371 @@
+import os
+import sys
+import json
+import math
+import time
+import glob
+import argparse
+from datetime import datetime
+import numpy as np  # type: ignore
+import pandas as pd  # type: ignore
+from dotenv import load_dotenv  # type: ignore
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Configurazione della diga e dei servizi dallo stesso .env dello stack docker-compose
+load_dotenv(os.path.join(ROOT, ".env"))
+
+# Il codice dei servizi viene importato così com'è: FSM del PLANNER, integratore e previsione dell'ANALYZER,
+# moduli condivisi di COMMON (copiati nelle immagini in fase di build)
+sys.path.insert(0, os.path.join(ROOT, "COMMON"))
+sys.path.insert(0, os.path.join(ROOT, "ANALYZER"))
+sys.path.insert(0, os.path.join(ROOT, "PLANNER"))
+import planner_balance
+import predictive_balance
+from forecast import forecast_inflows
+from forecast_cache import ForecastHorizonCache
+from forecast_index import ForecastIndex
+from inflow_table import load_inflow_model
+from sensor_inflow import apply_random_variability, calculate_inflow
+
+DAM_UNIQUE_ID = os.getenv("DAM_UNIQUE_ID")
+DAM_TOTAL_VOLUME = float(os.getenv("DAM_TOTAL_VOLUME"))
+DAM_HEIGHT = float(os.getenv("DAM_HEIGHT"))
+DAM_VOLUME = float(os.getenv("DAM_VOLUME", 0))
+DAM_CRITICAL_HEIGHT = float(os.getenv("DAM_CRITICAL_HEIGHT"))
+DAM_MIN_HEIGHT = float(os.getenv("DAM_MIN_HEIGHT"))
+POWER_GATE_ID = os.getenv("POWER_GATE_ID")
+POWER_GATE_OUTFLOW = float(os.getenv("POWER_GATE_OUTFLOW"))
+GATE_OUTFLOW = float(os.getenv("GATE_OUTFLOW"))
+SPILLWAY_GATE_COUNT = int(os.getenv("SPILLWAY_GATE_COUNT"))
+QUERY_INTERVAL = int(os.getenv("QUERY_INTERVAL"))
+GATE_PUBLISH_DELAY = int(os.getenv("GATE_PUBLISH_DELAY", 60))
+EXECUTOR_DEADBAND = float(os.getenv("EXECUTOR_DEADBAND", 0.5))
+
+DATA_DIR = os.path.join(ROOT, "TRAINING")
+FLOW_SUFFIX = "_hourly_mean_flow.csv"
+STATES = ("IDLE", "FILL", "BALANCE", "EMERGENCY")
+BALANCE_STATES = ("INITIAL", "MID", "FINAL", predictive_balance.PredictiveBalance.STATE)
+
+
+def quiet_planner():
+    """Disattiva le stampe del PLANNER (migliaia per ogni giorno simulato)."""
+    planner_balance.print = lambda *args, **kwargs: None
+    predictive_balance.print = lambda *args, **kwargs: None
+
+
+def river_name(csv_file):
+    return os.path.basename(csv_file)[:-len(FLOW_SUFFIX)]
+
+
+def load_observed_inflow(csv_files, year, min_coverage=0.9):
+    """
+    Portata oraria osservata (m³/s) di ogni fiume per l'anno indicato; le ore mancanti
+    sono interpolate. Gli anni con copertura inferiore a min_coverage sono rifiutati.
+    :return: (ore dell'anno come DatetimeIndex, dizionario fiume -> array orario).
+    """
+    hours = pd.date_range(f"{year}-01-01", f"{year + 1}-01-01", freq="h", inclusive="left")
+    rivers = {}
+    for csv_file in csv_files:
+        flow = pd.read_csv(csv_file, parse_dates=["DateTime"], index_col="DateTime").iloc[:, 0]
+        flow = flow[~flow.index.duplicated()].reindex(hours)
+        coverage = flow.notna().mean()
+        if coverage < min_coverage:
+            raise ValueError(f"{csv_file} covers only {coverage:.0%} of {year}")
+        rivers[river_name(csv_file)] = flow.interpolate(limit_direction="both").to_numpy(dtype=np.float64)
+    return hours, rivers
+
+
+def complete_years(csv_files, min_coverage=0.9):
+    """Anni coperti da tutti i fiumi per almeno min_coverage delle ore, in ordine crescente."""
+    years = None
+    for csv_file in csv_files:
+        times = pd.read_csv(csv_file, usecols=["DateTime"], parse_dates=["DateTime"])["DateTime"]
+        counts = times.dt.year.value_counts()
+        complete = {year for year, count in counts.items() if count >= min_coverage * 365 * 24}
+        years = complete if years is None else years & complete
+    if not years:
+        raise ValueError("No year is covered by all the flow files")
+    return sorted(years)
+
+
+def flow_files(csv_files=None):
+    """File di portata oraria dei fiumi (default: tutti quelli in TRAINING)."""
+    return csv_files or sorted(glob.glob(os.path.join(DATA_DIR, f"*{FLOW_SUFFIX}")))
+
+
+def observed_forecast(start, hourly_inflow):
+    """Previsione perfetta: l'inflow osservato, esteso ripetendo l'anno per gli orizzonti oltre dicembre."""
+    observed = np.concatenate([hourly_inflow, hourly_inflow])
+    return ForecastIndex.from_hourly(start.timestamp(), observed, version="observed")
+
+
+def solar_inflow(seconds_of_day):
+    """Curva della pompa solare (calculate_inflow del sensore) per un array di secondi del giorno."""
+    minutes = seconds_of_day // 60
+    return calculate_inflow(minutes // 60, minutes % 60)
+
+
+class ReplayForecast(ForecastHorizonCache):
+    """
+    Cache di previsione del PLANNER già caricata con un indice fisso (nessuna query né ricarica).
+    Le medie cambiano solo quando l'orologio passa all'ora successiva, quindi sono memorizzate per ora.
+    """
+
+    def __init__(self, index):
+        super().__init__(None, None, None, None, max_age=float("inf"))
+        self.index = index
+        self.version = self.loaded_version = index.version
+        self.means = {}
+
+    def needs_refresh(self, now=None):
+        return False
+
+    def mean(self, hours, now=None):
+        key = (hours, math.ceil((now - self.index.start) / self.index.step))
+        if key not in self.means:
+            self.means[key] = super().mean(hours, now)
+        return self.means[key]
+
+
+def model_forecast(model_files, start, hours):
+    """Previsione oraria dell'ANALYZER (somma dei modelli dei fiumi) a partire da start."""
+    models = {os.path.basename(path).split("_")[0]: load_inflow_model(path) for path in model_files}
+    forecast = forecast_inflows(models, start, hours)
+    return ForecastIndex.from_hourly(start.timestamp(), forecast["total_inflow"], version="models")
+
+
+def step_inflow(hourly_inflow, start, steps, step, solar=True, noise=False, seed=None):
+    """
+    Inflow totale (m³/s) visto dal MONITOR a ogni passo di controllo: portata oraria dei fiumi,
+    curva della pompa solare e, se richiesto, la variabilità casuale ±(5-10)% di ogni sensore.
+    """
+    offsets = np.arange(steps, dtype=np.int64) * step
+    hour_index = np.minimum(offsets // 3600, len(hourly_inflow) - 1)
+    sensors = [hourly_inflow[hour_index]]
+    if solar:
+        seconds_of_day = (offsets + int(start.timestamp()) - int(start.replace(hour=0, minute=0, second=0).timestamp())) % 86400
+        sensors.append(solar_inflow(seconds_of_day))
+    if not noise:
+        return np.sum(sensors, axis=0)
+    rng = np.random.default_rng(seed)
+    total = np.zeros(steps, dtype=np.float64)
+    for values in sensors:
+        total += apply_random_variability(values, rng=rng)
+    return total
+
+
+def gate_capacities():
+    """Portata massima (m³/s) di ogni gate, come nel calcolo dell'outflow del MONITOR."""
+    capacities = {POWER_GATE_ID: POWER_GATE_OUTFLOW}
+    for i in range(1, SPILLWAY_GATE_COUNT + 1):
+        capacities[f"Spillway_Gate_{i}"] = GATE_OUTFLOW
+    return capacities
+
+
+def lake_height(volume):
+    """Formula dell'ANALYZER (calculate_lake_height): altezza proporzionale al volume, limitata alla diga."""
+    return max(0.0, min(volume / DAM_TOTAL_VOLUME * DAM_HEIGHT, DAM_HEIGHT))
+
+
+def simulate(inflow, start, forecast=None, initial_volume=DAM_VOLUME, step=QUERY_INTERVAL,
+             gate_publish_delay=GATE_PUBLISH_DELAY, deadband=EXECUTOR_DEADBAND, fsm_factory=None, balance_params=None,
+             balance_mode="fsm"):
+    """
+    Ciclo chiuso MONITOR -> ANALYZER -> PLANNER -> EXECUTOR -> gate con orologio virtuale,
+    senza MQTT né InfluxDB. Ogni passo dura step secondi (QUERY_INTERVAL, il ciclo del PLANNER):
+    - MONITOR: inflow dei sensori e outflow dallo stato dei gate, che i gate pubblicano ogni gate_publish_delay s;
+    - ANALYZER: integrazione a trapezi del bilancio (come VolumeIntegrator) e altezza del lago;
+    - PLANNER: DamFSM/BalanceFSM reali con le previsioni di forecast (lo stato è assegnato come in fetch_data);
+    - EXECUTOR: comandi entro la deadband soppressi, come in needs_update.
+    Per passo restano in Python solo il modello dei gate, il bilancio e la chiamata alla FSM; medie orarie,
+    minimi e quote di stato sono calcolati dopo il ciclo con NumPy (un anno a 10 s sono oltre 3 milioni di passi).
+    :param inflow: Inflow totale (m³/s) per passo (vedi step_inflow).
+    :param start: Istante virtuale del primo passo (datetime).
+    :param fsm_factory: Funzione (forecast, clock) -> DamFSM, per provare FSM diverse.
+    :param balance_params: Parametri di BalanceFSM (vedi BalanceFSM.default_parameters) della DamFSM predefinita.
+    :param balance_mode: Controllo dello stato BALANCE della DamFSM predefinita: "fsm" oppure "mpc".
+    :return: (riepilogo come dizionario, DataFrame orario).
+    """
+    steps = len(inflow)
+    origin = start.timestamp()
+    clock_time = [origin]
+    clock = lambda: clock_time[0]
+    if fsm_factory is None:
+        fsm = planner_balance.DamFSM(DAM_UNIQUE_ID, forecast, clock, balance_params, balance_mode)
+    else:
+        fsm = fsm_factory(forecast, clock)
+
+    capacities = gate_capacities()
+    gate_ids = list(capacities)
+    capacity = [capacities[gate_id] for gate_id in gate_ids]
+    gate_index = {gate_id: position for position, gate_id in enumerate(gate_ids)}
+    positions = [0.0] * len(gate_ids)   # Apertura reale dei gate (%)
+    publish_every = max(1, round(gate_publish_delay / step))
+    power_outflow = outflow = 0.0       # Outflow calcolato dal MONITOR sull'ultimo stato pubblicato dai gate
+    commands_sent = commands_suppressed = 0
+
+    # Per passo il ciclo registra solo outflow, altezza e stato: medie orarie, minimi e contatori
+    # sono calcolati dopo il ciclo con operazioni vettoriali
+    step_outflow = [0.0] * steps
+    step_power = [0.0] * steps
+    step_height = [0.0] * steps
+    step_state = [None] * steps
+    step_balance = [None] * steps
+    transitions = 0
+
+    volume = float(initial_volume)
+    previous_net = None
+    height_scale = DAM_HEIGHT / DAM_TOTAL_VOLUME
+    half_step = 0.5 * step
+    spillway_capacity = capacity[1:]
+    inflows = np.asarray(inflow, dtype=np.float64).tolist()
+    wall_start = time.perf_counter()
+    for k, current_inflow in enumerate(inflows):
+        clock_time[0] = origin + k * step
+        if k % publish_every == 0:
+            power_outflow = positions[0] * capacity[0] / 100
+            outflow = power_outflow + sum(position * gate_capacity / 100
+                                          for position, gate_capacity in zip(positions[1:], spillway_capacity))
+        net = current_inflow - outflow
+        if previous_net is not None:
+            volume += half_step * (previous_net + net)
+        previous_net = net
+        height = min(max(volume * height_scale, 0.0), DAM_HEIGHT)
+
+        fsm.inflow, fsm.outflow, fsm.volume, fsm.height = current_inflow, outflow, volume, height
+        state = fsm.state
+        fsm.execute_state()
+        if fsm.state != state:
+            transitions += 1
+            state = fsm.state
+        for gate_id, target in fsm.actions.items():
+            position = gate_index.get(gate_id)
+            if position is None:
+                continue
+            target = min(max(target, 0.0), 100.0)
+            current = positions[position]
+            if target == current:
+                continue
+            if abs(target - current) >= deadband or target == 0 or target == 100:
+                positions[position] = target
+                commands_sent += 1
+            else:
+                commands_suppressed += 1
+
+        step_outflow[k] = outflow
+        step_power[k] = power_outflow
+        step_height[k] = height
+        step_state[k] = state
+        if state == "BALANCE" and fsm.balance_fsm:
+            step_balance[k] = fsm.balance_fsm.state
+    wall = time.perf_counter() - wall_start
+
+    hours = -(-steps * step // 3600)
+    hour_index = (np.arange(steps) * step) // 3600
+    heights = np.asarray(step_height)
+    inflow_m3 = np.bincount(hour_index, weights=inflows, minlength=hours) * step
+    outflow_m3 = np.bincount(hour_index, weights=step_outflow, minlength=hours) * step
+    power_m3 = np.bincount(hour_index, weights=step_power, minlength=hours) * step
+    hourly_height = np.zeros(hours)
+    hourly_height[hour_index] = heights  # Ultima altezza di ogni ora
+    state_counts = pd.Series(step_state).value_counts()
+    balance_counts = pd.Series(step_balance).value_counts()
+    critical_height = DAM_CRITICAL_HEIGHT * DAM_HEIGHT
+    above = heights >= critical_height
+    below = ~above & (heights < DAM_MIN_HEIGHT * DAM_HEIGHT)
+
+    simulated = steps * step
+    table = pd.DataFrame({
+        "time": pd.date_range(start, periods=hours, freq="h"),
+        "inflow_m3": inflow_m3,
+        "outflow_m3": outflow_m3,
+        "power_outflow_m3": power_m3,
+        "spillway_outflow_m3": outflow_m3 - power_m3,
+        "height_m": hourly_height,
+    })
+    summary = {
+        "start": start.isoformat(),
+        "simulated_days": simulated / 86400,
+        "steps": steps,
+        "step_s": step,
+        "wall_s": wall,
+        "speedup": simulated / wall if wall else float("inf"),
+        "initial_volume_m3": float(initial_volume),
+        "final_volume_m3": volume,
+        "min_height_m": float(heights.min()) if steps else float("inf"),
+        "max_height_m": float(heights.max()) if steps else 0.0,
+        "hours_above_critical": int(above.sum()) * step / 3600,
+        "hours_below_min": int(below.sum()) * step / 3600,
+        "inflow_hm3": inflow_m3.sum() / 1e6,
+        "power_outflow_hm3": power_m3.sum() / 1e6,
+        "spillway_outflow_hm3": (outflow_m3.sum() - power_m3.sum()) / 1e6,
+        "state_share": {state: int(state_counts.get(state, 0)) / steps for state in STATES},
+        "balance_share": {state: int(balance_counts.get(state, 0)) / steps for state in BALANCE_STATES},
+        "transitions": transitions,
+        "commands_sent": commands_sent,
+        "commands_suppressed": commands_suppressed,
+    }
+    return summary, table
+
+
+def print_summary(summary):
+    print(f"SIMULATION: {summary['simulated_days']:.0f} days ({summary['steps']} steps of {summary['step_s']} s) "
+          f"in {summary['wall_s']:.1f} s ({summary['speedup']:,.0f}x real time)")
+    print(f"SIMULATION: Height {summary['min_height_m']:.2f}-{summary['max_height_m']:.2f} m, "
+          f"{summary['hours_above_critical']:.1f} h above critical, {summary['hours_below_min']:.1f} h below minimum")
+    print(f"SIMULATION: Inflow {summary['inflow_hm3']:.1f} hm³, power gate {summary['power_outflow_hm3']:.1f} hm³, "
+          f"spillways {summary['spillway_outflow_hm3']:.1f} hm³, final volume {summary['final_volume_m3'] / 1e6:.2f} hm³")
+    print("SIMULATION: Time per state: " + ", ".join(
+        f"{state} {share:.1%}" for state, share in {**summary["state_share"], **summary["balance_share"]}.items()))
+    print(f"SIMULATION: {summary['transitions']} state transitions, {summary['commands_sent']} gate commands sent, "
+          f"{summary['commands_suppressed']} suppressed by the deadband")
+
+
+def prepare_inputs(args):
+    """Inflow per passo e previsione del PLANNER a partire dagli argomenti della riga di comando."""
+    csv_files = flow_files(args.flows)
+    year = args.year or complete_years(csv_files)[-1]
+    hours, rivers = load_observed_inflow(csv_files, year)
+    start = datetime(year, 1, 1)
+    hourly_inflow = np.sum(list(rivers.values()), axis=0)
+    days = args.days or len(hours) / 24
+    steps = int(days * 86400 // args.step)
+    inflow = step_inflow(hourly_inflow, start, steps, args.step, solar=not args.no_solar, noise=args.noise, seed=args.seed)
+
+    if args.models:
+        forecast_index = model_forecast(args.models, start, len(hours) + 180 * 24)
+    else:
+        forecast_index = observed_forecast(start, hourly_inflow)
+    print(f"SIMULATION: {year}, rivers {', '.join(rivers)}, forecast from {forecast_index.version}")
+    return start, inflow, ReplayForecast(forecast_index)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Simulazione a ciclo chiuso della diga più veloce del tempo reale.")
+    parser.add_argument("--flows", nargs="*", help=f"File *{FLOW_SUFFIX} dei fiumi (default: tutti quelli in TRAINING)")
+    parser.add_argument("--year", type=int, help="Anno da riprodurre (default: l'ultimo completo per tutti i fiumi)")
+    parser.add_argument("--days", type=float, help="Giorni da simulare (default: l'anno intero)")
+    parser.add_argument("--step", type=int, default=QUERY_INTERVAL, help="Passo di controllo (s), default QUERY_INTERVAL")
+    parser.add_argument("--initial-volume", type=float, default=DAM_VOLUME, help="Volume iniziale (m³)")
+    parser.add_argument("--models", nargs="*", help="Modelli .pkl per la previsione (default: previsione perfetta dai dati)")
+    parser.add_argument("--no-solar", action="store_true", help="Esclude la pompa solare dall'inflow")
+    parser.add_argument("--noise", action="store_true", help="Variabilità casuale ±(5-10)%% dei sensori")
+    parser.add_argument("--seed", type=int, default=42, help="Seme della variabilità dei sensori")
+    parser.add_argument("--output", help="CSV con l'andamento orario della simulazione")
+    parser.add_argument("--balance-mode", choices=("fsm", "mpc"), default="fsm",
+                        help="Controllo dello stato BALANCE: BalanceFSM oppure PredictiveBalance")
+    parser.add_argument("--balance-params", help="JSON con i parametri del controllo di BALANCE (es. '{\"target_level\": 0.9}')")
+    parser.add_argument("--verbose", action="store_true", help="Mantiene le stampe del PLANNER")
+    args = parser.parse_args()
+
+    if not args.verbose:
+        quiet_planner()
+    start, inflow, forecast = prepare_inputs(args)
+    balance_params = json.loads(args.balance_params) if args.balance_params else None
+    summary, table = simulate(inflow, start, forecast, args.initial_volume, args.step,
+                              balance_params=balance_params, balance_mode=args.balance_mode)
+    print_summary(summary)
+    if args.output:
+        table.to_csv(args.output, index=False)
+        print(f"SIMULATION: Hourly trace saved to '{args.output}'.")
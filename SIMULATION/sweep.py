@@ -0,0 +1,398 @@
+import os
+import json
+import time
+import hashlib
+import inspect
+import argparse
+import itertools
+from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np  # type: ignore
+import pandas as pd  # type: ignore
+import simulator
+from simulator import (DAM_CRITICAL_HEIGHT, DAM_HEIGHT, DAM_MIN_HEIGHT, DAM_TOTAL_VOLUME, DAM_VOLUME,
+                       EXECUTOR_DEADBAND, GATE_OUTFLOW, GATE_PUBLISH_DELAY, POWER_GATE_OUTFLOW, QUERY_INTERVAL,
+                       SPILLWAY_GATE_COUNT, complete_years, flow_files, load_observed_inflow, observed_forecast,
+                       step_inflow)
+
+BalanceFSM = simulator.planner_balance.BalanceFSM
+HORIZON_HOURS = [hours for hours, _ in BalanceFSM.HORIZON_WEIGHTS]
+
+# Stati di DamFSM e di BalanceFSM come codici interi
+IDLE, FILL, BALANCE, EMERGENCY = range(4)
+INITIAL, MID, FINAL = range(3)
+
+# Griglia predefinita: 3 x 3 x 3 x 3 x 3 x 3 x 4 = 2916 configurazioni
+DEFAULT_GRID = {
+    "initial_inflow_ratio": [0.3, 0.5, 0.7],
+    "mid_inflow_ratio": [0.5, 0.7, 0.9],
+    "mid_threshold": [0.7, 0.8, 0.9],
+    "final_threshold": [0.9, 0.95, 0.98],
+    "interpolation_gain": [0.05, 0.1, 0.2],
+    "current_inflow_weight": [0.3, 0.5, 0.7],
+    "horizon_weights": [
+        [0.2, 0.1, 0.1, 0.05, 0.05],
+        [0.4, 0.1, 0.0, 0.0, 0.0],
+        [0.1, 0.1, 0.1, 0.1, 0.1],
+        [0.0, 0.0, 0.0, 0.0, 0.0],
+    ],
+}
+
+# Griglia di --check: ogni configurazione viene ripetuta con la DamFSM reale e confrontata con simulate_batch
+CHECK_GRID = {
+    "mid_threshold": [0.7, 0.9],
+    "final_threshold": [0.9, 0.98],
+    "interpolation_gain": [0.05, 0.2],
+}
+CHECK_DAYS = 30
+
+# Impronta del codice del PLANNER replicato da simulate_batch (BalanceFSM e stati di DamFSM).
+# Se cambia, simulate_batch va riallineato e l'impronta aggiornata (il valore atteso è stampato da --check).
+PLANNER_FINGERPRINT = "9fe80f2ac104a1bf"
+
+METRICS = ["spillway_hm3", "power_hm3", "emergency_hours", "hours_above_critical", "hours_below_min",
+           "gate_commands", "suppressed_commands", "transitions", "final_volume_m3"]
+
+# Dati dei fiumi e input già preparati per anno, uno per processo worker (riusati tra i task)
+_years = {}
+_year_inputs = {}
+
+
+def parameter_grid(grid):
+    """Tutte le combinazioni della griglia, completate con i valori predefiniti di BalanceFSM."""
+    defaults = BalanceFSM.default_parameters()
+    unknown = set(grid) - set(defaults)
+    if unknown:
+        raise ValueError(f"Unknown BalanceFSM parameters: {', '.join(sorted(unknown))}")
+    names = list(grid)
+    return [dict(defaults, **dict(zip(names, values))) for values in itertools.product(*(grid[name] for name in names))]
+
+
+def planner_fingerprint():
+    """SHA-256 del sorgente di BalanceFSM e dei metodi di DamFSM che simulate_batch riproduce."""
+    DamFSM = simulator.planner_balance.DamFSM
+    sources = [inspect.getsource(BalanceFSM)] + [inspect.getsource(getattr(DamFSM, name))
+                                                 for name in ("execute_state", "idle", "fill", "balance", "emergency")]
+    return hashlib.sha256("".join(sources).encode()).hexdigest()[:16]
+
+
+def check_planner_sync():
+    """True se il PLANNER non è cambiato rispetto alla versione replicata da simulate_batch."""
+    fingerprint = planner_fingerprint()
+    if fingerprint != PLANNER_FINGERPRINT:
+        print(f"SWEEP: BalanceFSM/DamFSM changed (fingerprint {fingerprint}, expected {PLANNER_FINGERPRINT}): "
+              f"update simulate_batch, run --check and set PLANNER_FINGERPRINT = \"{fingerprint}\"")
+        return False
+    return True
+
+
+def horizon_means(index, hours):
+    """
+    Medie previste per ogni orizzonte di BalanceFSM, per ogni posizione oraria dell'orologio virtuale
+    (le stesse che il PLANNER ottiene da ForecastHorizonCache.mean): array (hours + 1, orizzonti).
+    """
+    return np.array([[index.mean(index.start + position * index.step, horizon) for horizon in HORIZON_HOURS]
+                     for position in range(hours + 1)])
+
+
+def simulate_batch(inflow, means, configs, initial_volume=DAM_VOLUME, step=QUERY_INTERVAL,
+                   gate_publish_delay=GATE_PUBLISH_DELAY, deadband=EXECUTOR_DEADBAND):
+    """
+    Versione vettoriale di simulator.simulate: le stesse regole di DamFSM/BalanceFSM, gate ed EXECUTOR
+    applicate in un unico ciclo sul tempo a un array di configurazioni (una colonna per configurazione).
+    Le operazioni seguono lo stesso ordine del codice del PLANNER, quindi le decisioni coincidono
+    con quelle di simulate (verificabile con --verify).
+    :param means: Medie previste per posizione oraria (vedi horizon_means).
+    :param configs: Lista di parametri di BalanceFSM (vedi parameter_grid).
+    :return: Dizionario metrica -> array con un valore per configurazione.
+    """
+    size = len(configs)
+    # Un array per parametro di BalanceFSM (stessi nomi di default_parameters), una colonna per configurazione
+    params = {name: np.array([config[name] for config in configs]) for name in BalanceFSM.default_parameters()}
+    initial_ratio = params["initial_inflow_ratio"]
+    mid_ratio = params["mid_inflow_ratio"]
+    gain = params["interpolation_gain"]
+    current_weight = params["current_inflow_weight"]
+    weights = params["horizon_weights"]
+    # Soglie, apertura obiettivo e interpolazione calcolate dai metodi statici di BalanceFSM
+    mid_threshold = BalanceFSM.threshold(simulator, params["mid_threshold"])
+    final_threshold = BalanceFSM.threshold(simulator, params["final_threshold"])
+    critical_height = DAM_CRITICAL_HEIGHT * DAM_HEIGHT
+    min_level = DAM_MIN_HEIGHT * DAM_HEIGHT
+    height_scale = DAM_HEIGHT / DAM_TOTAL_VOLUME
+
+    state = np.full(size, IDLE)
+    balance_state = np.full(size, INITIAL)       # BalanceFSM parte da INITIAL e mantiene lo stato tra le visite
+    power_action = np.zeros(size)                # Azioni del PLANNER (apertura % richiesta)
+    spillway_action = np.zeros(size)
+    power_position = np.zeros(size)              # Apertura reale dei gate dopo la deadband dell'EXECUTOR
+    spillway_position = np.zeros(size)           # Tutti gli Spillway ricevono lo stesso comando
+    power_outflow = np.zeros(size)
+    outflow = np.zeros(size)
+    volume = np.full(size, float(initial_volume))
+    previous_net = None
+    publish_every = max(1, round(gate_publish_delay / step))
+    horizon_part = np.zeros(size)
+    horizon_position = -1
+
+    totals = {name: np.zeros(size) for name in ("power", "outflow")}
+    counts = {name: np.zeros(size, dtype=np.int64) for name in
+              ("emergency", "above_critical", "below_min", "sent", "suppressed", "transitions")}
+
+    for k, current_inflow in enumerate(np.asarray(inflow, dtype=np.float64).tolist()):
+        if k % publish_every == 0:
+            # Outflow del MONITOR sull'ultimo stato pubblicato dai gate (somma nello stesso ordine di simulate)
+            power_outflow = power_position * POWER_GATE_OUTFLOW / 100
+            spillway_outflow = spillway_position * GATE_OUTFLOW / 100
+            spillway_total = 0
+            for _ in range(SPILLWAY_GATE_COUNT):
+                spillway_total = spillway_total + spillway_outflow
+            outflow = power_outflow + spillway_total
+        net = current_inflow - outflow
+        if previous_net is not None:
+            volume += 0.5 * (previous_net + net) * step
+        previous_net = net
+        height = np.minimum(np.maximum(volume * height_scale, 0.0), DAM_HEIGHT)
+
+        new_state = state.copy()
+        if k == 0:
+            # IDLE: solo transizioni, nessuna azione
+            idle = state == IDLE
+            new_state[idle & (height < min_level)] = FILL
+            new_state[idle & (min_level <= height) & (height < critical_height)] = BALANCE
+            new_state[idle & (height >= critical_height)] = EMERGENCY
+        else:
+            fill = state == FILL
+            balance = state == BALANCE
+            emergency = state == EMERGENCY
+
+            # FILL: gate chiusi
+            power_action[fill] = 0
+            spillway_action[fill] = 0
+            to_balance = fill & (height >= min_level)
+            new_state[to_balance] = BALANCE
+            new_state[fill & ~to_balance & (height >= critical_height)] = EMERGENCY
+
+            # BALANCE: Spillway chiusi, Power Gate interpolato verso l'obiettivo dello stato di BalanceFSM
+            spillway_action[balance] = 0
+            position = -(-k * step // 3600)
+            if position != horizon_position:
+                horizon_position = position
+                horizon_part = 0
+                for column in range(len(HORIZON_HOURS)):
+                    horizon_part = horizon_part + weights[:, column] * means[min(position, len(means) - 1), column]
+            final = balance_state == FINAL
+            predicted = np.where(final, current_weight * current_inflow + horizon_part,
+                                 current_inflow * np.where(balance_state == INITIAL, initial_ratio, mid_ratio))
+            target_percentage = BalanceFSM.target_percentage(predicted, POWER_GATE_OUTFLOW)
+            np.copyto(power_action, BalanceFSM.step_toward(power_action, target_percentage, gain), where=balance)
+            balance_initial = balance & (balance_state == INITIAL)
+            balance_mid = balance & (balance_state == MID)
+            balance_final = balance & final
+            balance_state[balance_initial & (height >= mid_threshold)] = MID
+            balance_state[balance_mid & (height >= final_threshold)] = FINAL
+            balance_state[balance_final & (height <= final_threshold)] = MID
+            new_state[balance_final & (height >= critical_height)] = EMERGENCY
+
+            # EMERGENCY: tutti i gate aperti
+            power_action[emergency] = 100
+            spillway_action[emergency] = 100
+            new_state[emergency & (height < critical_height)] = BALANCE
+
+            # EXECUTOR e gate: comandi entro la deadband soppressi (needs_update)
+            for action, positions, gates in ((power_action, power_position, 1),
+                                              (spillway_action, spillway_position, SPILLWAY_GATE_COUNT)):
+                target = np.minimum(np.maximum(action, 0.0), 100.0)
+                changed = target != positions
+                send = changed & ((np.abs(target - positions) >= deadband) | (target == 0) | (target == 100))
+                np.copyto(positions, target, where=send)
+                counts["sent"] += send * gates
+                counts["suppressed"] += (changed & ~send) * gates
+
+        counts["transitions"] += new_state != state
+        state = new_state
+        totals["power"] += power_outflow
+        totals["outflow"] += outflow
+        counts["emergency"] += state == EMERGENCY
+        above = height >= critical_height
+        counts["above_critical"] += above
+        counts["below_min"] += ~above & (height < min_level)
+
+    return {
+        "spillway_hm3": (totals["outflow"] - totals["power"]) * step / 1e6,
+        "power_hm3": totals["power"] * step / 1e6,
+        "emergency_hours": counts["emergency"] * step / 3600,
+        "hours_above_critical": counts["above_critical"] * step / 3600,
+        "hours_below_min": counts["below_min"] * step / 3600,
+        "gate_commands": counts["sent"],
+        "suppressed_commands": counts["suppressed"],
+        "transitions": counts["transitions"],
+        "final_volume_m3": volume,
+    }
+
+
+def year_inputs(year, step, days=None, solar=True):
+    """Inflow per passo e medie previste di un anno (preparati una volta per processo)."""
+    key = (year, step, days, solar)
+    if key not in _year_inputs:
+        hourly_inflow = _years[year]
+        start = datetime(year, 1, 1)
+        steps = int((days or len(hourly_inflow) / 24) * 86400 // step)
+        inflow = step_inflow(hourly_inflow, start, steps, step, solar=solar)
+        means = horizon_means(observed_forecast(start, hourly_inflow), -(-steps * step // 3600))
+        _year_inputs[key] = (start, inflow, means)
+    return _year_inputs[key]
+
+
+def init_worker(years):
+    """Inizializza un processo worker con l'inflow orario di ogni anno."""
+    _years.update(years)
+
+
+def evaluate_chunk(year, first, configs, step, days=None, solar=True):
+    """Valuta un blocco di configurazioni su un anno; restituisce le metriche e il tempo di calcolo."""
+    start = time.perf_counter()
+    _, inflow, means = year_inputs(year, step, days, solar)
+    metrics = simulate_batch(inflow, means, configs, step=step)
+    return {"year": year, "first": first, "metrics": {name: values.tolist() for name, values in metrics.items()},
+            "wall": time.perf_counter() - start}
+
+
+def run_sweep(configs, years, step=QUERY_INTERVAL, days=None, solar=True, workers=None, chunk_size=500):
+    """
+    Valuta tutte le configurazioni su tutti gli anni con un pool di processi: ogni task è
+    (anno, blocco di chunk_size configurazioni), simulate in un unico ciclo vettoriale.
+    :param years: Dizionario anno -> inflow orario osservato dei fiumi.
+    :return: DataFrame con una riga per (configurazione, anno).
+    """
+    workers = workers or os.cpu_count()
+    if step != QUERY_INTERVAL:
+        print(f"SWEEP: WARNING - step {step} s differs from QUERY_INTERVAL ({QUERY_INTERVAL} s): "
+              f"time above critical and spill depend on the step, the ranking may not match the deployed loop")
+    rows = []
+    start = time.perf_counter()
+    task_wall = 0.0
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=(years,)) as pool:
+        pending = [pool.submit(evaluate_chunk, year, first, configs[first:first + chunk_size], step, days, solar)
+                   for year in years for first in range(0, len(configs), chunk_size)]
+        print(f"SWEEP: {len(configs)} configurations x {len(years)} years in {len(pending)} tasks on {workers} workers "
+              f"(step {step} s)")
+        for done, future in enumerate(as_completed(pending), 1):
+            result = future.result()
+            task_wall += result["wall"]
+            for offset in range(len(result["metrics"]["spillway_hm3"])):
+                row = {"config": result["first"] + offset, "year": result["year"]}
+                row.update({name: values[offset] for name, values in result["metrics"].items()})
+                rows.append(row)
+            print(f"SWEEP: Task {done}/{len(pending)} ({result['year']}, configs {result['first']}+) "
+                  f"in {result['wall']:.1f} s")
+    wall = time.perf_counter() - start
+    print(f"SWEEP: {len(configs) * len(years)} config-years in {wall:.1f} s "
+          f"(parallel efficiency {task_wall / (wall * workers) if wall else 0:.0%} on {workers} workers)")
+    return pd.DataFrame(rows).sort_values(["config", "year"]).reset_index(drop=True)
+
+
+def summarize(results, configs, sort_keys):
+    """Metriche medie per anno di ogni configurazione, con i parametri, ordinate secondo sort_keys."""
+    table = results.groupby("config")[METRICS].mean()
+    table["worst_emergency_hours"] = results.groupby("config")["emergency_hours"].max()
+    parameters = pd.DataFrame([{name: json.dumps(value) if isinstance(value, list) else value
+                                for name, value in config.items()} for config in configs])
+    table = parameters.join(table)
+    columns = [key.lstrip("-") for key in sort_keys]
+    ascending = [not key.startswith("-") for key in sort_keys]
+    return table.sort_values(columns, ascending=ascending).rename_axis("config").reset_index()
+
+
+def verify(table, configs, year, hourly_inflow, step, count, days=None, solar=True):
+    """Ripete le prime 'count' configurazioni con la DamFSM reale (simulator.simulate) e confronta le metriche."""
+    simulator.quiet_planner()
+    start = datetime(year, 1, 1)
+    steps = int((days or len(hourly_inflow) / 24) * 86400 // step)
+    inflow = step_inflow(hourly_inflow, start, steps, step, solar=solar)
+    forecast = simulator.ReplayForecast(observed_forecast(start, hourly_inflow))
+    means = horizon_means(forecast.index, -(-steps * step // 3600))
+    selected = list(table["config"].head(count))
+    batches = simulate_batch(inflow, means, [configs[config_index] for config_index in selected], step=step)
+    mismatches = 0
+    for column, config_index in enumerate(selected):
+        summary, _ = simulator.simulate(inflow, start, forecast, step=step, balance_params=configs[config_index])
+        batch = {name: values[column] for name, values in batches.items()}
+        pairs = {
+            "spillway_hm3": summary["spillway_outflow_hm3"],
+            "power_hm3": summary["power_outflow_hm3"],
+            "emergency_hours": summary["state_share"]["EMERGENCY"] * summary["steps"] * step / 3600,
+            "gate_commands": summary["commands_sent"],
+            "transitions": summary["transitions"],
+        }
+        differences = {name: (batch[name], value) for name, value in pairs.items() if not np.isclose(batch[name], value)}
+        mismatches += bool(differences)
+        print(f"SWEEP: Verify config {config_index} on {year} with DamFSM ({summary['wall_s']:.1f} s): "
+              + ("match" if not differences else f"MISMATCH {differences}"))
+    return mismatches
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Sweep parallelo dei parametri di BalanceFSM sugli anni storici.")
+    parser.add_argument("--grid", help="JSON con parametro -> lista di valori (default: DEFAULT_GRID)")
+    parser.add_argument("--sample", type=int, help="Valuta solo un campione casuale di N configurazioni della griglia")
+    parser.add_argument("--seed", type=int, default=42, help="Seme del campionamento")
+    parser.add_argument("--flows", nargs="*", help="File *_hourly_mean_flow.csv dei fiumi (default: tutti quelli in TRAINING)")
+    parser.add_argument("--years", nargs="*", type=int, help="Anni da simulare (default: tutti quelli completi)")
+    parser.add_argument("--days", type=float, help="Giorni simulati per anno (default: l'anno intero)")
+    parser.add_argument("--step", type=int, default=QUERY_INTERVAL,
+                        help="Passo di controllo (s), default QUERY_INTERVAL; un passo diverso cambia i risultati")
+    parser.add_argument("--no-solar", action="store_true", help="Esclude la pompa solare dall'inflow")
+    parser.add_argument("--workers", type=int, help="Processi worker (default: tutti i core)")
+    parser.add_argument("--chunk-size", type=int, default=500, help="Configurazioni per task")
+    parser.add_argument("--sort", default="emergency_hours,spillway_hm3,-power_hm3",
+                        help="Metriche di ordinamento separate da virgola ('-' per decrescente)")
+    parser.add_argument("--output", default="sweep_results.csv", help="CSV delle metriche per configurazione")
+    parser.add_argument("--check", action="store_true",
+                        help=f"Solo controllo (per la CI): impronta del PLANNER e tutte le configurazioni di CHECK_GRID "
+                             f"ripetute con la DamFSM reale su {CHECK_DAYS} giorni del primo anno; codice 1 se divergono")
+    parser.add_argument("--verify", type=int, default=1,
+                        help="Ripete le prime N configurazioni con la DamFSM reale sul primo anno "
+                             "(default 1: una divergenza di simulate_batch dal PLANNER fa fallire lo sweep; 0 la disattiva)")
+    args = parser.parse_args()
+
+    grid = DEFAULT_GRID
+    if args.grid:
+        with open(args.grid) as grid_file:
+            grid = json.load(grid_file)
+    configs = parameter_grid(grid)
+    if args.sample and args.sample < len(configs):
+        chosen = np.random.default_rng(args.seed).choice(len(configs), size=args.sample, replace=False)
+        configs = [configs[index] for index in sorted(chosen)]
+
+    csv_files = flow_files(args.flows)
+    years = {}
+    for year in args.years or complete_years(csv_files):
+        _, rivers = load_observed_inflow(csv_files, year)
+        years[year] = np.sum(list(rivers.values()), axis=0)
+
+    if args.check:
+        synced = check_planner_sync()
+        year = next(iter(years))
+        configs = parameter_grid(CHECK_GRID)
+        table = pd.DataFrame({"config": range(len(configs))})
+        mismatches = verify(table, configs, year, years[year], args.step, len(configs), args.days or CHECK_DAYS,
+                            not args.no_solar)
+        print(f"SWEEP: Check {'passed' if synced and not mismatches else 'FAILED'} "
+              f"({len(configs)} configurations, {mismatches} mismatches)")
+        raise SystemExit(0 if synced and not mismatches else 1)
+    if not check_planner_sync():
+        raise SystemExit(1)
+
+    results = run_sweep(configs, years, args.step, args.days, not args.no_solar, args.workers, args.chunk_size)
+    table = summarize(results, configs, args.sort.split(","))
+    table.to_csv(args.output, index=False)
+    results.to_csv(os.path.splitext(args.output)[0] + "_by_year.csv", index=False)
+    with pd.option_context("display.width", 200, "display.max_columns", None):
+        print(table.head(10).to_string(index=False))
+    print(f"SWEEP: Results saved to '{args.output}'.")
+
+    if args.verify:
+        year = next(iter(years))
+        mismatches = verify(table, configs, year, years[year], args.step, args.verify, args.days, not args.no_solar)
+        raise SystemExit(1 if mismatches else 0)
@@ -1,9 +1,14 @@
 import os
+import sys
+import argparse
 import pandas as pd # type: ignore
 import numpy as np # type: ignore
 import joblib # type: ignore
 from datetime import datetime, timedelta
 import random
+# inflow_table è condiviso con i servizi nella directory COMMON
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "COMMON"))
+from inflow_table import SklearnInflowModel
 
 
 # Funzione per generare 5 date casuali durante l'anno con orari casuali
@@ -24,26 +29,12 @@ def generate_random_test_dates(year, n_dates=5):
 def test_model(model, river_name, test_dates):
     print(f"Testing model: {river_name}")
     results = []
-    for date in test_dates:
-        # Crea feature stagionali per la data
-        day_of_year = date.timetuple().tm_yday
-        hour_of_day = date.hour
-        sin_day = np.sin(2 * np.pi * day_of_year / 365)
-        cos_day = np.cos(2 * np.pi * day_of_year / 365)
-        sin_hour = np.sin(2 * np.pi * hour_of_day / 24)
-        cos_hour = np.cos(2 * np.pi * hour_of_day / 24)
-
-        # Prepara i dati di input per il modello
-        X_input = pd.DataFrame([{
-            "sin_day": sin_day,
-            "cos_day": cos_day,
-            "sin_hour": sin_hour,
-            "cos_hour": cos_hour
-        }])
-
-        # Predici il valore
-        prediction = model.predict(X_input)[0]
-        print("Test su 5 date random ed orari random")
+    # Predici tutte le date con una sola predict (feature codificate dal FeatureEncoder)
+    day_of_year = [date.timetuple().tm_yday for date in test_dates]
+    hour_of_day = [date.hour for date in test_dates]
+    predictions = model.predict_many(day_of_year, hour_of_day)
+    print("Test su 5 date random ed orari random")
+    for date, prediction in zip(test_dates, predictions):
         results.append({"Date": date, "Prediction": prediction})
 
     # Stampa i primi n risultati
@@ -51,50 +42,83 @@ def test_model(model, river_name, test_dates):
         print(f"Data: {result['Date'].strftime('%Y-%m-%d %H:%M')}, Predizione: {result['Prediction']:.2f} m³/s")
 
 def calculate_total_volume(model):
-    total_volume = 0
     start_date = datetime(2024, 1, 1)  # Modifica l'anno se necessario
-    for day in range(365):  # Per ciascun giorno dell'anno
-        for hour in range(24):  # Per ciascuna ora
-            current_date = start_date + timedelta(days=day, hours=hour)
-            # Crea feature stagionali per la data
-            day_of_year = current_date.timetuple().tm_yday
-            hour_of_day = current_date.hour
-            sin_day = np.sin(2 * np.pi * day_of_year / 365)
-            cos_day = np.cos(2 * np.pi * day_of_year / 365)
-            sin_hour = np.sin(2 * np.pi * hour_of_day / 24)
-            cos_hour = np.cos(2 * np.pi * hour_of_day / 24)
-
-            # Prepara i dati di input per il modello
-            X_input = pd.DataFrame([{
-                "sin_day": sin_day,
-                "cos_day": cos_day,
-                "sin_hour": sin_hour,
-                "cos_hour": cos_hour
-            }])
-
-            # Predici il valore e somma
-            prediction = model.predict(X_input)[0]
-            total_volume += prediction
-
-    return total_volume
+    # Tutte le 365 x 24 ore dell'anno in una sola predict
+    hours = pd.date_range(start_date, periods=365 * 24, freq="h")
+    return float(model.predict_many(hours.dayofyear, hours.hour).sum())
+
+
+def observed_flow_file(pkl_file, data_dir="."):
+    """CSV delle portate orarie osservate del fiume del modello (es. boite_random_forest.pkl -> boite_hourly_mean_flow.csv)."""
+    river_name = os.path.basename(pkl_file).split("_")[0]
+    return os.path.join(data_dir, f"{river_name}_hourly_mean_flow.csv")
+
+
+def validation_report(model, observed_file, min_coverage=0.9):
+    """
+    Confronta le predizioni con le portate osservate su tutte le ore del CSV in una sola predict.
+    I volumi mensili (hm³ = milioni di m³) sono sommati sulle stesse ore per osservato e predetto;
+    i mesi coperti per meno di min_coverage delle ore sono esclusi dalle statistiche mensili.
+    :return: (tabella per mese dell'anno, metriche orarie e annuali)
+    """
+    observed = pd.read_csv(observed_file, parse_dates=['DateTime'])
+    date_time = observed['DateTime'].dt
+    observed_flow = observed['PORT_MED'].to_numpy(dtype=np.float64)
+    predicted_flow = model.predict_many(date_time.dayofyear.to_numpy(), date_time.hour.to_numpy())
+
+    # Volume orario in hm³: portata (m³/s) per 3600 s
+    hourly = pd.DataFrame({
+        'year': date_time.year,
+        'month': date_time.month,
+        'hours': 1,
+        'observed': observed_flow * 3600 / 1e6,
+        'predicted': predicted_flow * 3600 / 1e6,
+    })
+    monthly = hourly.groupby(['year', 'month']).sum().reset_index()
+    month_start = pd.to_datetime(dict(year=monthly['year'], month=monthly['month'], day=1))
+    monthly = monthly[monthly['hours'] >= min_coverage * month_start.dt.days_in_month * 24]
+
+    monthly['error'] = monthly['predicted'] - monthly['observed']
+    monthly['abs_error'] = monthly['error'].abs()
+    monthly['squared_error'] = monthly['error'] ** 2
+    by_month = monthly.groupby('month').agg(
+        years=('year', 'size'),
+        observed_hm3=('observed', 'mean'),
+        predicted_hm3=('predicted', 'mean'),
+        mae_hm3=('abs_error', 'mean'),
+        mse_hm3=('squared_error', 'mean'),
+    )
+    by_month['bias_pct'] = (by_month['predicted_hm3'] / by_month['observed_hm3'] - 1) * 100
+    by_month['rmse_hm3'] = np.sqrt(by_month.pop('mse_hm3'))
+    by_month = by_month.reset_index()
+
+    error = predicted_flow - observed_flow
+    summary = {
+        'hours': len(observed_flow),
+        'hourly_mae': float(np.mean(np.abs(error))),
+        'hourly_rmse': float(np.sqrt(np.mean(error ** 2))),
+        'hourly_r2': float(1 - np.sum(error ** 2) / np.sum((observed_flow - observed_flow.mean()) ** 2)),
+        'monthly_mape_pct': float(np.mean(monthly['abs_error'] / monthly['observed']) * 100),
+        'observed_annual_hm3': float(by_month['observed_hm3'].sum()),
+        'predicted_annual_hm3': float(by_month['predicted_hm3'].sum()),
+    }
+    return by_month, summary
+
+
+def print_validation_report(pkl_file, by_month, summary):
+    print(f"Validazione di {pkl_file} su {summary['hours']} ore osservate")
+    print(f"{'Mese':>4} {'anni':>5} {'oss. hm³':>10} {'pred. hm³':>10} {'bias %':>8} {'MAE hm³':>9} {'RMSE hm³':>9}")
+    for row in by_month.itertuples():
+        print(f"{row.month:>4} {row.years:>5} {row.observed_hm3:>10.2f} {row.predicted_hm3:>10.2f} "
+              f"{row.bias_pct:>8.1f} {row.mae_hm3:>9.2f} {row.rmse_hm3:>9.2f}")
+    print(f"Anno medio: osservato {summary['observed_annual_hm3']:.2f} hm³, predetto {summary['predicted_annual_hm3']:.2f} hm³")
+    print(f"Orario: MAE {summary['hourly_mae']:.3f} m³/s, RMSE {summary['hourly_rmse']:.3f} m³/s, "
+          f"R² {summary['hourly_r2']:.3f} | mensile: MAPE {summary['monthly_mape_pct']:.1f}%")
+
+
 def predict_volume(day_of_year, hour_of_day):
-    # Calcola le feature sinusoidali
-    sin_day = np.sin(2 * np.pi * day_of_year / 365)
-    cos_day = np.cos(2 * np.pi * day_of_year / 365)
-    sin_hour = np.sin(2 * np.pi * hour_of_day / 24)
-    cos_hour = np.cos(2 * np.pi * hour_of_day / 24)
-
-    # Prepara le feature per la predizione
-    X_input = pd.DataFrame([{
-        'sin_day': sin_day,
-        'cos_day': cos_day,
-        'sin_hour': sin_hour,
-        'cos_hour': cos_hour
-    }])
-
-    # Predizione del volume
-    prediction = model.predict(X_input)[0]
-    return prediction
+    # Predizione del volume (feature sinusoidali calcolate dal FeatureEncoder del modello)
+    return model.predict(day_of_year, hour_of_day)
 
 def predict_manual():
     try:
@@ -115,43 +139,59 @@ def predict_manual():
     except Exception as e:
         print(f"Errore nell'inserimento dei dati: {e}")
 
-# Cerca tutti i file .pkl nella cartella corrente
-current_dir = os.getcwd()
-pkl_files = [file for file in os.listdir(current_dir) if file.endswith(".pkl")]
-
-# Genera date casuali di test
-test_dates = generate_random_test_dates(2024, n_dates=5)  # Cambia l'anno se necessario
-
-# Testa ciascun modello
-for pkl_file in pkl_files:
-    try:
-        # Carica il modello
-        model = joblib.load(pkl_file)
-        river_name = os.path.splitext(pkl_file)[0]
-        print(f"Modello {river_name} caricato con successo.")
-        # Testa il modello
-        # Testa su 5 gg random ad orario random
-        test_model(model, river_name, test_dates)
-        # Calcola il volume in m3 anno per un confronto con i dati reali..
-        calculate_total_vol = calculate_total_volume(model)
-        print("---------------------------")
-        print(f"Volume totale annuo --->>> {calculate_total_vol:.2f}   m³")
-
-        # Calcola la predizione ad oggi, questa funzione sarà usata nel progetto.
-        now = datetime.now()
-        day_of_year = now.timetuple().tm_yday
-        hour_of_day = now.hour
-        # Predizione basata sull'ora corrente
-        predicted_volume = predict_volume(day_of_year, hour_of_day)
-        print("---------------------------")
-        print(f"Volume predetto per oggi {now.strftime('%Y-%m-%d %H:%M:%S')} con {pkl_file} --->>> {predicted_volume:.2f}   m³")
-        print("---------------------------")
-
-
-    except Exception as e:
-        print(f"Errore con il file {pkl_file}: {e}")
-
-
-# Chiamata della funzione manuale
-#predict_manual()
-
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Test dei modelli di portata (.pkl) della directory corrente.")
+    parser.add_argument("models", nargs="*", help="File .pkl da testare (default: tutti i .pkl nella directory corrente)")
+    parser.add_argument("--report", action="store_true",
+                        help="Report di validazione mensile contro <fiume>_hourly_mean_flow.csv invece dei test casuali")
+    parser.add_argument("--data-dir", default=".", help="Directory dei CSV <fiume>_hourly_mean_flow.csv")
+    args = parser.parse_args()
+
+    # Cerca tutti i file .pkl nella cartella corrente
+    current_dir = os.getcwd()
+    pkl_files = args.models or [file for file in os.listdir(current_dir) if file.endswith(".pkl")]
+
+    # Genera date casuali di test
+    test_dates = generate_random_test_dates(2024, n_dates=5)  # Cambia l'anno se necessario
+
+    # Testa ciascun modello
+    for pkl_file in pkl_files:
+        try:
+            # Carica il modello (i nomi delle feature sono validati una volta sola qui)
+            model = SklearnInflowModel(joblib.load(pkl_file))
+            river_name = os.path.splitext(pkl_file)[0]
+            print(f"Modello {river_name} caricato con successo.")
+            if args.report:
+                # Validazione contro le portate osservate, senza test casuali
+                by_month, summary = validation_report(model, observed_flow_file(pkl_file, args.data_dir))
+                print_validation_report(pkl_file, by_month, summary)
+                print(f"Volume totale annuo --->>> {calculate_total_volume(model):.2f}   m³")
+                report_file = f"{river_name}_validation.csv"
+                by_month.to_csv(report_file, index=False)
+                print(f"Report di validazione salvato come '{report_file}'.")
+                print("---------------------------")
+                continue
+            # Testa il modello
+            # Testa su 5 gg random ad orario random
+            test_model(model, river_name, test_dates)
+            # Calcola il volume in m3 anno per un confronto con i dati reali..
+            calculate_total_vol = calculate_total_volume(model)
+            print("---------------------------")
+            print(f"Volume totale annuo --->>> {calculate_total_vol:.2f}   m³")
+
+            # Calcola la predizione ad oggi, questa funzione sarà usata nel progetto.
+            now = datetime.now()
+            day_of_year = now.timetuple().tm_yday
+            hour_of_day = now.hour
+            # Predizione basata sull'ora corrente
+            predicted_volume = predict_volume(day_of_year, hour_of_day)
+            print("---------------------------")
+            print(f"Volume predetto per oggi {now.strftime('%Y-%m-%d %H:%M:%S')} con {pkl_file} --->>> {predicted_volume:.2f}   m³")
+            print("---------------------------")
+
+
+        except Exception as e:
+            print(f"Errore con il file {pkl_file}: {e}")
+
+    # Chiamata della funzione manuale
+    #predict_manual()
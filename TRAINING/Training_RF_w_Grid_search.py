@@ -1,48 +1,47 @@
 import os
+import sys
+import argparse
 import pandas as pd # type: ignore
 import numpy as np # type: ignore
 from sklearn.ensemble import RandomForestRegressor # type: ignore
 from sklearn.model_selection import train_test_split, GridSearchCV # type: ignore
+from sklearn.experimental import enable_halving_search_cv  # type: ignore # noqa: F401
+from sklearn.model_selection import HalvingGridSearchCV  # type: ignore
 from sklearn.metrics import mean_squared_error # type: ignore
-import joblib # type: ignore
+# inflow_table è condiviso con i servizi nella directory COMMON
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "COMMON"))
+from inflow_table import FEATURES
+from river_cache import load_hourly_average
+from compact_models import compact_candidates, export_compact_models
+from parallel_training import export_model, search_table, train_rivers_parallel, write_search_table
 
 # Directory base contenente le cartelle dei fiumi
 base_dir = "fiumi_dati"  # Modifica con il percorso corretto
 
+# Griglia degli iperparametri della Random Forest
+param_grid = {
+    'n_estimators': [50, 100, 200],
+    'max_depth': [10, 20, None],
+    'min_samples_split': [2, 5, 10]
+}
+
 # Funzione per calcolare la media oraria e preparare il dataset
 def calculate_hourly_average(file):
-    # Carica il dataset
-    df = pd.read_csv(file, sep=";")
-
-    # Converti le colonne in numerico
-    df['PORT_MED'] = pd.to_numeric(df['PORT_MED'], errors='coerce')
-    df['ORA'] = pd.to_numeric(df['ORA'], errors='coerce')
-    df['GIORNO'] = pd.to_numeric(df['GIORNO'], errors='coerce')
-    df['MESE'] = pd.to_numeric(df['MESE'], errors='coerce')
-
-    # Rimuovi righe con valori mancanti
-    df = df.dropna(subset=['PORT_MED', 'ORA', 'GIORNO', 'MESE'])
-
-    # Aggiungi una colonna per la data completa
-    df['DateTime'] = pd.to_datetime(dict(year=df['ANNO'], month=df['MESE'], day=df['GIORNO'], hour=df['ORA']))
-
-    # Raggruppa per data e ora e calcola la media
-    hourly_avg = df.groupby('DateTime')['PORT_MED'].mean().reset_index()
-    return hourly_avg
+    # Media oraria con giorno dell'anno e ora già calcolati, dalla cache colonnare (il CSV
+    # viene rianalizzato solo se è cambiato, vedi river_cache.py)
+    return load_hourly_average(file)
 
-# Funzione per eseguire il training per ciascun fiume
-def train_model_for_river(river_name, river_files):
+# Funzione per preparare feature e target di un fiume, già divisi in training e test
+def prepare_dataset(river_name, river_files):
     # Calcola la media oraria per ciascun file
     hourly_dfs = [calculate_hourly_average(file) for file in river_files]
 
     # Combina tutti i dataset
     combined_hourly = pd.concat(hourly_dfs, ignore_index=True)
-    combined_hourly.to_csv(f"{river_name}_hourly_mean_flow.csv", index=False)
+    combined_hourly[['DateTime', 'PORT_MED']].to_csv(f"{river_name}_hourly_mean_flow.csv", index=False)
     print(f"Dataset aggregato orario salvato come '{river_name}_hourly_mean_flow.csv'.")
 
-    # Aggiungi feature temporali (giorno dell'anno, ora del giorno)
-    combined_hourly['DayOfYear'] = combined_hourly['DateTime'].apply(lambda x: pd.to_datetime(x).timetuple().tm_yday)
-    combined_hourly['HourOfDay'] = pd.to_datetime(combined_hourly['DateTime']).dt.hour
+    # Le feature temporali (giorno dell'anno, ora del giorno) arrivano già dalla cache
 
     # Aggiungi feature stagionali (seno e coseno per giorno e ora)
     combined_hourly['sin_day'] = np.sin(2 * np.pi * combined_hourly['DayOfYear'] / 365)
@@ -51,28 +50,42 @@ def train_model_for_river(river_name, river_files):
     combined_hourly['cos_hour'] = np.cos(2 * np.pi * combined_hourly['HourOfDay'] / 24)
 
     # Definisci le feature (X) e il target (y)
-    features = ['sin_day', 'cos_day', 'sin_hour', 'cos_hour']
-    X = combined_hourly[features]
+    X = combined_hourly[FEATURES]
     y = combined_hourly['PORT_MED']
 
     # Dividi i dati in training e test
-    X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=0.2, random_state=42, shuffle=True)
-
-    # Ottimizzazione tramite Grid Search
-    param_grid = {
-        'n_estimators': [50, 100, 200],
-        'max_depth': [10, 20, None],
-        'min_samples_split': [2, 5, 10]
-    }
-
-    grid_search = GridSearchCV(
-        RandomForestRegressor(random_state=42),
-        param_grid,
-        cv=3,
-        scoring='neg_mean_squared_error',
-        verbose=1
-    )
+    return train_test_split(X, y, test_size=0.2, random_state=42, shuffle=True)
+
+# Funzione per eseguire il training di un fiume in sequenza
+def train_model_for_river(river_name, river_files, search="grid", workers=None):
+    X_train, X_test, y_train, y_test = prepare_dataset(river_name, river_files)
+
+    if search == "halving":
+        # Successive halving: tutte le configurazioni partono su pochi campioni e a ogni
+        # iterazione solo il terzo migliore passa a un campione 3 volte più grande,
+        # quindi i fit sull'intero training set si fanno solo per le configurazioni promettenti
+        grid_search = HalvingGridSearchCV(
+            RandomForestRegressor(random_state=42),
+            param_grid,
+            cv=3,
+            factor=3,
+            resource='n_samples',
+            scoring='neg_mean_squared_error',
+            n_jobs=workers,
+            random_state=42,
+            verbose=1
+        )
+    else:
+        # Ottimizzazione tramite Grid Search
+        grid_search = GridSearchCV(
+            RandomForestRegressor(random_state=42),
+            param_grid,
+            cv=3,
+            scoring='neg_mean_squared_error',
+            verbose=1
+        )
     grid_search.fit(X_train, y_train)
+    write_search_table(river_name, search_table(grid_search.cv_results_))
 
     # Migliori parametri trovati
     print(f"Best parameters for {river_name}: {grid_search.best_params_}")
@@ -85,17 +98,49 @@ def train_model_for_river(river_name, river_files):
     mse = mean_squared_error(y_test, y_pred)
     print(f"Mean Squared Error for {river_name}: {mse}")
 
-    # Salva il modello
-    model_filename = f"{river_name}_random_forest.pkl"
-    joblib.dump(best_model, model_filename)
-    print(f"Modello Random Forest ottimizzato salvato come '{model_filename}'.")
+    # Salva il modello e la tabella precalcolata usata a runtime al posto del .pkl
+    export_model(best_model, f"{river_name}_random_forest.pkl")
 
 # Cerca tutte le cartelle per ciascun fiume
-for river_folder in os.listdir(base_dir):
-    river_path = os.path.join(base_dir, river_folder)
-    if os.path.isdir(river_path):
-        # Cerca tutti i file CSV nella cartella
-        river_files = [os.path.join(river_path, file) for file in os.listdir(river_path) if file.endswith(".csv")]
-        if river_files:
-            river_name = river_folder  # Usa il nome della cartella come identificatore del fiume
+def find_river_files(base_dir):
+    rivers = {}
+    for river_folder in sorted(os.listdir(base_dir)):
+        river_path = os.path.join(base_dir, river_folder)
+        if os.path.isdir(river_path):
+            # Cerca tutti i file CSV nella cartella
+            river_files = sorted(os.path.join(river_path, file) for file in os.listdir(river_path) if file.endswith(".csv"))
+            if river_files:
+                rivers[river_folder] = river_files  # Usa il nome della cartella come identificatore del fiume
+    return rivers
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Training dei modelli di portata dei fiumi.")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(),
+                        help="Processi del pool (parallelismo totale, default: numero di CPU)")
+    parser.add_argument("--sequential", action="store_true",
+                        help="Un fiume alla volta con GridSearchCV su un solo core (comportamento storico)")
+    parser.add_argument("--search", choices=("grid", "halving"), default="grid",
+                        help="grid: ricerca esaustiva; halving: successive halving sul numero di campioni")
+    parser.add_argument("--compact", nargs="*", choices=list(compact_candidates()),
+                        help="Esporta anche i modelli compatti indicati (tutti se senza argomenti) con il report dei costi")
+    parser.add_argument("--mse-tolerance", type=float, default=0.05,
+                        help="Peggioramento relativo di MSE ammesso per il modello consigliato (default 0.05)")
+    args = parser.parse_args()
+
+    rivers = find_river_files(base_dir)
+    datasets = {}
+    if args.search == "halving":
+        for river_name, river_files in rivers.items():
+            train_model_for_river(river_name, river_files, search="halving", workers=args.workers)
+    elif args.sequential:
+        for river_name, river_files in rivers.items():
             train_model_for_river(river_name, river_files)
+    else:
+        datasets = {river_name: prepare_dataset(river_name, river_files) for river_name, river_files in rivers.items()}
+        train_rivers_parallel(datasets, param_grid, workers=args.workers)
+
+    if args.compact is not None:
+        for river_name, river_files in rivers.items():
+            dataset = datasets.get(river_name) or prepare_dataset(river_name, river_files)
+            export_compact_models(river_name, dataset, f"{river_name}_random_forest.pkl",
+                                  kinds=args.compact, mse_tolerance=args.mse_tolerance)
@@ -0,0 +1,168 @@
+import os
+import sys
+import json
+import time
+import glob
+import argparse
+import hashlib
+import platform
+import warnings
+from datetime import datetime
+import numpy as np  # type: ignore
+import pandas as pd  # type: ignore
+import joblib  # type: ignore
+import sklearn  # type: ignore
+# inflow_table è condiviso con i servizi nella directory COMMON
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "COMMON"))
+from inflow_table import FEATURES, InflowLookupTable, SklearnInflowModel, calendar_grid, cyclical_features, lookup_table_path
+
+
+def timings(function, repeat):
+    """Esegue function 'repeat' volte e restituisce min, mediana e 95° percentile in millisecondi."""
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        samples.append(time.perf_counter() - start)
+    samples = np.asarray(samples) * 1000
+    return {"min_ms": float(samples.min()), "median_ms": float(np.median(samples)),
+            "p95_ms": float(np.percentile(samples, 95))}
+
+
+def single_row_frame(day_of_year, hour_of_day):
+    """Input a riga singola come lo costruivano sensori e ANALYZER (DataFrame di un dizionario)."""
+    sin_day, cos_day, sin_hour, cos_hour = cyclical_features(day_of_year, hour_of_day)[0]
+    return pd.DataFrame([{
+        'sin_day': sin_day,
+        'cos_day': cos_day,
+        'sin_hour': sin_hour,
+        'cos_hour': cos_hour
+    }])
+
+
+def file_digest(path):
+    with open(path, "rb") as model_file:
+        return hashlib.sha256(model_file.read()).hexdigest()[:16]
+
+
+def benchmark_model(model_filename, repeat=5, single_calls=200):
+    """
+    Costi di caricamento e predizione di un modello, come li pagano i consumatori:
+    joblib.load, predict a riga singola tramite DataFrame, tramite ndarray e tramite il FeatureEncoder
+    (percorso runtime di SklearnInflowModel), predict in batch sull'anno intero (366 x 24 ore) e, se presente, la tabella precalcolata.
+    """
+    model = joblib.load(model_filename)
+    day_of_year, hour_of_day = 172, 12
+    X_row = cyclical_features(day_of_year, hour_of_day)
+    doy, hour = calendar_grid()
+    X_year = cyclical_features(doy, hour)
+    year_frame = pd.DataFrame(X_year, columns=FEATURES)
+    encoded_model = SklearnInflowModel(joblib.load(model_filename))
+
+    def predict_ndarray():
+        # Un modello addestrato su DataFrame avvisa a ogni chiamata con un ndarray
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", UserWarning)
+            model.predict(X_row)
+
+    model.predict(single_row_frame(day_of_year, hour_of_day))
+    result = {
+        "model": os.path.basename(model_filename),
+        "sha256": file_digest(model_filename),
+        "size_bytes": os.path.getsize(model_filename),
+        "load": timings(lambda: joblib.load(model_filename), repeat),
+        "single_row_dataframe": timings(lambda: model.predict(single_row_frame(day_of_year, hour_of_day)), single_calls),
+        "single_row_ndarray": timings(predict_ndarray, single_calls),
+        "single_row_encoder": timings(lambda: encoded_model.predict(day_of_year, hour_of_day), single_calls),
+        "batch_year": timings(lambda: model.predict(year_frame), repeat),
+        "batch_rows": len(year_frame),
+    }
+    result["batch_us_per_row"] = result["batch_year"]["min_ms"] * 1000 / len(year_frame)
+
+    table_filename = lookup_table_path(model_filename)
+    if os.path.exists(table_filename):
+        table = InflowLookupTable(table_filename)
+        result["lookup_table"] = {
+            "size_bytes": os.path.getsize(table_filename),
+            "load": timings(lambda: InflowLookupTable(table_filename), repeat),
+            "single": timings(lambda: table.predict(day_of_year, hour_of_day), single_calls),
+            "batch_year": timings(lambda: table.predict_many(doy, hour), repeat),
+        }
+    return result
+
+
+def environment():
+    """Versioni e macchina, per confrontare solo risultati comparabili."""
+    return {
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "python": sys.version.split()[0],
+        "numpy": np.__version__,
+        "pandas": pd.__version__,
+        "scikit-learn": sklearn.__version__,
+        "machine": platform.machine(),
+        "processor": platform.processor(),
+        "cpu_count": os.cpu_count(),
+    }
+
+
+METRICS = [
+    ("load", "median_ms"),
+    ("single_row_dataframe", "median_ms"),
+    ("single_row_ndarray", "median_ms"),
+    ("single_row_encoder", "median_ms"),
+    ("batch_year", "min_ms"),
+]
+
+
+def compare(results, baseline, threshold):
+    """Stampa le variazioni rispetto a un report precedente; restituisce il numero di regressioni."""
+    previous = {result["model"]: result for result in baseline.get("results", [])}
+    regressions = 0
+    for result in results:
+        old = previous.get(result["model"])
+        if not old:
+            continue
+        for section, statistic in METRICS:
+            if section not in old:
+                continue  # Misura non presente nel report precedente
+            ratio = result[section][statistic] / old[section][statistic] if old[section][statistic] else 1.0
+            flag = ""
+            if ratio > 1 + threshold:
+                flag = "  <-- regression"
+                regressions += 1
+            print(f"{result['model']:<32} {section:<22} {old[section][statistic]:>10.3f} -> "
+                  f"{result[section][statistic]:>10.3f} ms ({ratio:.2f}x){flag}")
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark di caricamento e predizione dei modelli di portata.")
+    parser.add_argument("models", nargs="*", help="File .pkl da misurare (default: tutti i .pkl nella directory corrente)")
+    parser.add_argument("--repeat", type=int, default=5, help="Ripetizioni di caricamento e batch")
+    parser.add_argument("--single-calls", type=int, default=200, help="Chiamate per le misure a riga singola")
+    parser.add_argument("--output", default="benchmark_models.json", help="File JSON dei risultati")
+    parser.add_argument("--baseline", help="Report JSON precedente con cui confrontare i risultati")
+    parser.add_argument("--threshold", type=float, default=0.2,
+                        help="Rallentamento relativo oltre il quale una misura è segnalata come regressione")
+    args = parser.parse_args()
+
+    model_files = args.models or sorted(glob.glob("*.pkl"))
+    results = []
+    for model_filename in model_files:
+        result = benchmark_model(model_filename, args.repeat, args.single_calls)
+        results.append(result)
+        print(f"{result['model']:<32} load {result['load']['median_ms']:>8.1f} ms | "
+              f"1 row DataFrame {result['single_row_dataframe']['median_ms']:>7.3f} ms | "
+              f"1 row ndarray {result['single_row_ndarray']['median_ms']:>7.3f} ms | "
+              f"1 row encoder {result['single_row_encoder']['median_ms']:>7.3f} ms | "
+              f"year {result['batch_year']['min_ms']:>8.1f} ms")
+
+    report = {"environment": environment(), "results": results}
+    with open(args.output, "w") as output_file:
+        json.dump(report, output_file, indent=2)
+    print(f"Risultati salvati in '{args.output}'.")
+
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            regressions = compare(results, json.load(baseline_file), args.threshold)
+        sys.exit(1 if regressions else 0)
@@ -0,0 +1,90 @@
+import json
+import time
+import joblib  # type: ignore
+from sklearn.ensemble import HistGradientBoostingRegressor, RandomForestRegressor  # type: ignore
+from sklearn.linear_model import Ridge  # type: ignore
+from sklearn.metrics import mean_squared_error  # type: ignore
+from sklearn.pipeline import make_pipeline  # type: ignore
+from sklearn.preprocessing import PolynomialFeatures  # type: ignore
+from benchmark_models import benchmark_model
+from parallel_training import export_model
+
+
+def compact_candidates():
+    """Modelli compatti addestrati sulle stesse feature sin/cos della Random Forest."""
+    return {
+        # Foresta piccola e poco profonda: stesso tipo di modello, una frazione dei nodi
+        "forest": RandomForestRegressor(n_estimators=30, max_depth=10, min_samples_leaf=5, random_state=42),
+        # Gradient boosting su istogrammi: alberi piccoli, predizione molto veloce
+        "hgb": HistGradientBoostingRegressor(max_iter=200, learning_rate=0.1, random_state=42),
+        # Serie di Fourier: i prodotti di sin/cos fino al grado 4 generano le armoniche
+        # superiori di giorno e ora, poi una regressione lineare con poca regolarizzazione
+        "fourier": make_pipeline(PolynomialFeatures(degree=4, include_bias=False), Ridge(alpha=1e-3)),
+    }
+
+
+def compact_model_path(river_name, kind):
+    return f"{river_name}_compact_{kind}.pkl"
+
+
+def measure_model(model_filename, X_test, y_test, repeat=3, single_calls=200):
+    """
+    Costo di inferenza di un modello salvato (misure di benchmark_models.py): dimensione del file,
+    tempo di caricamento, latenza di una predizione a riga singola (FeatureEncoder, percorso dei consumatori),
+    costo per predizione in batch su un anno intero e MSE sul test set.
+    """
+    benchmark = benchmark_model(model_filename, repeat, single_calls)
+    return {
+        "file": model_filename,
+        "size_bytes": benchmark["size_bytes"],
+        "load_ms": benchmark["load"]["min_ms"],
+        "single_row_ms": benchmark["single_row_encoder"]["median_ms"],
+        "batch_us_per_row": benchmark["batch_us_per_row"],
+        "test_mse": float(mean_squared_error(y_test, joblib.load(model_filename).predict(X_test))),
+    }
+
+
+def export_compact_models(river_name, dataset, reference_model_filename, kinds=None, mse_tolerance=0.05):
+    """
+    Addestra ed esporta i modelli compatti accanto alla Random Forest e scrive <fiume>_model_report.json
+    con i costi di ogni modello. Il modello consigliato è il più piccolo con MSE entro
+    (1 + mse_tolerance) volte quello della Random Forest di riferimento.
+    :param dataset: (X_train, X_test, y_train, y_test) del fiume.
+    :return: Report come dizionario.
+    """
+    X_train, X_test, y_train, y_test = dataset
+    candidates = compact_candidates()
+    kinds = kinds or list(candidates)
+
+    models = [dict(kind="random_forest", **measure_model(reference_model_filename, X_test, y_test))]
+    for kind in kinds:
+        model = candidates[kind]
+        start = time.perf_counter()
+        model.fit(X_train, y_train)
+        fit_time = time.perf_counter() - start
+        model_filename = compact_model_path(river_name, kind)
+        export_model(model, model_filename, label=f"Modello compatto ({kind})")
+        models.append(dict(kind=kind, fit_s=fit_time, **measure_model(model_filename, X_test, y_test)))
+
+    bound = models[0]["test_mse"] * (1 + mse_tolerance)
+    eligible = [model for model in models if model["test_mse"] <= bound]
+    recommended = min(eligible, key=lambda model: model["size_bytes"]) if eligible else models[0]
+    report = {
+        "river": river_name,
+        "mse_bound": bound,
+        "mse_tolerance": mse_tolerance,
+        "recommended": recommended["file"],
+        "models": models,
+    }
+
+    report_filename = f"{river_name}_model_report.json"
+    with open(report_filename, "w") as report_file:
+        json.dump(report, report_file, indent=2)
+
+    print(f"{'Model':<14} {'size (KB)':>10} {'load (ms)':>10} {'1 row (ms)':>11} {'batch (us)':>11} {'test MSE':>10}")
+    for model in models:
+        print(f"{model['kind']:<14} {model['size_bytes'] / 1024:>10.1f} {model['load_ms']:>10.1f} "
+              f"{model['single_row_ms']:>11.3f} {model['batch_us_per_row']:>11.3f} {model['test_mse']:>10.4f}")
+    print(f"Modello consigliato per {river_name} (MSE <= {bound:.4f}): {recommended['file']}")
+    print(f"Report dei modelli salvato come '{report_filename}'.")
+    return report
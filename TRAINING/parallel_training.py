@@ -0,0 +1,203 @@
+import os
+import sys
+import time
+import shutil
+import tempfile
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np  # type: ignore
+import pandas as pd  # type: ignore
+import joblib  # type: ignore
+from sklearn.ensemble import RandomForestRegressor  # type: ignore
+from sklearn.model_selection import KFold, ParameterGrid  # type: ignore
+from sklearn.metrics import mean_squared_error  # type: ignore
+# inflow_table è condiviso con i servizi nella directory COMMON
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "COMMON"))
+from inflow_table import FEATURES, SklearnInflowModel, build_lookup_table, lookup_table_path, save_lookup_table
+
+# Array mappati aperti da ogni processo worker (uno per file, riusati tra i task)
+_shared_arrays = {}
+
+
+def export_model(model, model_filename, label="Modello Random Forest ottimizzato"):
+    """Salva il modello (.pkl) e la tabella precalcolata (366 x 24, float32) usata a runtime."""
+    joblib.dump(model, model_filename)
+    print(f"{label} salvato come '{model_filename}'.")
+    table_filename = lookup_table_path(model_filename)
+    save_lookup_table(build_lookup_table(SklearnInflowModel(model)), table_filename)
+    print(f"Tabella di lookup salvata come '{table_filename}'.")
+
+
+def search_table(cv_results):
+    """
+    Tabella costo/punteggio per configurazione dai cv_results_ di scikit-learn (GridSearchCV o
+    HalvingGridSearchCV): campioni usati, tempo medio di fit e di predizione sul fold, MSE medio.
+    """
+    table = pd.DataFrame(list(cv_results["params"]))
+    table["iteration"] = cv_results.get("iter", np.zeros(len(table), dtype=int))
+    table["n_samples"] = cv_results.get("n_resources", np.full(len(table), -1))
+    table["fit_time"] = cv_results["mean_fit_time"]
+    table["score_time"] = cv_results["mean_score_time"]
+    table["cv_mse"] = -np.asarray(cv_results["mean_test_score"])
+    return table.sort_values(["iteration", "cv_mse"], ascending=[False, True]).reset_index(drop=True)
+
+
+def write_search_table(river_name, table):
+    """Salva e stampa la tabella costo/punteggio della ricerca degli iperparametri."""
+    filename = f"{river_name}_search_results.csv"
+    table.to_csv(filename, index=False)
+    print(table.head(10).to_string(index=False))
+    print(f"Tabella costo/punteggio salvata come '{filename}'.")
+
+
+def share_dataset(work_dir, river_name, X_train, X_test, y_train, y_test):
+    """
+    Scrive il dataset di un fiume come .npy nella directory di lavoro: i worker lo mappano
+    in memoria (mmap) invece di riceverne una copia serializzata per ogni task.
+    Le feature sono salvate in float32, il tipo usato internamente dalla Random Forest.
+    """
+    arrays = {
+        "X_train": np.ascontiguousarray(X_train, dtype=np.float32),
+        "X_test": np.ascontiguousarray(X_test, dtype=np.float32),
+        "y_train": np.ascontiguousarray(y_train, dtype=np.float64),
+        "y_test": np.ascontiguousarray(y_test, dtype=np.float64),
+    }
+    paths = {}
+    for name, array in arrays.items():
+        paths[name] = os.path.join(work_dir, f"{river_name}_{name}.npy")
+        np.save(paths[name], array)
+    return paths
+
+
+def _load_shared(path):
+    if path not in _shared_arrays:
+        _shared_arrays[path] = np.load(path, mmap_mode="r")
+    return _shared_arrays[path]
+
+
+def fit_fold(river_name, paths, param_index, params, fold, n_splits=3, random_state=42):
+    """Addestra una configurazione su un fold (come GridSearchCV con cv=n_splits) e restituisce MSE e tempi."""
+    started = time.time()
+    wall_start, cpu_start = time.perf_counter(), time.process_time()
+    X = _load_shared(paths["X_train"])
+    y = _load_shared(paths["y_train"])
+    train_index, validation_index = list(KFold(n_splits=n_splits).split(X))[fold]
+
+    model = RandomForestRegressor(random_state=random_state, **params)
+    model.fit(X[train_index], y[train_index])
+    fit_time = time.perf_counter() - wall_start
+    mse = mean_squared_error(y[validation_index], model.predict(X[validation_index]))
+    return {
+        "river": river_name, "param_index": param_index, "fold": fold, "mse": mse, "n_samples": len(train_index),
+        "fit_time": fit_time, "score_time": time.perf_counter() - wall_start - fit_time,
+        "wall": time.perf_counter() - wall_start, "cpu": time.process_time() - cpu_start,
+        "started": started, "finished": time.time(),
+    }
+
+
+def refit_model(river_name, paths, params, model_filename, random_state=42):
+    """Riaddestra la configurazione migliore su tutto il training set, la valuta sul test set e la esporta."""
+    started = time.time()
+    wall_start, cpu_start = time.perf_counter(), time.process_time()
+    X_train = pd.DataFrame(_load_shared(paths["X_train"]), columns=FEATURES)
+    X_test = pd.DataFrame(_load_shared(paths["X_test"]), columns=FEATURES)
+
+    model = RandomForestRegressor(random_state=random_state, **params)
+    model.fit(X_train, _load_shared(paths["y_train"]))
+    mse = mean_squared_error(_load_shared(paths["y_test"]), model.predict(X_test))
+    export_model(model, model_filename)
+    return {
+        "river": river_name, "mse": mse,
+        "wall": time.perf_counter() - wall_start, "cpu": time.process_time() - cpu_start,
+        "started": started, "finished": time.time(),
+    }
+
+
+def estimated_cost(params):
+    """Stima grossolana del costo di una configurazione (per avviare prima i task più lunghi)."""
+    depth = params.get("max_depth") or 64
+    return params.get("n_estimators", 100) * depth / params.get("min_samples_split", 2) ** 0.5
+
+
+def train_rivers_parallel(datasets, param_grid, workers=None, n_splits=3, random_state=42):
+    """
+    Grid search di tutti i fiumi su un unico pool di processi: ogni task è (fiume, configurazione, fold)
+    con una Random Forest a singolo core, quindi il parallelismo totale è pari a 'workers'.
+    Il refit di un fiume parte appena i suoi fold sono completi.
+    :param datasets: Dizionario fiume -> (X_train, X_test, y_train, y_test).
+    :return: Dizionario fiume -> {best_params, cv_mse, test_mse, model_filename, tempi}.
+    """
+    workers = workers or os.cpu_count()
+    candidates = list(ParameterGrid(param_grid))
+    order = sorted(range(len(candidates)), key=lambda index: -estimated_cost(candidates[index]))
+    work_dir = tempfile.mkdtemp(prefix="training_")
+    results = {}
+    start = time.perf_counter()
+    try:
+        shared = {river_name: share_dataset(work_dir, river_name, *data) for river_name, data in datasets.items()}
+        scores = {river_name: np.full((len(candidates), n_splits), np.nan) for river_name in datasets}
+        fit_times = {river_name: np.zeros((len(candidates), n_splits)) for river_name in datasets}
+        score_times = {river_name: np.zeros((len(candidates), n_splits)) for river_name in datasets}
+        timings = {river_name: {"cpu": 0.0, "task_wall": 0.0, "started": float("inf"), "finished": 0.0}
+                   for river_name in datasets}
+
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            pending = {
+                pool.submit(fit_fold, river_name, shared[river_name], index, candidates[index], fold, n_splits, random_state)
+                for index in order for river_name in datasets for fold in range(n_splits)
+            }
+            print(f"Training: {len(pending)} fit ({len(datasets)} rivers x {len(candidates)} configs x {n_splits} folds) "
+                  f"on {workers} workers")
+            while pending:
+                future = next(as_completed(pending))
+                pending.remove(future)
+                result = future.result()
+                river_name = result["river"]
+                timing = timings[river_name]
+                timing["cpu"] += result["cpu"]
+                timing["task_wall"] += result["wall"]
+                timing["started"] = min(timing["started"], result["started"])
+                timing["finished"] = max(timing["finished"], result["finished"])
+
+                if "fold" not in result:
+                    results[river_name].update(test_mse=result["mse"], refit_wall=result["wall"], refit_cpu=result["cpu"])
+                    continue
+                scores[river_name][result["param_index"], result["fold"]] = result["mse"]
+                fit_times[river_name][result["param_index"], result["fold"]] = result["fit_time"]
+                score_times[river_name][result["param_index"], result["fold"]] = result["score_time"]
+                if not np.isnan(scores[river_name]).any():
+                    # Stesso criterio di GridSearchCV: MSE medio minimo, a parità la prima configurazione
+                    mean_mse = scores[river_name].mean(axis=1)
+                    best_index = int(np.argmin(mean_mse))
+                    model_filename = f"{river_name}_random_forest.pkl"
+                    results[river_name] = {
+                        "best_params": candidates[best_index],
+                        "cv_mse": float(mean_mse[best_index]),
+                        "model_filename": model_filename,
+                    }
+                    print(f"Best parameters for {river_name}: {candidates[best_index]}")
+                    write_search_table(river_name, search_table({
+                        "params": candidates,
+                        "n_resources": np.full(len(candidates), result["n_samples"]),
+                        "mean_fit_time": fit_times[river_name].mean(axis=1),
+                        "mean_score_time": score_times[river_name].mean(axis=1),
+                        "mean_test_score": -mean_mse,
+                    }))
+                    pending.add(pool.submit(
+                        refit_model, river_name, shared[river_name], candidates[best_index], model_filename, random_state
+                    ))
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    total_wall = time.perf_counter() - start
+    total_cpu = 0.0
+    print(f"{'River':<10} {'wall (s)':>9} {'CPU (s)':>9} {'CPU/wall':>9} {'CV MSE':>10} {'test MSE':>10}")
+    for river_name, result in results.items():
+        timing = timings[river_name]
+        wall = timing["finished"] - timing["started"]
+        total_cpu += timing["cpu"]
+        result.update(wall=wall, cpu=timing["cpu"], task_wall=timing["task_wall"])
+        print(f"{river_name:<10} {wall:>9.1f} {timing['cpu']:>9.1f} {timing['cpu'] / wall if wall else 0:>9.2f} "
+              f"{result['cv_mse']:>10.4f} {result.get('test_mse', float('nan')):>10.4f}")
+    print(f"Total: wall {total_wall:.1f} s, CPU {total_cpu:.1f} s "
+          f"(parallel efficiency {total_cpu / (total_wall * workers) if total_wall else 0:.0%} on {workers} workers)")
+    return results
@@ -0,0 +1,111 @@
+import os
+import hashlib
+import numpy as np  # type: ignore
+import pandas as pd  # type: ignore
+
+CACHE_DIR = "ingest_cache"   # Cache colonnare delle medie orarie (una .npz per fiume-anno)
+CACHE_VERSION = 1            # Da incrementare se cambia il formato o il calcolo della cache
+
+
+def parse_hourly_average(file):
+    """Legge il CSV di un fiume-anno e calcola la media oraria della portata (PORT_MED)."""
+    # Carica solo le colonne usate
+    df = pd.read_csv(file, sep=";", usecols=['ANNO', 'MESE', 'GIORNO', 'ORA', 'PORT_MED'])
+
+    # Converti le colonne in numerico
+    df['PORT_MED'] = pd.to_numeric(df['PORT_MED'], errors='coerce')
+    df['ORA'] = pd.to_numeric(df['ORA'], errors='coerce')
+    df['GIORNO'] = pd.to_numeric(df['GIORNO'], errors='coerce')
+    df['MESE'] = pd.to_numeric(df['MESE'], errors='coerce')
+
+    # Rimuovi righe con valori mancanti
+    df = df.dropna(subset=['PORT_MED', 'ORA', 'GIORNO', 'MESE'])
+
+    # Aggiungi una colonna per la data completa
+    df['DateTime'] = pd.to_datetime(dict(year=df['ANNO'], month=df['MESE'], day=df['GIORNO'], hour=df['ORA']))
+
+    # Raggruppa per data e ora e calcola la media
+    hourly_avg = df.groupby('DateTime')['PORT_MED'].mean().reset_index()
+    return hourly_avg
+
+
+def file_sha256(file):
+    """Hash SHA-256 del contenuto del file."""
+    digest = hashlib.sha256()
+    with open(file, "rb") as source:
+        for block in iter(lambda: source.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def cache_path(file, cache_dir=CACHE_DIR):
+    """Percorso della cache di un CSV: <cache_dir>/<fiume>/<nome del csv>.npz"""
+    river_name = os.path.basename(os.path.dirname(os.path.abspath(file)))
+    return os.path.join(cache_dir, river_name, os.path.splitext(os.path.basename(file))[0] + ".npz")
+
+
+def _save_cache(path, columns, stat, sha256):
+    """Scrive la cache in modo atomico (file temporaneo + rename)."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temp_path = f"{path}.tmp"
+    with open(temp_path, "wb") as cache_file:
+        np.savez(
+            cache_file,
+            cache_version=np.int64(CACHE_VERSION),
+            source_mtime_ns=np.int64(stat.st_mtime_ns),
+            source_size=np.int64(stat.st_size),
+            source_sha256=np.array(sha256),
+            **columns
+        )
+    os.replace(temp_path, path)
+
+
+def _columns_frame(columns):
+    return pd.DataFrame({
+        'DateTime': columns['date_time'],
+        'PORT_MED': columns['flow'],
+        'DayOfYear': columns['day_of_year'],
+        'HourOfDay': columns['hour_of_day'],
+    })
+
+
+def load_hourly_average(file, cache_dir=CACHE_DIR):
+    """
+    Media oraria di un fiume-anno con le feature di calendario, letta dalla cache se valida.
+    La cache viene ricostruita solo se cambia il CSV: mtime e dimensione uguali bastano,
+    altrimenti si confronta l'hash del contenuto (un semplice touch non forza il parsing).
+    :return: DataFrame con DateTime, PORT_MED, DayOfYear e HourOfDay.
+    """
+    path = cache_path(file, cache_dir)
+    stat = os.stat(file)
+    sha256 = None
+    if os.path.exists(path):
+        try:
+            with np.load(path) as cached:
+                columns = {name: cached[name] for name in ('date_time', 'flow', 'day_of_year', 'hour_of_day')}
+                valid = int(cached['cache_version']) == CACHE_VERSION
+                same_stat = int(cached['source_mtime_ns']) == stat.st_mtime_ns and int(cached['source_size']) == stat.st_size
+                cached_sha256 = str(cached['source_sha256'])
+            if valid and same_stat:
+                return _columns_frame(columns)
+            if valid:
+                sha256 = file_sha256(file)
+                if sha256 == cached_sha256:
+                    # Contenuto invariato: aggiorna solo mtime e dimensione registrati
+                    _save_cache(path, columns, stat, sha256)
+                    return _columns_frame(columns)
+        except (OSError, KeyError, ValueError) as e:
+            print(f"Cache {path} non valida, verrà ricostruita: {e}")
+
+    hourly_avg = parse_hourly_average(file)
+    date_time = hourly_avg['DateTime']
+    columns = {
+        'date_time': date_time.to_numpy(dtype='datetime64[s]'),
+        'flow': hourly_avg['PORT_MED'].to_numpy(dtype=np.float64),
+        # Feature di calendario con gli accessor vettoriali (nessuna chiamata Python per riga)
+        'day_of_year': date_time.dt.dayofyear.to_numpy(dtype=np.int16),
+        'hour_of_day': date_time.dt.hour.to_numpy(dtype=np.int8),
+    }
+    _save_cache(path, columns, stat, sha256 or file_sha256(file))
+    print(f"Cache colonnare aggiornata: {path} ({len(hourly_avg)} ore)")
+    return _columns_frame(columns)